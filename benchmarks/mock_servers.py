@@ -0,0 +1,212 @@
+"""
+Local stand-ins for the Karbon and AskNicely APIs, used by the benchmark harness.
+
+Both servers answer the handful of endpoints the webhook pipeline calls, with configurable
+latency, error rate and organization/contact fan-out, and count every request they receive.
+"""
+import asyncio
+import datetime
+import random
+import re
+from aiohttp import web
+
+class MockUpstream:
+    """
+    Base for a local aiohttp server that adds latency and random 503s to every response.
+
+    Parameters:
+        latency (float): Seconds added to every response.
+        jitter (float): Extra random latency of up to this many seconds.
+        error_rate (float): Share of requests (0-1) answered with 503 and a short Retry-After.
+        host (str): Interface to listen on. The port is picked by the OS.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, host='127.0.0.1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.host = host
+        self.port = None
+        self.calls = {}
+        self.errors = 0
+        self.bytes_sent = 0
+        self._runner = None
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def routes(self):
+        raise NotImplementedError
+
+    async def start(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self):
+        self.calls = {}
+        self.errors = 0
+        self.bytes_sent = 0
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        # count by route template, e.g. 'GET /v3/Contacts/{key}', not per key.
+        resource = request.match_info.route.resource
+        route = f"{request.method} {resource.canonical if resource else request.path}"
+        self.calls[route] = self.calls.get(route, 0) + 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({'error': 'Service Unavailable'}, status=503, headers={'Retry-After': '0'})
+        response = await handler(request)
+        self.bytes_sent += len(response.body or b'')
+        return response
+
+def project(entity, select):
+    """Applies an OData $select (comma separated field names) to a dict, keeping navigation properties."""
+    if not select:
+        return entity
+    fields = set(select.split(','))
+    return {key: value for key, value in entity.items() if key in fields or isinstance(value, list)}
+
+def expand_options(expand, navigation):
+    """Returns the nested options of $expand=<navigation>(...) as a dict, or None if it isn't expanded."""
+    match = re.match(rf"{navigation}(?:\((.*)\))?$", expand or '')
+    if not match:
+        return None
+    return dict(option.split('=', 1) for option in (match.group(1) or '').split(';') if option)
+
+class MockKarbonServer(MockUpstream):
+    """
+    Serves WorkItems (one at a time, or listed with $top/$skip), Organizations (with $expand=Contacts, optionally paged with nested
+    $top/$skip), Contacts (listed with $top/$skip, or one at a time with $expand=BusinessCards)
+    and Notes. $select is honoured at the top level and inside $expand.
+
+    Every work item is a completed, NPS-eligible work item for organization ORG<n>, where n cycles
+    through organizations. Each organization has contacts_per_org contacts, and every
+    missing_email_every-th contact has no email address (0 disables). The work item list holds
+    listed_work_items of them, WI0 to WI<n>, and ignores $filter.
+    """
+
+    def __init__(self, organizations=10, contacts_per_org=3, missing_email_every=0, listed_work_items=0, **kwargs):
+        super().__init__(**kwargs)
+        self.listed_work_items = listed_work_items
+        self.organizations = organizations
+        self.contacts_per_org = contacts_per_org
+        self.missing_email_every = missing_email_every
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v3"
+
+    def routes(self):
+        return [
+            web.get('/v3/WorkItems', self.work_items),
+            web.get('/v3/WorkItems/{key}', self.work_item),
+            web.get('/v3/Organizations/{key}', self.organization),
+            web.get('/v3/Contacts', self.contacts),
+            web.get('/v3/Contacts/{key}', self.contact),
+            web.post('/v3/Notes', self.note)
+        ]
+
+    def organization_for(self, work_item_key):
+        return f"ORG{sum(map(ord, work_item_key)) % self.organizations}"
+
+    async def work_items(self, request):
+        top = int(request.query.get('$top', 100))
+        skip = int(request.query.get('$skip', 0))
+        keys = [f"WI{index}" for index in range(skip, min(skip + top, self.listed_work_items))]
+        return web.json_response({'value': [project(self.work_item_for(key), request.query.get('$select')) for key in keys]})
+
+    async def work_item(self, request):
+        return web.json_response(project(self.work_item_for(request.match_info['key']), request.query.get('$select')))
+
+    def work_item_for(self, key):
+        completed = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {
+            'WorkItemKey': key,
+            'Title': f"Benchmark work item {key}",
+            'Description': 'Benchmark work item description. ' * 20,
+            'PrimaryStatus': 'Completed',
+            'SecondaryStatus': 'Completed',
+            'WorkType': 'Internal',
+            'StartDate': completed,
+            'DueDate': completed,
+            'CompletedDate': completed,
+            'ClientKey': self.organization_for(key),
+            'ClientType': 'Organization',
+            'ClientName': f"Benchmark client {self.organization_for(key)}",
+            'AssigneeEmailAddress': 'assignee@example.com'
+        }
+
+    async def organization(self, request):
+        key = request.match_info['key']
+        organization = {'OrganizationKey': key, 'FullName': f"Benchmark client {key}", 'Description': 'Benchmark organization description. ' * 20}
+        options = expand_options(request.query.get('$expand'), 'Contacts')
+        if options is not None:
+            skip = int(options.get('$skip', 0))
+            top = int(options.get('$top', self.contacts_per_org))
+            organization['Contacts'] = [
+                project({'ContactKey': f"{key}-C{i}", 'FullName': f"Contact {i} of {key}", 'ContactType': 'Client', 'UserDefinedIdentifier': f"{key}-{i}"}, options.get('$select'))
+                for i in range(skip, min(skip + top, self.contacts_per_org))
+            ]
+        return web.json_response(project(organization, request.query.get('$select')))
+
+    async def contacts(self, request):
+        top = int(request.query.get('$top', 100))
+        skip = int(request.query.get('$skip', 0))
+        keys = [f"ORG{organization}-C{index}" for organization in range(self.organizations) for index in range(self.contacts_per_org)]
+        return web.json_response({'value': [{'ContactKey': key} for key in keys[skip:skip + top]]})
+
+    async def contact(self, request):
+        key = request.match_info['key']
+        organization_key, _, index = key.rpartition('-C')
+        missing = self.missing_email_every and index.isdigit() and (int(index) + 1) % self.missing_email_every == 0
+        contact = {
+            'ContactKey': key,
+            'FirstName': 'Bench',
+            'PreferredName': '',
+            'LastName': key,
+            'Salutation': 'Dr',
+            'ContactType': 'Client',
+            'Description': 'Benchmark contact description. ' * 20
+        }
+        options = expand_options(request.query.get('$expand'), 'BusinessCards')
+        if options is not None:
+            cards = [
+                {'OrganizationKey': 'OTHER', 'IsPrimaryCard': True, 'EmailAddresses': [] if missing else [f"{key}@primary.example.com"], 'PhoneNumbers': [], 'Addresses': 'Benchmark address'},
+                {'OrganizationKey': organization_key, 'IsPrimaryCard': False, 'EmailAddresses': [] if missing else [f"{key}@example.com"], 'PhoneNumbers': [], 'Addresses': 'Benchmark address'}
+            ]
+            contact['BusinessCards'] = [project(card, options.get('$select')) for card in cards]
+        return web.json_response(project(contact, request.query.get('$select')))
+
+    async def note(self, request):
+        await request.read()
+        return web.json_response({'NoteKey': 'N1'}, status=201)
+
+class MockAskNicelyServer(MockUpstream):
+    """Accepts contact trigger POSTs and answers 201 like AskNicely."""
+
+    @property
+    def trigger_url(self):
+        return f"http://{self.host}:{self.port}/api/v1/contact/trigger"
+
+    def routes(self):
+        return [web.post('/api/v1/contact/trigger', self.trigger)]
+
+    async def trigger(self, request):
+        await request.read()
+        return web.json_response({'success': True}, status=201)
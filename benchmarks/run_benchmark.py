@@ -0,0 +1,287 @@
+"""
+End-to-end benchmark of MainWebhookHandler -> webhook_processor against local mock servers.
+
+Starts stand-in Karbon and AskNicely servers (see benchmarks/mock_servers.py), points the app at
+them through KARBON_BASE_URL and ASKNICELY_TRIGGER_URL, and sends a synthetic stream of webhooks
+through the HTTP trigger. Everything runs offline, with its own temporary queue and ledger.
+
+Reports throughput, ack and end-to-end latency percentiles, outbound calls per webhook and peak
+memory. Results can be saved as a JSON baseline and compared against a previous one, so a
+regression between commits shows up as a non-zero exit code.
+
+Usage:
+    python -m benchmarks.run_benchmark --webhooks 500 --work-items 100 --contacts-per-org 5
+    python -m benchmarks.run_benchmark --save default
+    python -m benchmarks.run_benchmark --compare benchmarks/baselines/default.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from benchmarks.mock_servers import MockKarbonServer, MockAskNicelyServer
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# metric -> True when higher is better. Used to decide which direction counts as a regression.
+COMPARED_METRICS = {
+    'throughput_per_second': True,
+    'ack_latency_ms.p50': False,
+    'ack_latency_ms.p95': False,
+    'ack_latency_ms.p99': False,
+    'end_to_end_latency_ms.p50': False,
+    'end_to_end_latency_ms.p95': False,
+    'end_to_end_latency_ms.p99': False,
+    'outbound_calls_per_webhook': False,
+    'karbon_bytes_per_webhook': False,
+    'peak_memory_mb': False
+}
+
+def percentile(values, percent):
+    """Nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def summarize_latencies(seconds):
+    return {
+        'p50': round(percentile(seconds, 50) * 1000, 2) if seconds else None,
+        'p95': round(percentile(seconds, 95) * 1000, 2) if seconds else None,
+        'p99': round(percentile(seconds, 99) * 1000, 2) if seconds else None,
+        'max': round(max(seconds) * 1000, 2) if seconds else None
+    }
+
+def build_events(count, work_items, organizations, contacts_per_org, contact_share, seed):
+    """Returns a reproducible list of webhook payloads with repeated WorkItem keys and some Contact events."""
+    rng = random.Random(seed)
+    events = []
+    for _ in range(count):
+        if contacts_per_org and rng.random() < contact_share:
+            key = f"ORG{rng.randrange(organizations)}-C{rng.randrange(contacts_per_org)}"
+            events.append({'ResourcePermaKey': key, 'ResourceType': 'Contact', 'ActionType': 'Updated'})
+        else:
+            events.append({'ResourcePermaKey': f"WI{rng.randrange(work_items)}", 'ResourceType': 'WorkItem', 'ActionType': 'Updated'})
+    return events
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_benchmark(args):
+    karbon = await MockKarbonServer(
+        organizations=args.organizations,
+        contacts_per_org=args.contacts_per_org,
+        missing_email_every=args.missing_email_every,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate
+    ).start()
+    asknicely = await MockAskNicelyServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate).start()
+    data_dir = tempfile.TemporaryDirectory(prefix='avrio-benchmark-')
+
+    # the app reads its configuration at import, so the environment has to be in place first.
+    os.environ.update({
+        'KARBON_BASE_URL': karbon.base_url,
+        'ASKNICELY_TRIGGER_URL': asknicely.trigger_url,
+        'KARBON_ACCESS_KEY': 'benchmark',
+        'KARBON_BEARER_TOKEN': 'benchmark',
+        'ASKNICELY_API_KEY': 'benchmark',
+        'LOCAL_DATA_DIR': data_dir.name,
+        'CONTACT_DIRECTORY_PATH': os.path.join(data_dir.name, 'contact_directory.db'),
+        'WEBHOOK_QUEUE_BACKEND': args.queue_backend,
+        'WEBHOOK_COALESCE_WINDOW': str(args.coalesce_window),
+        'OUTBOUND_DEFAULT_RATE_LIMIT': str(args.outbound_rate_limit),
+        'OUTBOUND_DEFAULT_RATE_BURST': str(max(1, int(args.outbound_rate_limit))),
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+        'LOG_BODY_SAMPLE_RATE': '0',
+        # send surveys straight away, so each run measures the whole pipeline.
+        'ASK_NICELY_MINUTES_DELAY': '0'
+    })
+
+    import azure.functions as func
+    import function_app
+    from services.entity_cache import entity_cache
+    from services.http_session import close_session
+    from services.resilience import outbound_stats
+    from utils.logging_config import get_correlation_id
+
+    sent_at = {}
+    acked_at = {}
+    done_at = {}
+    failures = {'rejected': 0, 'processing': 0}
+
+    async def timed(process, payload, **kwargs):
+        try:
+            await process(payload, **kwargs)
+        except Exception:
+            failures['processing'] += 1
+            raise
+        done_at.setdefault(get_correlation_id(), time.perf_counter())
+
+    # time each webhook until processing finishes, on whichever path the backend uses.
+    if function_app.webhook_queue_consumer is not None:
+        consumer = function_app.webhook_queue_consumer
+        process = consumer.processor
+        consumer.processor = lambda payload: timed(process, payload)
+    else:
+        process = function_app.webhook_processor
+        function_app.webhook_processor = lambda payload, **kwargs: timed(process, payload, **kwargs)
+    main_handler = function_app.MainWebhookHandler.build().get_user_function()
+
+    events = build_events(args.webhooks, args.work_items, args.organizations, args.contacts_per_org, args.contact_share, args.seed)
+    pending = asyncio.Queue()
+    for index, event in enumerate(events):
+        pending.put_nowait((f"bench-{index}", event))
+
+    interval = 1 / args.rate if args.rate else 0
+    next_start = time.perf_counter()
+
+    async def sender():
+        nonlocal next_start
+        while not pending.empty():
+            correlation_id, event = pending.get_nowait()
+            if interval:
+                delay = next_start - time.perf_counter()
+                next_start = max(next_start, time.perf_counter()) + interval
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            request = func.HttpRequest(
+                method='POST',
+                url='/api/MainWebhookHandler',
+                headers={'Content-Type': 'application/json', 'x-correlation-id': correlation_id},
+                body=json.dumps(event).encode()
+            )
+            sent_at[correlation_id] = time.perf_counter()
+            response = await main_handler(request)
+            acked_at[correlation_id] = time.perf_counter()
+            if response.status_code != 202:
+                failures['rejected'] += 1
+                sent_at.pop(correlation_id)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+        deadline = time.monotonic() + args.timeout
+        while len(done_at) < len(sent_at) and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        finished = max(done_at.values(), default=time.perf_counter())
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    finally:
+        if args.trace_memory:
+            tracemalloc.stop()
+        if function_app.webhook_queue_consumer is not None:
+            await function_app.webhook_queue_consumer.stop()
+        if function_app.webhook_queue is not None:
+            await function_app.webhook_queue.close()
+        await close_session()
+        await karbon.stop()
+        await asknicely.stop()
+        data_dir.cleanup()
+
+    completed = [correlation_id for correlation_id in sent_at if correlation_id in done_at]
+    elapsed = finished - started
+    outbound_calls = karbon.total_calls + asknicely.total_calls
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    return {
+        'webhooks': len(events),
+        'accepted': len(sent_at),
+        'completed': len(completed),
+        'rejected': failures['rejected'],
+        'processing_failures': failures['processing'],
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_per_second': round(len(completed) / elapsed, 2) if elapsed > 0 else None,
+        'ack_latency_ms': summarize_latencies([acked_at[key] - sent_at[key] for key in sent_at]),
+        'end_to_end_latency_ms': summarize_latencies([done_at[key] - sent_at[key] for key in completed]),
+        'outbound_calls': outbound_calls,
+        'outbound_calls_per_webhook': round(outbound_calls / len(events), 3) if events else None,
+        'outbound_calls_by_route': dict(karbon.calls, **asknicely.calls),
+        'karbon_bytes_per_webhook': round(karbon.bytes_sent / len(events)) if events else None,
+        'upstream_errors_injected': karbon.errors + asknicely.errors,
+        'peak_memory_mb': round(traced_peak / (1024 * 1024), 2) if traced_peak is not None else round(max_rss, 2),
+        'peak_memory_source': 'tracemalloc' if traced_peak is not None else 'max_rss',
+        'outbound_stats': outbound_stats(),
+        'coalescer_stats': dict(function_app.webhook_coalescer.stats),
+        'entity_cache_stats': dict(entity_cache.stats)
+    }
+
+def lookup(results, metric):
+    value = results
+    for part in metric.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def compare(results, baseline, tolerance):
+    """Prints each compared metric against the baseline. Returns the metrics that regressed beyond tolerance."""
+    regressions = []
+    print(f"\nCompared with baseline from commit {baseline.get('commit')} ({baseline.get('created_at')}):")
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        current = lookup(results, metric)
+        previous = lookup(baseline['results'], metric)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        regressed = -change > tolerance if higher_is_better else change > tolerance
+        if regressed:
+            regressions.append(metric)
+        print(f"  {metric:<28} {previous:>10} -> {current:<10} {change:+.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the webhook pipeline end to end against local mock Karbon and AskNicely servers.")
+    parser.add_argument('--webhooks', type=int, default=200, help="Webhooks sent (default 200).")
+    parser.add_argument('--work-items', type=int, default=50, help="Distinct work item keys, so repeats exercise coalescing and dedupe (default 50).")
+    parser.add_argument('--organizations', type=int, default=10, help="Distinct client organizations (default 10).")
+    parser.add_argument('--contacts-per-org', type=int, default=3, help="Contacts on each organization (default 3).")
+    parser.add_argument('--missing-email-every', type=int, default=0, help="Every nth contact has no email address, 0 for none.")
+    parser.add_argument('--contact-share', type=float, default=0.1, help="Share of webhooks that are Contact events (default 0.1).")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds of latency added by the mock servers (default 0.05).")
+    parser.add_argument('--jitter', type=float, default=0.02, help="Extra random latency of up to this many seconds (default 0.02).")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of upstream calls answered with 503 (default 0).")
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent webhook senders (default 16).")
+    parser.add_argument('--rate', type=float, default=None, help="Maximum webhooks sent per second, default unlimited.")
+    parser.add_argument('--queue-backend', choices=('sqlite', 'none'), default='sqlite', help="Webhook queue backend (default sqlite).")
+    parser.add_argument('--coalesce-window', type=float, default=0.2, help="Coalescing window in seconds, 0 disables (default 0.2).")
+    parser.add_argument('--outbound-rate-limit', type=float, default=1000, help="Requests per second allowed to the mock servers (default 1000).")
+    parser.add_argument('--timeout', type=float, default=120, help="Seconds to wait for processing to finish (default 120).")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the synthetic webhook stream.")
+    parser.add_argument('--trace-memory', action='store_true', help="Measure peak Python allocations with tracemalloc (slower) instead of max RSS.")
+    parser.add_argument('--save', metavar='NAME', help="Save the results as benchmarks/baselines/NAME.json.")
+    parser.add_argument('--compare', metavar='PATH', help="Baseline JSON to compare against. Exits with 1 on a regression.")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Relative change allowed before a metric counts as a regression (default 0.1).")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    print(json.dumps(results, indent=2))
+
+    parameters = {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'tolerance')}
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save}.json")
+        with open(path, 'w') as file:
+            json.dump({'commit': git_commit(), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'parameters': parameters, 'results': results}, file, indent=2)
+        print(f"\nSaved baseline to {path}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('parameters') != parameters:
+            print("\nWarning: the baseline was recorded with different parameters, so the comparison may not be meaningful.")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
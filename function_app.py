@@ -1,11 +1,23 @@
 import azure.functions as func
 import logging
 import os
-from handlers.karbon_work_item_handler import work_item_handler
-from handlers.karbon_notes_handler import notes_handler
-from handlers.karbon_contacts_handler import contacts_handler
-from services.karbon_services import is_karbon_webhook
+from handlers.dispatcher import handler_dispatcher
+from handlers.registry import handler_registry
+from utils import config
+from utils.admission import admission_controller, AdmissionRejected
+from utils.coalescer import WebhookCoalescer
+from utils.event_log import get_event_log
+from utils.ingest import parse_webhook, WebhookRejected
+from utils.logging_config import setup_logging, set_correlation_id, get_correlation_id, should_log_body, redact
+from utils.metrics import span, webhooks_total, render_prometheus, stats_counter, stats_gauge
+from utils import profiling
+from utils.webhook_queue import create_webhook_queue, WebhookQueueConsumer
 import asyncio
+import functools
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
 
 # Get API keys and other environment variables
 karbon_access_key = os.getenv('KARBON_ACCESS_KEY')
@@ -14,60 +26,223 @@ azure_logic_app_handler_url = os.getenv('AZURE_LOGIC_APP_HANDLER')
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+if config.event_log_enabled and not os.getenv('EVENT_LOG_DIR'):
+    logger.warning("Event log - EVENT_LOG_DIR isn't set, so webhook history lives on this instance's temp disk and is lost when it's recycled or scaled in.")
+if config.ask_nicely_minutes_delay > 0 and not os.getenv('ACTION_SCHEDULER_PATH'):
+    logger.warning("Scheduler - ASK_NICELY_MINUTES_DELAY is set without ACTION_SCHEDULER_PATH, so held surveys live on this instance's temp disk and are lost if it's recycled or scaled in.")
+
+# Collapses bursts of events for the same resource into a single handler run.
+webhook_coalescer = WebhookCoalescer(
+    window=config.webhook_coalesce_window,
+    max_wait=config.webhook_coalesce_max_wait,
+    resource_types=config.webhook_coalesce_resource_types
+)
+
 @app.route(route="MainWebhookHandler")
 async def MainWebhookHandler(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Main Handler - Python HTTP trigger function processed a request.')
+    correlation_id = set_correlation_id(req.headers.get('x-correlation-id'))
+    logger.info('Main Handler - Python HTTP trigger function processed a request.')
 
-    # Log the request headers and body
-    logging.info(f"Request Headers: {req.headers}")
-    logging.info(f"Request Body: {req.get_body()}")
+    # Validate and decode the body in a single pass
+    with span('ingest_parse') as timing:
+        try:
+            req_body = parse_webhook(req.get_body(), req.headers)
+        except WebhookRejected as e:
+            timing.set(outcome='rejected')
+            webhooks_total.inc(resource_type='unknown', outcome=f"rejected_{e.status_code}")
+            logger.info("Main Handler - Rejected webhook with %s: %s", e.status_code, e.message)
+            return func.HttpResponse(e.message, status_code=e.status_code)
+    resource_type = req_body.get('ResourceType')
 
-    # Parse the request body safely
-    try:
-        logging.info("Trying to get JSON body of request.")
-        req_body = req.get_json()
-        logging.info(f"Parsed Request Body: {req_body}")
-    except ValueError:
-        logging.error("Main Handler - Invalid JSON received.")
-        return func.HttpResponse("Invalid JSON", status_code=400)
-    
-    # Process the webhook if it's valid for Karbon
-    logging.info("Main Handler - Checking to see if webhook is from Karbon.")
-    if is_karbon_webhook(req_body):
-        logging.info("Main Handler - Webhook appears to be from Karbon.")
+    # A webhook carrying a signed profiling token is profiled when it's processed.
+    if profiling.enabled and profiling.request_profile(req.headers, correlation_id):
+        logger.info("Main Handler - Profiling requested for this webhook.")
+
+    # Log a redacted sample of request headers and bodies
+    if should_log_body():
+        logger.info("Request Headers: %s", redact(dict(req.headers)))
+        logger.info("Parsed Request Body: %s", redact(req_body))
+
+    # Hand the webhook to the durable queue, or start processing it directly if queueing is off.
+    if webhook_queue is not None:
+        webhook_queue_consumer.ensure_started()
+        try:
+            with span('enqueue'):
+                await webhook_queue.enqueue(req_body, correlation_id)
+        except Exception as e:
+            webhooks_total.inc(resource_type=resource_type, outcome='enqueue_failed')
+            logger.error("Main Handler - Could not enqueue webhook: %s", e, exc_info=True)
+            return func.HttpResponse("Could not queue webhook, try again later.", status_code=503, headers={"Retry-After": str(config.admission_retry_after)})
     else:
-        logging.info("Main Handler - Request did not qualify as a Karbon webhook.")
-        return func.HttpResponse("Not a recognized webhook.", status_code=400)
+        # bounded, so a burst sheds with 429 + Retry-After instead of piling up unbounded tasks.
+        try:
+            admission_controller.admit(webhook_processor, req_body, correlation_id=correlation_id)
+        except AdmissionRejected as e:
+            webhooks_total.inc(resource_type=resource_type, outcome='shed')
+            logger.warning("Main Handler - Shed %s webhook with %s. Backlog: %s", resource_type, e.status_code, admission_controller.backlog)
+            return func.HttpResponse(e.message, status_code=e.status_code, headers={"Retry-After": str(e.retry_after), "x-correlation-id": correlation_id})
 
-    # Start webhook processing asynchronously
-    asyncio.create_task(webhook_processor(req_body))
+    # Record the accepted webhook for audit and lookup. A failure here must not lose the webhook.
+    if config.event_log_enabled and resource_type in config.event_log_resource_types:
+        try:
+            with span('event_log_append'):
+                get_event_log().append(req_body, correlation_id)
+        except Exception as e:
+            logger.warning("Main Handler - Could not record webhook in the event log: %s", e)
 
-    # Return the response immediately and log the response details
-    response = func.HttpResponse("Request received, processing in the background.", status_code=202, headers={"Content-Type": "application/json"})
-    logging.info(f"Response Status Code: {response.status_code}")
-    logging.info(f"Response Headers: {response.headers}")
-    return response
+    # Return the response immediately
+    webhooks_total.inc(resource_type=resource_type, outcome='accepted')
+    logger.info("Main Handler - Accepted %s %s webhook for %s.", resource_type, req_body.get('ActionType'), req_body.get('ResourcePermaKey'))
+    return func.HttpResponse("Request received, processing in the background.", status_code=202, headers={"Content-Type": "application/json", "x-correlation-id": correlation_id})
 
-async def webhook_processor(req_body) -> None:
-    resource_type = req_body.get('ResourceType')
-    logging.info(f"Main Handler - Handling {resource_type} event.")
+@app.timer_trigger(schedule="0 */5 * * * *", arg_name="timer", run_on_startup=True)
+async def WebhookQueueKeepAlive(timer: func.TimerRequest) -> None:
+    # Make sure queued webhooks are drained after a restart even if no new webhook arrives.
+    if webhook_queue is not None:
+        webhook_queue_consumer.ensure_started()
+        logger.info("Webhook queue - Depth: %s | in flight: %s", await webhook_queue.depth(), webhook_queue_consumer.in_flight)
+    else:
+        logger.info("Admission - In flight: %s | backlog: %s | shed: %s", admission_controller.in_flight, admission_controller.backlog, admission_controller.stats['shed'])
+    for resource_type, stats in handler_dispatcher.snapshot().items():
+        logger.info("Handlers - %s waiting: %s | in flight: %s | completed: %s | failed: %s", resource_type, stats['waiting'], stats['in_flight'], stats['completed'], stats['failed'])
 
-    # Mapping of Karbon resource types to handler functions
-    karbon_event_handlers = {
-        'WorkItem': work_item_handler,
-        'Contact': contacts_handler,
-        'Note': notes_handler
-    }
+    # Restart the delayed action loop, so surveys scheduled before a restart still go out.
+    if config.ask_nicely_minutes_delay > 0:
+        from utils.scheduler import get_action_scheduler
+        action_scheduler = get_action_scheduler()
+        action_scheduler.ensure_started()
+        logger.info("Scheduler - Pending actions: %s", await action_scheduler.pending())
 
-    if resource_type not in karbon_event_handlers:
-        logging.warning(f"Main Handler - Received unhandled event type: {resource_type}")
+    # Import the configured handlers off the request path, so the first webhook after a cold start doesn't pay for it.
+    if config.handler_prewarm:
+        await asyncio.to_thread(handler_registry.prewarm, config.handler_prewarm)
+
+@app.timer_trigger(schedule="0 */10 * * * *", arg_name="timer", run_on_startup=False)
+async def WorkItemReconciliation(timer: func.TimerRequest) -> None:
+    # Catch completed work items whose webhook was missed or late, with one filtered list query per sweep.
+    if not config.reconciliation_enabled:
+        return
+    from helpers.reconcile_work_items import reconcile_completed_work_items
+
+    set_correlation_id()
+    try:
+        with span('reconciliation'):
+            await reconcile_completed_work_items(karbon_bearer_token, karbon_access_key, os.getenv('ASKNICELY_API_KEY'))
+    except Exception as e:
+        logger.error("Reconciliation - Sweep failed: %s", e, exc_info=True)
+
+@app.route(route="metrics", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+async def Metrics(req: func.HttpRequest) -> func.HttpResponse:
+    # Stage timings and webhook counts, plus the counters kept by the outbound clients, cache, coalescer and queue.
+    from services.entity_cache import entity_cache
+    from services.resilience import outbound_stats
+    from utils.contact_directory import get_contact_directory
+
+    lines = []
+    outbound = outbound_stats()
+    lines += stats_counter('outbound_events_total', "Outbound requests, retries, failures, breaker sheds and throttled calls per host.", [
+        ({'host': host, 'event': event}, stats[event]) for host, stats in outbound.items() for event in ('requests', 'retries', 'failures', 'shed', 'throttled')
+    ])
+    lines += stats_counter('outbound_throttle_wait_seconds_total', "Time spent waiting on the per-host rate limiter.", [
+        ({'host': host}, stats['wait_seconds']) for host, stats in outbound.items()
+    ])
+    lines += stats_gauge('outbound_circuit_state', "1 for the current circuit breaker state of each host.", [
+        ({'host': host, 'state': stats['breaker_state']}, 1) for host, stats in outbound.items()
+    ])
+    lines += stats_counter('entity_cache_events_total', "Entity cache hits, misses, revalidations, shared fetches, evictions and invalidations.", [
+        ({'event': event}, value) for event, value in entity_cache.stats.items()
+    ])
+    if config.contact_directory_enabled:
+        lines += stats_counter('contact_directory_events_total', "Contact directory hits, misses, updates and removals.", [
+            ({'event': event}, value) for event, value in get_contact_directory().stats.items()
+        ])
+    lines += stats_counter('webhook_coalescer_events_total', "Webhooks received, merged and flushed by the coalescer.", [
+        ({'event': event}, value) for event, value in webhook_coalescer.stats.items()
+    ])
+    handlers = handler_dispatcher.snapshot()
+    lines += stats_gauge('handler_waiting', "Handler runs waiting for a concurrency slot, per resource type.", [
+        ({'resource_type': resource_type}, stats['waiting']) for resource_type, stats in handlers.items()
+    ])
+    lines += stats_gauge('handler_in_flight', "Handler runs in progress, per resource type.", [
+        ({'resource_type': resource_type}, stats['in_flight']) for resource_type, stats in handlers.items()
+    ])
+    lines += stats_counter('handler_runs_total', "Finished handler runs per resource type and outcome.", [
+        ({'resource_type': resource_type, 'outcome': outcome}, stats[outcome]) for resource_type, stats in handlers.items() for outcome in ('completed', 'failed')
+    ])
+    if config.reconciliation_enabled:
+        from helpers.reconcile_work_items import reconciliation_stats
+        lines += stats_counter('reconciliation_events_total', "Reconciliation sweeps, and work items listed, eligible and failed by them.", [
+            ({'event': event}, value) for event, value in reconciliation_stats.items()
+        ])
+    if config.ask_nicely_minutes_delay > 0:
+        from utils.scheduler import get_action_scheduler
+        action_scheduler = get_action_scheduler()
+        lines += stats_counter('scheduled_actions_total', "Delayed actions scheduled, fired, retried, dead-lettered and cancelled.", [
+            ({'event': event}, value) for event, value in action_scheduler.stats.items()
+        ])
+        try:
+            lines += stats_gauge('scheduled_actions_pending', "Delayed actions waiting to fire.", [({}, await action_scheduler.pending())])
+        except Exception as e:
+            logger.warning("Metrics - Could not count scheduled actions: %s", e)
+    if webhook_queue is None:
+        admission = admission_controller.stats
+        lines += stats_gauge('admission_in_flight', "Background webhooks running in-process.", [({}, admission_controller.in_flight)])
+        lines += stats_gauge('admission_backlog', "Background webhooks admitted but not finished, running or waiting.", [({}, admission_controller.backlog)])
+        lines += stats_counter('admission_events_total', "Background webhooks admitted, shed, completed, failed and cancelled.", [
+            ({'event': event}, admission[event]) for event in ('admitted', 'shed', 'completed', 'failed', 'cancelled')
+        ])
+        if admission['last_drain_seconds'] is not None:
+            lines += stats_gauge('admission_last_drain_seconds', "Time the last shutdown drain took.", [({}, admission['last_drain_seconds'])])
+    if webhook_queue is not None:
+        try:
+            lines += stats_gauge('webhook_queue_depth', "Messages waiting in the webhook queue.", [({}, await webhook_queue.depth())])
+            lines += stats_gauge('webhook_queue_in_flight', "Leased messages being processed by the consumer.", [({}, webhook_queue_consumer.in_flight)])
+        except Exception as e:
+            logger.warning("Metrics - Could not read webhook queue depth: %s", e)
+    return func.HttpResponse(render_prometheus(lines), status_code=200, headers={"Content-Type": "text/plain; version=0.0.4"})
+
+async def webhook_processor(req_body, raise_errors=False, correlation_id=None) -> None:
+    """
+    Dispatches a webhook to its sub-handler. Errors are logged, and re-raised when
+    raise_errors is set so the queue consumer can retry the message.
+    """
+    correlation_id = set_correlation_id(correlation_id or get_correlation_id())
+    resource_type = req_body.get('ResourceType')
+    logger.info("Main Handler - Handling %s event.", resource_type)
+
+    if resource_type not in handler_registry:
+        logger.warning("Main Handler - Received unhandled event type: %s", resource_type)
         return
 
     # Execute the handler function associated with the resource type
     try:
-        logging.info("Main Handler - Trying to send webhook to associated sub-handler.")
-        handler_function = karbon_event_handlers[resource_type]
-        handler_function(req_body, karbon_bearer_token, karbon_access_key)
-        logging.info(f"Main Handler - {resource_type} event processed successfully.")
+        logger.debug("Main Handler - Trying to send webhook to associated sub-handler.")
+        handler_function = handler_registry.get(resource_type)
+        with span('process', resource_type=resource_type):
+            async with profiling.maybe_profile(resource_type, correlation_id):
+                if webhook_coalescer.applies_to(resource_type):
+                    key = (resource_type, req_body.get('ResourcePermaKey'))
+                    await webhook_coalescer.submit(key, req_body, functools.partial(run_handler, resource_type, handler_function))
+                else:
+                    await run_handler(resource_type, handler_function, req_body)
+        logger.info("Main Handler - %s event processed successfully.", resource_type)
     except Exception as e:
-        logging.error(f"Main Handler - Error processing the {resource_type} event: {str(e)}", exc_info=True)
\ No newline at end of file
+        logger.error("Main Handler - Error processing the %s event: %s", resource_type, e, exc_info=True)
+        if raise_errors:
+            raise
+
+async def run_handler(resource_type, handler_function, req_body) -> None:
+    # async handlers run on the loop, sync ones in the dispatcher's thread pool, both under the type's concurrency limit.
+    await handler_dispatcher.run(resource_type, handler_function, req_body, karbon_bearer_token, karbon_access_key)
+
+# Durable queue between the HTTP trigger and webhook_processor. None means webhooks are processed in-process.
+webhook_queue = create_webhook_queue()
+webhook_queue_consumer = WebhookQueueConsumer(
+    webhook_queue,
+    functools.partial(webhook_processor, raise_errors=True),
+    batch_size=config.webhook_queue_batch_size,
+    # a type at its handler cap keeps its leases while it waits, so leave every other type room to be leased past it.
+    max_in_flight=max(config.webhook_queue_max_in_flight, config.handler_max_concurrency + max(config.handler_concurrency_limits.values(), default=config.handler_default_concurrency_limit)),
+    visibility_timeout=config.webhook_queue_visibility_timeout,
+    poll_interval=config.webhook_queue_poll_interval
+) if webhook_queue is not None else None
\ No newline at end of file
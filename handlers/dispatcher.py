@@ -0,0 +1,154 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import config
+from utils.logging_config import setup_logging
+from utils.metrics import span
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class HandlerDispatcher:
+    """
+    Runs webhook handlers with a concurrency limit per resource type and a priority between types.
+
+    Handlers follow the protocol handler(data, karbon_bearer_token, karbon_access_key). Native
+    `async def` handlers run on the event loop; plain functions are treated as blocking legacy
+    handlers and run in a bounded thread pool, so they can't stall other events.
+
+    At most max_concurrency handlers run at once, and at most limits[resource_type] of one type.
+    When a slot frees up, waiting types are served in priority order (lower first), FIFO within a
+    type. Because every type is capped, a flood of one type can't take all the slots, and lower
+    priority types still make progress whenever max_concurrency exceeds the higher types' caps.
+
+    On the queue path this only covers messages the consumer has leased, so its max_in_flight has
+    to leave room above the largest per-type cap (see function_app). A flood longer than the
+    consumer's lease window is still served in queue order up to that point.
+    """
+
+    def __init__(self, max_concurrency=32, limits=None, priorities=None, default_limit=8, default_priority=10, thread_pool_size=4):
+        self.max_concurrency = max_concurrency
+        self.limits = limits or {}
+        self.priorities = priorities or {}
+        self.default_limit = default_limit
+        self.default_priority = default_priority
+        self.thread_pool_size = thread_pool_size
+        self._executor = None
+        self._waiting = {} # resource type -> deque of futures
+        self._in_flight = collections.Counter()
+        self._running = 0
+        self.stats = {} # resource type -> counters, see _stats_for
+
+    def limit_for(self, resource_type):
+        return self.limits.get(resource_type, self.default_limit)
+
+    def priority_for(self, resource_type):
+        return self.priorities.get(resource_type, self.default_priority)
+
+    def _stats_for(self, resource_type):
+        stats = self.stats.get(resource_type)
+        if stats is None:
+            stats = self.stats[resource_type] = {'completed': 0, 'failed': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+        return stats
+
+    def snapshot(self):
+        """Returns the waiting (queue depth) and in-flight counts, limit, priority and counters for every type seen."""
+        return {
+            resource_type: dict(
+                stats,
+                waiting=len(self._waiting.get(resource_type) or ()),
+                in_flight=self._in_flight[resource_type],
+                limit=self.limit_for(resource_type),
+                priority=self.priority_for(resource_type)
+            )
+            for resource_type, stats in self.stats.items()
+        }
+
+    def _can_start(self, resource_type):
+        return self._running < self.max_concurrency and self._in_flight[resource_type] < self.limit_for(resource_type)
+
+    def _start(self, resource_type):
+        self._running += 1
+        self._in_flight[resource_type] += 1
+
+    def _release(self, resource_type):
+        self._running -= 1
+        self._in_flight[resource_type] -= 1
+        self._wake()
+
+    def _wake(self):
+        for resource_type in sorted(self._waiting, key=self.priority_for):
+            waiters = self._waiting[resource_type]
+            while waiters and self._can_start(resource_type):
+                future = waiters.popleft()
+                if not future.done():
+                    self._start(resource_type)
+                    future.set_result(None)
+            if self._running >= self.max_concurrency:
+                return
+
+    async def _acquire(self, resource_type):
+        waiters = self._waiting.setdefault(resource_type, collections.deque())
+        if not waiters and self._can_start(resource_type):
+            self._start(resource_type)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just before the cancel landed; give it back.
+                self._release(resource_type)
+            elif future in waiters:
+                waiters.remove(future)
+            raise
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.thread_pool_size, thread_name_prefix='webhook-handler')
+        return self._executor
+
+    async def run(self, resource_type, handler, *args):
+        """Waits for a slot for resource_type, then runs handler(*args) and returns its result."""
+        stats = self._stats_for(resource_type)
+        started = time.perf_counter()
+        with span('handler_wait', resource_type=resource_type):
+            await self._acquire(resource_type)
+        waited = time.perf_counter() - started
+        stats['wait_seconds'] += waited
+        stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+
+        try:
+            if asyncio.iscoroutinefunction(handler):
+                result = await handler(*args)
+            else:
+                # copy the context so the correlation id follows the handler into the worker thread.
+                context = contextvars.copy_context()
+                result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), functools.partial(context.run, handler, *args))
+        except BaseException:
+            stats['failed'] += 1
+            raise
+        finally:
+            self._release(resource_type)
+        stats['completed'] += 1
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+handler_dispatcher = HandlerDispatcher(
+    max_concurrency=config.handler_max_concurrency,
+    limits=config.handler_concurrency_limits,
+    priorities=config.handler_priorities,
+    default_limit=config.handler_default_concurrency_limit,
+    thread_pool_size=config.handler_thread_pool_size
+)
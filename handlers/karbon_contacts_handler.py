@@ -1,8 +1,38 @@
 from utils.logging_config import setup_logging
+from services.entity_cache import entity_cache
+from services.karbon_models import Contact
+from services.karbon_services import Entities, CONTACT_FIELDS, CONTACT_EXPAND
+from utils.config import contact_directory_enabled
+from utils.contact_directory import get_contact_directory
 import logging
 
 # apply logging config file
 setup_logging()
+logger = logging.getLogger(__name__)
 
-def contacts_handler(data, karbon_bearer_token, karbon_access_key):
-    logging.info("Someone called the contacts handler, but it's not working yet.")
\ No newline at end of file
+async def contacts_handler(data, karbon_bearer_token, karbon_access_key):
+    contact_key = data.get('ResourcePermaKey')
+    action_type = data.get('ActionType')
+    logger.info("Contact %s webhook received for %s. Evicting cached entries.", action_type, contact_key)
+
+    # drop the contact itself and any cached organization that lists it.
+    evicted = entity_cache.invalidate('Contact', contact_key)
+    evicted += entity_cache.invalidate_where(
+        'Organization',
+        lambda organization: any(contact.get('ContactKey') == contact_key for contact in (organization or {}).get('Contacts') or [])
+    )
+    logger.info("Evicted %s cached entries for contact %s.", evicted, contact_key)
+
+    if not contact_directory_enabled:
+        return
+
+    # keep the contact directory current so NPS runs can resolve this contact without calling Karbon.
+    directory = get_contact_directory()
+    if action_type == 'Deleted':
+        await directory.remove(contact_key)
+        logger.info("Removed contact %s from the contact directory.", contact_key)
+        return
+
+    contact = Contact.from_json(await Entities(karbon_bearer_token,karbon_access_key).get_entity_by_key(contact_key,'Contact',CONTACT_EXPAND,use_cache=False,select=CONTACT_FIELDS))
+    await directory.upsert(contact)
+    logger.info("Updated contact %s in the contact directory.", contact_key)
@@ -1,8 +1,19 @@
-from utils.logging_config import setup_logging
+from utils.logging_config import setup_logging, get_correlation_id
+from utils import config
+from utils.event_log import get_event_log
 import logging
 
 # apply logging config file
 setup_logging()
+logger = logging.getLogger(__name__)
 
-def notes_handler(data, karbon_bearer_token, karbon_access_key):
-    logging.info("Someone called the notes handler, but it's not working yet.")
\ No newline at end of file
+async def notes_handler(data, karbon_bearer_token, karbon_access_key):
+    note_key = data.get('ResourcePermaKey')
+    if not config.event_log_enabled:
+        logger.info("Note %s webhook received for %s. The event log is disabled, so it isn't recorded.", data.get('ActionType'), note_key)
+        return
+
+    # Note events have no processing yet; keep them in the event log so they can be looked up later.
+    if 'Note' not in config.event_log_resource_types:
+        get_event_log().append(data, get_correlation_id())
+    logger.info("Note %s webhook for %s recorded in the event log.", data.get('ActionType'), note_key)
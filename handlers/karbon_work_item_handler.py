@@ -1,16 +1,20 @@
 import datetime
 from datetime import timezone, timedelta
-from services.karbon_services import Entities
-from helpers.send_contacts_to_asknicely import get_contact_information_and_send_surveys_to_asknicely as nps
+from services.karbon_models import WorkItem
+from services.karbon_services import Entities, WORK_ITEM_FIELDS
+from helpers.send_contacts_to_asknicely import get_contact_information_and_send_surveys_to_asknicely as nps, cancel_scheduled_surveys
 import logging
 import os
 # from dotenv import load_dotenv
 from utils.logging_config import setup_logging
+from utils.config import ask_nicely_minutes_delay, nps_eligible_work_types, nps_completion_window
+from utils.metrics import span
 
 # apply logging config file
 setup_logging()
+logger = logging.getLogger(__name__)
 
-def work_item_handler(data, karbon_bearer_token, karbon_access_key):
+async def work_item_handler(data, karbon_bearer_token, karbon_access_key):
 
     # logging.info('Attempt to load environment.')
     # # Load the correct environmental variables
@@ -22,53 +26,55 @@ def work_item_handler(data, karbon_bearer_token, karbon_access_key):
     entity_type = data['ResourceType']
 
     # get full work item details
-    logging.info('Requesting full Work Item from Karbon.')
-    work_item_details = Entities(karbon_bearer_token,karbon_access_key).get_entity_by_key(entity_key,entity_type)
+    logger.debug('Requesting full Work Item from Karbon.')
+    with span('work_item_fetch'):
+        work_item = WorkItem.from_json(await Entities(karbon_bearer_token,karbon_access_key).get_entity_by_key(entity_key,entity_type,select=WORK_ITEM_FIELDS))
 
     # Check if the work item is eligible for net promoter score (nps) and send it along if so.
-    work_item_status = work_item_details['PrimaryStatus']
-    work_item_type = work_item_details['WorkType']
-    eligible_work_types = [
-        'Tax: Processing',
-        'Internal'
-    ]
-    logging.info('Checking if work item is eligible for Net Promoter Score (NPS)')
-    if work_item_status == 'Completed' and work_item_type in eligible_work_types:
-        # Parse the CompletedDate to datetime object and set it to UTC timezone and compare to 
-        completed_datetime = work_item_details['CompletedDate'] # get completed datetime from work item.
-        completed_datetime = datetime.datetime.strptime(completed_datetime, '%Y-%m-%dT%H:%M:%SZ') # format time for comparison.
-        completed_datetime = completed_datetime.replace(tzinfo=timezone.utc) # set completed time to UTC.
+    work_item_status = work_item.primary_status
+    work_item_type = work_item.work_type
+    logger.debug('Checking if work item is eligible for Net Promoter Score (NPS)')
+    if work_item_status == 'Completed' and work_item_type in nps_eligible_work_types:
+        # CompletedDate is parsed to a UTC datetime by the model, compare it to now.
+        completed_datetime = work_item.completed_date # get completed datetime from work item.
         current_datetime = datetime.datetime.now(timezone.utc) # Get the current datetime in UTC.
         time_difference = current_datetime - completed_datetime # Calculate the time difference between completed datetime and now.
 
-        # Check if the work item was completed within the last hour
+        # Check if the work item was completed within the last hour (nps_completion_window)
             # This avoids situations where work items are updated after they are completed.
             # Such situations will fail this test and won't be sent for NPS.
-        logging.info('Check to see if work item was completed recently.')
-        if time_difference <= timedelta(hours=1):
+        logger.debug('Check to see if work item was completed recently.')
+        if time_difference <= timedelta(seconds=nps_completion_window):
             # get asknicely api key
             try:
-                logging.info('Try to get AskNicely api key from environmental variables.')
+                logger.debug('Try to get AskNicely api key from environmental variables.')
                 asknicely_api_key = os.getenv('ASKNICELY_API_KEY')
             except:
-                logging.error('Could not load AskNicely API key.')
+                logger.error('Could not load AskNicely API key.')
 
             # send information to asknicely.
-            logging.info('Attempting to send NPS survye trigger to AskNicely.')
-            nps(karbon_bearer_token,karbon_access_key,work_item_details,asknicely_api_key)
+            logger.debug('Attempting to send NPS survye trigger to AskNicely.')
+            with span('nps_run'):
+                await nps(karbon_bearer_token,karbon_access_key,work_item,asknicely_api_key)
         
         else:
-            logging.info(f"Not eligible for NPS because work item was completed {time_difference} hours ago. Must be within 1 hour.")
+            logger.info("Not eligible for NPS because work item was completed %s hours ago. Must be within %s seconds.", time_difference, nps_completion_window)
     else:
-        logging.info(f"Work Item not eligible for NPS. Work Item status: {work_item_status}")
+        logger.info("Work Item not eligible for NPS. Work Item status: %s", work_item_status)
+        # a work item reopened before its delayed surveys went out shouldn't send them.
+        if work_item_status != 'Completed' and ask_nicely_minutes_delay > 0:
+            cancelled = await cancel_scheduled_surveys(work_item.work_item_key)
+            if cancelled:
+                logger.info("Cancelled %s scheduled NPS surveys because work item %s is %s again.", cancelled, work_item.work_item_key, work_item_status)
 
 # use for testing
 if __name__ == "__main__":
     
     # imports for test
     import os
+    import asyncio
     from dotenv import load_dotenv
-    import json
+    from services.http_session import close_session
 
     # Load the correct environmental variables
     env = os.environ.get('ENVIRONMENT', 'test')
@@ -88,4 +94,10 @@ if __name__ == "__main__":
         "ActionType": "Updated"
     }
 
-    work_item_handler(webhook_data,karbon_bearer_token,karbon_access_key,asknicely_api_key)
\ No newline at end of file
+    async def main():
+        try:
+            await work_item_handler(webhook_data,karbon_bearer_token,karbon_access_key)
+        finally:
+            await close_session()
+
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,75 @@
+import importlib
+import logging
+import threading
+import time
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Karbon resource types and the 'module:function' of the handler for each.
+# Handler modules pull in the HTTP clients, so they are only imported when first needed.
+KARBON_EVENT_HANDLERS = {
+    'WorkItem': 'handlers.karbon_work_item_handler:work_item_handler',
+    'Contact': 'handlers.karbon_contacts_handler:contacts_handler',
+    'Note': 'handlers.karbon_notes_handler:notes_handler'
+}
+
+class HandlerRegistry:
+    """
+    Maps ResourceType to its handler function, importing the handler's module on first use.
+
+    Resolved handlers are kept for the life of the process. import_seconds records how long
+    each first import took, so cold-start cost can be checked in the logs.
+    """
+
+    def __init__(self, handlers):
+        self._paths = dict(handlers)
+        self._loaded = {}
+        self._lock = threading.Lock()
+        self.import_seconds = {}
+
+    def __contains__(self, resource_type):
+        return resource_type in self._paths
+
+    @property
+    def resource_types(self):
+        return tuple(self._paths)
+
+    def register(self, resource_type, path):
+        """Adds or replaces the handler for resource_type, given as 'module:function'."""
+        with self._lock:
+            self._paths[resource_type] = path
+            self._loaded.pop(resource_type, None)
+
+    def get(self, resource_type):
+        """Returns the handler for resource_type. Raises KeyError for unregistered types."""
+        handler = self._loaded.get(resource_type)
+        if handler is None:
+            handler = self._load(resource_type)
+        return handler
+
+    def _load(self, resource_type):
+        with self._lock:
+            handler = self._loaded.get(resource_type)
+            if handler is not None:
+                return handler
+            module_name, _, function_name = self._paths[resource_type].partition(':')
+            started = time.perf_counter()
+            handler = getattr(importlib.import_module(module_name), function_name)
+            self.import_seconds[resource_type] = time.perf_counter() - started
+            self._loaded[resource_type] = handler
+        logger.info("Handler registry - Loaded %s handler in %.3fs.", resource_type, self.import_seconds[resource_type])
+        return handler
+
+    def prewarm(self, resource_types=None):
+        """Imports the handlers for resource_types (default all). Unknown types are skipped with a warning."""
+        for resource_type in resource_types or self._paths:
+            if resource_type not in self._paths:
+                logger.warning("Handler registry - Cannot pre-warm unknown resource type %s.", resource_type)
+                continue
+            self.get(resource_type)
+        return dict(self.import_seconds)
+
+handler_registry = HandlerRegistry(KARBON_EVENT_HANDLERS)
@@ -0,0 +1,122 @@
+import asyncio
+import datetime
+from datetime import timezone, timedelta
+from helpers.send_contacts_to_asknicely import get_contact_information_and_send_surveys_to_asknicely as nps
+from services.karbon_models import WorkItem
+from services.karbon_services import Entities, WORK_ITEM_FIELDS
+from utils.checkpoints import get_checkpoint_store
+from utils.config import nps_eligible_work_types, nps_completion_window, reconciliation_overlap, reconciliation_page_size, reconciliation_concurrency
+from utils.logging_config import setup_logging
+from utils.metrics import span
+import logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = 'work_item_reconciliation'
+
+# Totals across sweeps, reported on the metrics route.
+reconciliation_stats = {'sweeps': 0, 'listed': 0, 'eligible': 0, 'failed': 0}
+
+def odata_datetime(moment):
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def completed_work_items_filter(since, work_types):
+    """Builds the OData $filter for work items of work_types completed at or after since."""
+    quoted_types = ' or '.join("WorkType eq '%s'" % work_type.replace("'", "''") for work_type in work_types)
+    return f"PrimaryStatus eq 'Completed' and CompletedDate ge {odata_datetime(since)} and ({quoted_types})"
+
+def is_eligible(work_item, window_start):
+    # Karbon applies the filter, but check again so a partly honoured filter can't send surveys early or late.
+    if work_item.primary_status != 'Completed' or work_item.work_type not in nps_eligible_work_types:
+        return False
+    completed_date = work_item.completed_date
+    return completed_date is not None and completed_date >= window_start
+
+async def reconcile_completed_work_items(karbon_bearer_token, karbon_access_key, asknicely_api_key, now=None):
+    """
+    Sends NPS surveys for eligible work items completed since the last sweep, whether or not their webhook arrived.
+
+    Lists completed work items of the eligible types with one filtered, paged query, starting at
+    the stored high-water mark (less reconciliation_overlap seconds, for late writes) but never
+    earlier than the NPS completion window. Each match goes through the NPS helper, whose
+    idempotency ledger skips work items a webhook already handled.
+
+    The high-water mark only moves forward once every match was handled, so a failed sweep is
+    retried by the next one.
+
+    The ledger is a local SQLite file, so this is only safe when the webhooks are handled against
+    the same ledger as the sweep; see RECONCILIATION_ENABLED in utils/config.py. It's off by default.
+
+    Returns:
+        dict: Counts of listed, eligible and failed work items, and the start of the swept window.
+    """
+    now = now or datetime.datetime.now(timezone.utc)
+    window_start = now - timedelta(seconds=nps_completion_window)
+    store = get_checkpoint_store()
+    high_water = await store.get(CHECKPOINT)
+    since = window_start
+    if high_water is not None:
+        since = max(window_start, datetime.datetime.fromtimestamp(high_water - reconciliation_overlap, timezone.utc))
+
+    parameters = {'$filter': completed_work_items_filter(since, nps_eligible_work_types), '$orderby': 'CompletedDate'}
+    logger.info("Reconciliation - Listing work items completed since %s.", odata_datetime(since))
+
+    summary = {'listed': 0, 'eligible': 0, 'failed': 0, 'since': odata_datetime(since)}
+    semaphore = asyncio.Semaphore(max(1, reconciliation_concurrency))
+
+    async def send(work_item):
+        try:
+            with span('nps_run'):
+                # raises when any contact failed, after recording the ones that were sent.
+                await nps(karbon_bearer_token, karbon_access_key, work_item, asknicely_api_key)
+        except Exception as e:
+            summary['failed'] += 1
+            logger.error("Reconciliation - Could not send NPS surveys for work item %s: %s", work_item.work_item_key, e, exc_info=True)
+        finally:
+            semaphore.release()
+
+    tasks = []
+    try:
+        async for payload in Entities(karbon_bearer_token, karbon_access_key).iter_collection('WorkItems', parameters, select=WORK_ITEM_FIELDS, page_size=reconciliation_page_size):
+            summary['listed'] += 1
+            work_item = WorkItem.from_json(payload)
+            if not is_eligible(work_item, window_start):
+                continue
+            summary['eligible'] += 1
+            # the listed fields are all the NPS helper needs, so there's no per work item GET.
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(send(work_item)))
+    finally:
+        await asyncio.gather(*tasks)
+        reconciliation_stats['sweeps'] += 1
+        for counter in ('listed', 'eligible', 'failed'):
+            reconciliation_stats[counter] += summary[counter]
+
+    if summary['failed']:
+        logger.warning("Reconciliation - %s work items failed. Keeping the high-water mark so the next sweep retries them.", summary['failed'])
+    else:
+        await store.set(CHECKPOINT, now.timestamp())
+    logger.info("Reconciliation - Listed: %s | Eligible: %s | Failed: %s", summary['listed'], summary['eligible'], summary['failed'])
+    return summary
+
+# use for testing
+if __name__ == "__main__":
+
+    # imports for test
+    import os
+    from dotenv import load_dotenv
+    from services.http_session import close_session
+
+    # Load the correct environmental variables
+    env = os.environ.get('ENVIRONMENT', 'test')
+    load_dotenv(dotenv_path=f".env.{env}")
+
+    async def main():
+        try:
+            print(await reconcile_completed_work_items(os.getenv('KARBON_BEARER_TOKEN'), os.getenv('KARBON_ACCESS_KEY'), os.getenv('ASKNICELY_API_KEY')))
+        finally:
+            await close_session()
+
+    asyncio.run(main())
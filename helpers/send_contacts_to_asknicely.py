@@ -1,170 +1,410 @@
-from services.karbon_services import Notes, Entities
+from services.karbon_models import Contact, ContactRef
+from services.karbon_services import Notes, Entities, ORGANIZATION_CONTACT_FIELDS, CONTACT_FIELDS, CONTACT_EXPAND
 from services.asknicely_services import AskNicelyAPI
+from services.resilience import CircuitOpenError, SAFE_RETRY_STATUSES
+import asyncio
 import datetime
 import logging
+import os
+import time
+from utils.config import ask_nicely_minutes_delay, webhook_queue_backend, nps_max_concurrency, nps_note_mode, nps_contact_page_size, contact_directory_enabled
+from utils.contact_directory import get_contact_directory
+from utils.idempotency import get_idempotency_ledger
 from utils.logging_config import setup_logging
+from utils.metrics import span
+from utils.scheduler import ActionFailed, get_action_scheduler
 
 # apply logging config file
 setup_logging()
+logger = logging.getLogger(__name__)
 
 # get client details from work key 
-def get_contact_information_and_send_surveys_to_asknicely(karbon_bearer_token, karbon_access_key, work_item_details, asknicely_api_key):
+async def get_contact_information_and_send_surveys_to_asknicely(karbon_bearer_token, karbon_access_key, work_item, asknicely_api_key, max_concurrency=None, note_mode=None):
+    """
+    Sends NPS survey triggers to every contact attached to a completed work item's client.
 
-    logging.info('Received request to send contact information to AskNicely.')
+    An organization's contacts are streamed from Karbon a page at a time and handled as they
+    arrive, with at most max_concurrency in flight at once (defaults to utils.config.nps_max_concurrency).
+    Pass max_concurrency=1 to handle them one at a time.
 
-    client_key = work_item_details['ClientKey']
-    client_type = work_item_details['ClientType']
-    client_name = work_item_details['ClientName']
+    note_mode (defaults to utils.config.nps_note_mode) controls the Karbon timeline notes:
+    'aggregate' writes one summary note per work item, 'per_contact' writes a note per contact.
+
+    Every side effect is recorded in the idempotency ledger first, so repeated webhooks for a
+    work item that was already handled end after a single local lookup.
+
+    Returns:
+        list: One summary dict per contact (see send_survey_to_contact), or None if the client type isn't supported.
+
+    Raises:
+        RuntimeError: after the notes are written, if any contact failed, so the webhook queue
+            redelivers the work item. The ledger skips the contacts that were already sent.
+    """
+
+    logger.info('Received request to send contact information to AskNicely.')
+
+    client_key = work_item.client_key
+    client_type = work_item.client_type
+    client_name = work_item.client_name
+    work_item_key = work_item.work_item_key
+
+    ledger = get_idempotency_ledger()
+    if await ledger.has(work_item_key, None, 'nps_run'):
+        logger.info("NPS surveys were already handled for work item %s. Skipping.", work_item_key)
+        return []
 
     # handle organziation-type clients.
-    logging.info(f"Checking client type and handling appropriately. Client: {client_name} | Client Type: {client_type} | Key: {client_key}")
+    logger.debug("Checking client type and handling appropriately. Client: %s | Client Type: %s | Key: %s", client_name, client_type, client_key)
     if client_type == 'Organization':
-        logging.info("Client is an org.")
-        # get contacts associated with the work item's organizaiton
-        params = {'$expand': 'Contacts'}
-        logging.info(f"Requesting full org details from Karbon.")
-        organization_details = Entities(karbon_bearer_token,karbon_access_key).get_entity_by_key(client_key,client_type,params)
-
-        # pull out contacts information.
-        logging.info("Found contacts attached to Org.")
-        contacts = organization_details['Contacts']
-
-        # Check to see if there are contacts associated. If not, add a note to Karbon.
-        logging.info("Checking for contacts information attached to the Org.")
-        if not contacts:
-            logging.info("Cannot find any contact information.")
-            note_subject = 'OH NO! No people connected to this organization'
-            note_body = f"I tried to send out some NPS surveys because we just finished up the {work_item_details['Title']} for {work_item_details['ClientName']}, but I couldn't find any people attached to this organization. Please take care of this right away so I can send out NPS surveys in the future."
-            timelines = [
-                {'EntityType': 'WorkItem','EntityKey': work_item_details['WorkItemKey']},
-                {'EntityType': work_item_details['ClientType'],'EntityKey': work_item_details['ClientKey']}
-            ]
-            
-            assignee = work_item_details['AssigneeEmailAddress']
-
-            logging.info("Adding note to the client and work item timelines.")
-            Notes(karbon_bearer_token,karbon_access_key).add_note(note_subject,note_body,timelines,assignee)
+        logger.debug("Client is an org.")
+        # stream the contacts associated with the work item's organizaiton, only the fields used here.
+        logger.debug("Requesting the org's contacts from Karbon.")
+        contacts = contact_refs(Entities(karbon_bearer_token,karbon_access_key).iter_expanded(client_key, client_type, 'Contacts', select=ORGANIZATION_CONTACT_FIELDS, page_size=nps_contact_page_size))
 
     elif client_type == 'Contact':
-        logging.info("Client is a contact.")
-        contacts = [{'ContactKey': client_key, 'FullName': client_name}]
+        logger.debug("Client is a contact.")
+        contacts = iterate([ContactRef(client_key, client_name)])
 
     else:
-        logging.info("Client is neither an org or a contact. Ending process.")
+        logger.info("Client is neither an org or a contact. Ending process.")
         return None
-    
-    
-
-    # cycle throhgh each contact to get their business cards
-    logging.info("Cycling through to find names and email addresses for AskNicely.")
-    for contact in contacts:
-        params = {'$expand': 'BusinessCards'}
-        # get contact details for this contact.
-        contact_key = contact['ContactKey']
-        contact_name = contact['FullName']
-        logging.info(f"Request contact details for contact. Name: {contact_name} | Key: {contact_key}")
-        contact_details = Entities(karbon_bearer_token,karbon_access_key).get_entity_by_key(contact_key,'Contact',params)
-
-        # build list for asknicely
-        ## first name
-        logging.info("Checking for preferred name.")
-        if contact_details['PreferredName'] not in ("", None):
-            logging.info("Preferred name exists. Setting it as first name.")
-            first_name = contact_details['PreferredName']
-        else:
-            logging.info("No preferred name set. Setting 'FirstName' to 'fist_name'.")
-            first_name = contact_details['FirstName']
-        ## last name
-        last_name = contact_details['LastName']
-
-        # search business cards for an appropriate email address.
-        business_cards = contact_details['BusinessCards']
-        logging.info("Looking up business cards for contact.")
-        email = get_email_from_business_cards(business_cards,client_key)
-        
+
+    # fan out over the contacts as they arrive, capping how many are in flight at once.
+    if max_concurrency is None:
+        max_concurrency = nps_max_concurrency
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    note_mode = note_mode or nps_note_mode
+    per_contact_notes = note_mode == 'per_contact'
+
+    async def bounded_send(contact):
+        try:
+            with span('contact_survey') as timing:
+                result = await send_survey_to_contact(karbon_bearer_token, karbon_access_key, work_item, asknicely_api_key, contact, per_contact_notes)
+                timing.set(outcome=result['Status'])
+            return result
+        finally:
+            semaphore.release()
+
+    logger.info("Cycling through contacts to find names and email addresses for AskNicely. Max concurrency: %s", max_concurrency)
+    tasks = []
+    try:
+        async for contact in contacts:
+            # wait for a free slot before taking the next contact, so paging never runs far ahead of the sends.
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(bounded_send(contact)))
+    finally:
+        # contacts already started finish (and stay in the ledger) even if listing fails part way.
+        results = list(await asyncio.gather(*tasks))
+
+    # Check to see if there are contacts associated. If not, add a note to Karbon.
+    logger.debug("Checking for contacts information attached to the Org.")
+    if client_type == 'Organization' and not results:
+        await add_note_for_missing_contacts(karbon_bearer_token, karbon_access_key, work_item)
+
+    sent = sum(1 for result in results if result['Status'] == 'sent')
+    scheduled = sum(1 for result in results if result['Status'] == 'scheduled')
+    logger.info("Finished sending NPS surveys for %s. Sent: %s | Scheduled: %s | Contacts: %s", client_name, sent, scheduled, len(results))
+
+    if not per_contact_notes:
+        await add_nps_summary_note(karbon_bearer_token, karbon_access_key, work_item, results)
+
+    # only mark the whole work item as done once no contact needs a retry, and fail so the queue redelivers it.
+    failed = sum(1 for result in results if result['Status'] == 'failed')
+    if failed:
+        raise RuntimeError(f"NPS surveys failed for {failed} of {len(results)} contacts on work item {work_item_key}.")
+    await ledger.claim(work_item_key, None, 'nps_run')
+    return results
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+async def contact_refs(payloads):
+    # keep only the key and name of each listed contact, so the page can be freed.
+    async for payload in payloads:
+        yield ContactRef.from_json(payload)
+
+async def add_note_for_missing_contacts(karbon_bearer_token, karbon_access_key, work_item) -> None:
+    """Asks the work item's assignee, once per work item, to attach people to an organization that has none."""
+    logger.info("Cannot find any contact information.")
+    client_key = work_item.client_key
+    work_item_key = work_item.work_item_key
+    note_subject = 'OH NO! No people connected to this organization'
+    note_body = f"I tried to send out some NPS surveys because we just finished up the {work_item.title} for {work_item.client_name}, but I couldn't find any people attached to this organization. Please take care of this right away so I can send out NPS surveys in the future."
+    timelines = [
+        {'EntityType': 'WorkItem','EntityKey': work_item_key},
+        {'EntityType': work_item.client_type,'EntityKey': client_key}
+    ]
+
+    assignee = work_item.assignee_email_address
+
+    ledger = get_idempotency_ledger()
+    if await ledger.claim(work_item_key, client_key, 'no_contacts_note'):
+        logger.debug("Adding note to the client and work item timelines.")
+        try:
+            await Notes(karbon_bearer_token,karbon_access_key).add_note(note_subject,note_body,timelines,assignee)
+        except Exception:
+            await ledger.release(work_item_key, client_key, 'no_contacts_note')
+            raise
+
+async def send_survey_to_contact(karbon_bearer_token, karbon_access_key, work_item, asknicely_api_key, contact, write_notes=True):
+    """
+    Looks up a single contact, sends their NPS survey trigger and records it on the timelines.
+    When ask_nicely_minutes_delay is set, the trigger (and its note) is handed to the action
+    scheduler instead and goes out once the delay is up, unless cancelled first.
+
+    Errors are caught and reported in the returned summary so one contact can't stop the others.
+    Contacts whose survey is already in the idempotency ledger are skipped.
+    With write_notes=False no timeline notes are added; the caller summarises the results instead.
+
+    Returns:
+        dict: ContactKey, FullName, Status ('sent', 'scheduled', 'missing_email', 'duplicate' or 'failed') and Error.
+    """
+    contact_key = contact.contact_key
+    contact_name = contact.full_name
+    result = {'ContactKey': contact_key, 'FullName': contact_name, 'Status': None, 'Error': None}
+    client_key = work_item.client_key
+    client_name = work_item.client_name
+    work_item_key = work_item.work_item_key
+    ledger = get_idempotency_ledger()
+
+    try:
+        if await ledger.has(work_item_key, contact_key, 'survey'):
+            logger.info("NPS survey already sent for this work item. Name: %s | Key: %s", contact_name, contact_key)
+            result['Status'] = 'duplicate'
+            return result
+
+        # get the contact's name and best email address for this client.
+        first_name, last_name, email = await get_contact_name_and_email(karbon_bearer_token, karbon_access_key, contact_key, contact_name, client_key)
+
         # set timelines for future use.
         timelines = [
-            {'EntityType': 'WorkItem','EntityKey': work_item_details['WorkItemKey']},
-            {'EntityType': work_item_details['ClientType'],'EntityKey': work_item_details['ClientKey']},
-            {'EntityType': 'Contact','EntityKey': contact['ContactKey']}
+            {'EntityType': 'WorkItem','EntityKey': work_item.work_item_key},
+            {'EntityType': work_item.client_type,'EntityKey': work_item.client_key},
+            {'EntityType': 'Contact','EntityKey': contact_key}
         ]
 
         # if no email exists, add a note to the appropriate timelines.
-        logging.info("Check if email exists.")
+        logger.debug("Check if email exists.")
         if not email:
-            logging.info("No email exists.")
-            note_body = f"I tried to send an NPS survey to {contact['FullName']} after we finished their {work_item_details['Title']}, but I cannot locate an email address. Pleaes take care of this right away so I can send out their NPS survey."
+            logger.debug("No email exists.")
+            note_body = f"I tried to send an NPS survey to {contact_name} after we finished their {work_item.title}, but I cannot locate an email address. Pleaes take care of this right away so I can send out their NPS survey."
+
+            result['Status'] = 'missing_email'
+            if not write_notes:
+                return result
+            if not await ledger.claim(work_item_key, contact_key, 'missing_email_note'):
+                logger.info("Already asked for updated contact information on this work item.")
+                return result
+
+            logger.debug("Adding note to appropriate timelines asking for updated contact information.")
+            assignee = work_item.assignee_email_address
+            try:
+                await add_note_for_missing_contact_information(karbon_bearer_token,karbon_access_key,assignee,timelines,note_body)
+            except Exception:
+                await ledger.release(work_item_key, contact_key, 'missing_email_note')
+                raise
+            return result
+
+        # claim the survey before sending so a concurrent duplicate webhook can't send it too.
+        if not await ledger.claim(work_item_key, contact_key, 'survey'):
+            result['Status'] = 'duplicate'
+            return result
+
+        survey = {
+            'first_name': first_name,
+            'last_name': last_name,
+            'email_address': email,
+            'contact_name': work_item.client_name,
+            'contact_key': work_item.client_key,
+            'contact_type': work_item.client_type,
+            'work_item_name': work_item.title,
+            'work_item_key': work_item.work_item_key,
+            'work_type': work_item.work_type
+        }
+        note_subject = "FYI: Sent NPS survey"
+        note_body = f"I sent an NPS survey to {contact_name} after we completed '{work_item.title}' for '{client_name}'."
 
-            logging.info("Adding note to appropriate timelines asking for updated contact information.")
-            assignee = work_item_details['AssigneeEmailAddress']
-            add_note_for_missing_contact_information(karbon_bearer_token,karbon_access_key,assignee,timelines,note_body)
-            # stopping the loop as no emails where found for this contact.
-            break
+        if ask_nicely_minutes_delay > 0:
+            # hold the survey locally so it can still be cancelled, e.g. if the work item is reopened.
+            note = {'Subject': note_subject, 'Body': note_body, 'Timelines': timelines} if write_notes else None
+            try:
+                await schedule_survey(survey, note, contact_key)
+            except Exception:
+                await ledger.release(work_item_key, contact_key, 'survey')
+                raise
+            result['Status'] = 'scheduled'
+            return result
 
         # send survey survye trigger to asknicely
-        logging.info("Send request to AskNicely to trigger NPS survey.")
-        AskNicelyAPI(asknicely_api_key).send_business_card(
-            first_name,last_name,email,
-            work_item_details['ClientName'],
-            work_item_details['ClientKey'],
-            work_item_details['ClientType'],
-            work_item_details['Title'],
-            work_item_details['WorkItemKey'],
-            work_item_details['WorkType']
-        )
+        logger.debug("Send request to AskNicely to trigger NPS survey.")
+        try:
+            status_code, text = await AskNicelyAPI(asknicely_api_key).send_business_card(**survey)
+        except Exception:
+            await ledger.release(work_item_key, contact_key, 'survey')
+            raise
+        if status_code != 201:
+            await ledger.release(work_item_key, contact_key, 'survey')
+            result['Status'] = 'failed'
+            result['Error'] = f"AskNicely returned {status_code}: {text}"
+            return result
 
         # add note to appropriate timelines about the NPS survey.
-        logging.info("Sending request to Karbon to add not to timelines.")
-        note_subject = "FYI: Sent NPS survey"
-        note_body = f"I sent an NPS survey to {contact_name} after we completed '{work_item_details['Title']}' for '{client_name}'."
-        Notes(karbon_bearer_token,karbon_access_key).add_note(note_subject,note_body,timelines)
-        logging.info("Added note in Karbon.")
+        logger.debug("Sending request to Karbon to add not to timelines.")
+        result['Status'] = 'sent'
+        if not write_notes:
+            return result
+        try:
+            await Notes(karbon_bearer_token,karbon_access_key).add_note(note_subject,note_body,timelines)
+            logger.debug("Added note in Karbon.")
+        except Exception as e:
+            # the survey went out, so keep it claimed and don't let a retry send it again.
+            logger.error("Sent NPS survey but could not add the note. Name: %s | Key: %s | Error: %s", contact_name, contact_key, e)
+            result['Error'] = f"Note not added: {e}"
+
+    except Exception as e:
+        logger.error("Failed to send NPS survey to contact. Name: %s | Key: %s | Error: %s", contact_name, contact_key, e, exc_info=True)
+        result['Status'] = 'failed'
+        result['Error'] = str(e)
+
+    return result
+
+async def schedule_survey(survey, note, contact_key):
+    """Stores a survey trigger (the send_business_card arguments) to go out after ask_nicely_minutes_delay, with an optional note."""
+    scheduler = get_action_scheduler()
+    due_at = time.time() + ask_nicely_minutes_delay * 60
+    await scheduler.schedule('asknicely_survey', {'Survey': survey, 'Note': note}, due_at, survey['work_item_key'], contact_key)
+    scheduler.ensure_started()
+    logger.info("Scheduled NPS survey for contact %s on work item %s in %s minutes.", contact_key, survey['work_item_key'], ask_nicely_minutes_delay)
+
+async def fire_scheduled_survey(payload):
+    """
+    Scheduler executor for 'asknicely_survey'. Only failures that show AskNicely never took the
+    trigger (an open circuit, 429 or 503) are raised for the scheduler to retry. Anything else may
+    already have sent the survey, so it raises ActionFailed and is dead-lettered instead.
+    """
+    survey = payload['Survey']
+    try:
+        status_code, text = await AskNicelyAPI(os.getenv('ASKNICELY_API_KEY')).send_business_card(**survey)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        raise ActionFailed(f"AskNicely request failed: {e}") from e
+    if status_code in SAFE_RETRY_STATUSES:
+        raise RuntimeError(f"AskNicely returned {status_code}")
+    if status_code != 201:
+        raise ActionFailed(f"AskNicely returned {status_code}: {text}")
+
+    # the survey is out, so nothing from here on may fail this action and send it again.
+    if payload.get('Note'):
+        try:
+            await get_action_scheduler().schedule('karbon_note', payload['Note'], time.time(), survey['work_item_key'])
+        except Exception as e:
+            logger.error("Could not schedule the NPS note for work item %s: %s", survey['work_item_key'], e)
+
+async def fire_scheduled_note(payload):
+    """Scheduler executor for 'karbon_note'."""
+    await Notes(os.getenv('KARBON_BEARER_TOKEN'), os.getenv('KARBON_ACCESS_KEY')).add_note(payload['Subject'], payload['Body'], payload['Timelines'])
+
+async def survey_dead_lettered(action, error):
+    """
+    Scheduler dead-letter handler for 'asknicely_survey'. Notes on the timelines that the survey
+    didn't go out as planned, since the summary note already said it was going to.
+
+    Only when retries ran out on failures that show AskNicely never took the trigger (an open
+    circuit, 429 or 503) are the survey's ledger claims released, so the next NPS run for the work
+    item sends it again. An ActionFailed may already have sent it, so its claims are kept and the
+    note asks for it to be checked in AskNicely before it's resent.
+    """
+    survey = action.payload['Survey']
+    contact_name = ' '.join(filter(None, (survey['first_name'], survey['last_name'])))
+    if isinstance(error, ActionFailed):
+        subject = "Action needed: NPS survey may not have been sent"
+        note_body = f"The NPS survey to {contact_name} after we completed '{survey['work_item_name']}' for '{survey['contact_name']}' may not have gone out ({error}). Please check AskNicely before resending it."
+    else:
+        ledger = get_idempotency_ledger()
+        await ledger.release(action.work_item_key, action.contact_key, 'survey')
+        await ledger.release(action.work_item_key, None, 'nps_run')
+        subject = "Action needed: NPS survey not sent"
+        note_body = f"I couldn't send the NPS survey to {contact_name} after we completed '{survey['work_item_name']}' for '{survey['contact_name']}' ({error}). Please send it from AskNicely."
+
+    timelines = [
+        {'EntityType': 'WorkItem','EntityKey': action.work_item_key},
+        {'EntityType': survey['contact_type'],'EntityKey': survey['contact_key']}
+    ]
+    await Notes(os.getenv('KARBON_BEARER_TOKEN'), os.getenv('KARBON_ACCESS_KEY')).add_note(subject, note_body, timelines)
+
+async def cancel_scheduled_surveys(work_item_key):
+    """
+    Cancels a work item's survey triggers that haven't gone out yet, e.g. because it was reopened,
+    and releases their ledger entries so the surveys are sent if it's completed again. Triggers the
+    scheduler has already leased aren't cancelled, and their claims are kept.
+
+    Returns:
+        int: The number of surveys cancelled.
+    """
+    cancelled = await get_action_scheduler().cancel(work_item_key, 'asknicely_survey')
+    if cancelled:
+        ledger = get_idempotency_ledger()
+        for _, contact_key in cancelled:
+            await ledger.release(work_item_key, contact_key, 'survey')
+        await ledger.release(work_item_key, None, 'nps_run')
+        logger.info("Cancelled %s scheduled NPS surveys for work item %s.", len(cancelled), work_item_key)
+    return len(cancelled)
+
+async def get_contact_name_and_email(karbon_bearer_token, karbon_access_key, contact_key, contact_name, client_key):
+    """
+    Returns (first name, last name, email) for a contact, email being None if they have none.
+
+    The local contact directory answers without calling Karbon. On a miss the contact is
+    fetched with its business cards and written to the directory for next time.
+    """
+    directory = get_contact_directory() if contact_directory_enabled else None
+    if directory is not None:
+        entry = await directory.lookup(contact_key, client_key)
+        if entry is not None:
+            logger.debug("Found contact in the local directory. Name: %s | Key: %s", contact_name, contact_key)
+            return entry['FirstName'], entry['LastName'], entry['Email']
+
+    # get contact details for this contact.
+    logger.debug("Request contact details for contact. Name: %s | Key: %s", contact_name, contact_key)
+    with span('contact_fetch'):
+        contact = Contact.from_json(await Entities(karbon_bearer_token,karbon_access_key).get_entity_by_key(contact_key,'Contact',CONTACT_EXPAND,select=CONTACT_FIELDS))
+    if directory is not None:
+        await directory.upsert(contact)
+
+    # search business cards for an appropriate email address. The model already prefers PreferredName as the first name.
+    logger.debug("Looking up business cards for contact.")
+    email = get_email_from_business_cards(contact.business_cards,client_key)
+    return contact.first_name, contact.last_name, email
 
 def get_email_from_business_cards(business_cards, client_key):
+    """
+    Picks a contact's email in one pass over their BusinessCard models: the email on the client
+    organization's card, else the primary card's, else the first email on any card, else None.
+    """
     primary_email = None
-
-    # Cycle through each business card once to find the right email
-    logging.info("Cycle through business cards to find email addresses.")
+    first_email = None
     for business_card in business_cards:
-        # Extract emails from the current business card
-        emails = business_card.get('EmailAddresses')
-        logging.info("Check if emails exist.")
-        if not emails:
-            logging.info("No emails on business card.")
+        email = business_card.email
+        if not email:
             continue  # Skip if no emails
-        
-        # Check if the business card matches the organization key
-        logging.info("Pick up the email from the business card from the organization where the work happened.")
-        if business_card.get('OrganizationKey') == client_key:
-            email = emails[0]
-            logging.info(f"First email attached to organization business card: {email}")
-            return email  # Return the first email if it matches the client key
-        
-        # Check if the card is primary; save the email to return later if no better match is found
-        logging.info("Pick up email address from primary card.")
-        if business_card.get('IsPrimaryCard'):
-            primary_email = emails[0]
-            logging.info(f"Primary email address: {primary_email}")
-    
-    # Return the primary email if no organization-specific email was found
-    if primary_email:
-        logging.info("Returned primary email.")
-        return primary_email
-
-    # As a last resort, return the first email found on any card
-    logging.info("Couldn't find email address on primary or organization business card.")
-    for business_card in business_cards:
-        emails = business_card.get('EmailAddresses')
-        logging.info("Checking to see if any emails exist.")
-        if emails:
-            email = emails[0]
-            logging.info(f"Return the first email: {email}")
+
+        # the card from the organization where the work happened wins outright.
+        if business_card.organization_key == client_key:
+            logger.debug("Using the email on the client's business card: %s", email)
             return email
-        logging.info("Found no email addresses.")
-        return None  # Return None if no emails are found at all
+        if business_card.is_primary:
+            primary_email = email
+        if first_email is None:
+            first_email = email
+
+    logger.debug("No business card for the client. Primary email: %s | First email: %s", primary_email, first_email)
+    return primary_email or first_email
 
-def add_note_for_missing_contact_information(karbon_bearer_token,karbon_access_key,assignee_email,timelines,note_body) -> None:
-    logging.info("Asked to add note to Karbon.")
+async def add_note_for_missing_contact_information(karbon_bearer_token,karbon_access_key,assignee_email,timelines,note_body) -> None:
+    logger.debug("Asked to add note to Karbon.")
 
     note_subject = "OH NO! Missing contact information"
 
@@ -175,8 +415,65 @@ def add_note_for_missing_contact_information(karbon_bearer_token,karbon_access_k
     # Formatting the datetime in ISO format, which includes the timezone
     iso_formatted_date = now.isoformat()
 
-    logging.info("Sending note to Karbon now.")
-    Notes(karbon_bearer_token,karbon_access_key).add_note(note_subject,note_body,timelines,assignee_email,iso_formatted_date,iso_formatted_date)
+    logger.debug("Sending note to Karbon now.")
+    await Notes(karbon_bearer_token,karbon_access_key).add_note(note_subject,note_body,timelines,assignee_email,iso_formatted_date,iso_formatted_date)
+
+async def add_nps_summary_note(karbon_bearer_token, karbon_access_key, work_item, results) -> None:
+    """
+    Writes one note to the work item and client timelines summarising every contact's NPS outcome.
+
+    Contacts whose missing email was already reported for this work item are left out. If any
+    contact is missing an email, the note is assigned to the work item's assignee as a to-do.
+    """
+    work_item_key = work_item.work_item_key
+    ledger = get_idempotency_ledger()
+
+    sent = [result['FullName'] for result in results if result['Status'] == 'sent']
+    scheduled = [result['FullName'] for result in results if result['Status'] == 'scheduled']
+    failed = [result['FullName'] for result in results if result['Status'] == 'failed']
+    missing = []
+    claimed = []
+    for result in results:
+        if result['Status'] == 'missing_email' and await ledger.claim(work_item_key, result['ContactKey'], 'missing_email_note'):
+            missing.append(result['FullName'])
+            claimed.append(result['ContactKey'])
+
+    if not (sent or scheduled or failed or missing):
+        logger.info("Nothing new to report on the timelines for work item %s.", work_item_key)
+        return
+
+    lines = [f"We just finished '{work_item.title}' for '{work_item.client_name}'. Here's how the NPS surveys went:"]
+    if sent:
+        lines.append(f"Sent to: {', '.join(sent)}")
+    if scheduled:
+        due = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=ask_nicely_minutes_delay)
+        lines.append(f"Going out {due:%b %d at %H:%M} UTC to: {', '.join(scheduled)}")
+    if missing:
+        lines.append(f"Missing an email address: {', '.join(missing)}. Please take care of this right away so I can send out their NPS surveys.")
+    if failed:
+        if webhook_queue_backend == 'none':
+            # nothing redelivers an in-process webhook, so don't promise a retry.
+            lines.append(f"Could not send to: {', '.join(failed)}. Please send their surveys from AskNicely.")
+        else:
+            lines.append(f"Could not send to: {', '.join(failed)}. I'll try again shortly.")
+    note_body = '</br></br>'.join(lines)
+
+    timelines = [
+        {'EntityType': 'WorkItem','EntityKey': work_item_key},
+        {'EntityType': work_item.client_type,'EntityKey': work_item.client_key}
+    ]
+
+    try:
+        if missing:
+            await add_note_for_missing_contact_information(karbon_bearer_token,karbon_access_key,work_item.assignee_email_address,timelines,note_body)
+        else:
+            await Notes(karbon_bearer_token,karbon_access_key).add_note("FYI: Sent NPS surveys",note_body,timelines)
+        logger.debug("Added NPS summary note in Karbon.")
+    except Exception as e:
+        # surveys already went out; only the missing email reminders need another chance.
+        logger.error("Could not add NPS summary note for work item %s: %s", work_item_key, e)
+        for contact_key in claimed:
+            await ledger.release(work_item_key, contact_key, 'missing_email_note')
 
 # use for testing
 if __name__ == "__main__":
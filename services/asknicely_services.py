@@ -1,17 +1,20 @@
-import requests
 import logging
+from aiohttp import ClientError
+from services.resilience import CircuitOpenError, request as outbound_request
 from utils.logging_config import setup_logging
-from utils.config import ask_nicely_minutes_delay
+from utils.config import asknicely_trigger_url
+from utils.metrics import span
 
 # apply logging config file
 setup_logging()
+logger = logging.getLogger(__name__)
 
 class AskNicelyAPI:
-    def __init__(self, api_key):
+    def __init__(self, api_key, base_url=None):
         self.api_key = api_key
-        self.base_url = 'https://avriosolutions.asknice.ly/api/v1/contact/trigger'
+        self.base_url = base_url or asknicely_trigger_url
 
-    def send_business_card(self, first_name, last_name, email_address, contact_name, contact_key, contact_type, work_item_name, work_item_key, work_type):
+    async def send_business_card(self, first_name, last_name, email_address, contact_name, contact_key, contact_type, work_item_name, work_item_key, work_type):
         """
         Send business card information from Karbon to Ask Nicely via API to trigger an NPS survey.
 
@@ -27,9 +30,9 @@ class AskNicelyAPI:
             work_type (str): Type of work done.
 
         Returns:
-            Response object from the requests module.
+            Tuple of the HTTP status code and the response body text.
         """
-        logging.info('Received request to send to AskNicely')
+        logger.debug('Received request to send to AskNicely')
 
         headers = {
             'Content-Type': 'application/json',
@@ -39,9 +42,9 @@ class AskNicelyAPI:
             'email': email_address,
             'firstname': first_name,
             'lastname': last_name,
-            'addcontact': False,
-            'triggeremail': True, # remove after testing
-            'delayminutes': 0, # ask_nicely_minutes_delay,
+            'addcontact': 'False',
+            'triggeremail': 'True', # remove after testing
+            'delayminutes': 0, # ask_nicely_minutes_delay is applied locally by utils.scheduler, so surveys can be cancelled
             'contact_name_c': contact_name,
             'contact_key_c': contact_key,
             'contact_type_c': contact_type,
@@ -51,23 +54,31 @@ class AskNicelyAPI:
         }
 
         try:
-            response = requests.post(self.base_url, params=params, headers=headers)
-            if response.status_code == 201:
-                logging.info('Request sent to Ask Nicely successfully.')
+            with span('asknicely_request', method='POST') as timing:
+                response = await outbound_request('POST', self.base_url, params=params, headers=headers)
+                timing.set(status=response.status)
+            status_code, text = response.status, response.text
+            if status_code == 201:
+                logger.info('Request sent to Ask Nicely successfully.')
             else:
-                logging.error(f"Failed to send data: {response.status_code}, {response.text}")
-        except requests.RequestException as e:
-            logging.error(f"An error occurred: {e}")
+                logger.error("Failed to send data: %s, %s", status_code, text)
+        except CircuitOpenError:
+            # nothing was sent, so callers may retry it later.
+            raise
+        except ClientError as e:
+            logger.error("An error occurred: %s", e)
             raise RuntimeError(f"An error occurred while sending data to Ask Nicely: {e}")
 
-        return response
+        return status_code, text
 
 # Usage example:
 if __name__ == "__main__":
 
     # imports for test
     import os
+    import asyncio
     from dotenv import load_dotenv
+    from services.http_session import close_session
 
     # Load the correct environmental variables
     env = os.environ.get('ENVIRONMENT', 'test')
@@ -79,15 +90,22 @@ if __name__ == "__main__":
     api_key = os.getenv('ASKNICELY_API_KEY')
     print(api_key)
     ask_nicely = AskNicelyAPI(api_key)
-    response = ask_nicely.send_business_card(
-        first_name='John',
-        last_name='Doe',
-        email_address='m@dchr.me',
-        contact_name='Company XYZ',
-        contact_key='123abc',
-        contact_type='Organization',
-        work_item_name='Project Alpha',
-        work_item_key='456def',
-        work_type='Consulting'
-    )
-    print(response.status_code, response.json())
+
+    async def main():
+        try:
+            return await ask_nicely.send_business_card(
+                first_name='John',
+                last_name='Doe',
+                email_address='m@dchr.me',
+                contact_name='Company XYZ',
+                contact_key='123abc',
+                contact_type='Organization',
+                work_item_name='Project Alpha',
+                work_item_key='456def',
+                work_type='Consulting'
+            )
+        finally:
+            await close_session()
+
+    status_code, text = asyncio.run(main())
+    print(status_code, text)
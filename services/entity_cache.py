@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from utils.config import entity_cache_max_entries, entity_cache_ttls, entity_cache_default_ttl
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class EntityCache:
+    """
+    In-process cache for Karbon entity lookups.
+
+    Entries are keyed by (entity type, entity key, params) and expire after a per-type TTL.
+    The least recently used entry is evicted once max_entries is reached. Concurrent
+    requests for the same key share a single in-flight fetch. Expired entries that carry
+    an ETag are revalidated with If-None-Match instead of being downloaded again. A fetch that
+    was in flight when its entity was invalidated still answers its callers but isn't stored,
+    so data read before a webhook's change can't be served for a whole TTL after it.
+
+    Cached values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries=1024, ttls=None, default_ttl=60):
+        self.max_entries = max_entries
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict() # key -> [expires_at, etag, value]
+        self._inflight = {} # key -> task
+        self._generations = {} # key -> generation of its in-flight fetch, bumped by invalidation
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'shared': 0, 'evictions': 0, 'invalidations': 0}
+
+    def ttl_for(self, entity_type):
+        """Returns the TTL in seconds for an entity type. A TTL of 0 disables caching for that type."""
+        return self.ttls.get(entity_type, self.default_ttl)
+
+    @staticmethod
+    def make_key(entity_type, entity_key, params=None):
+        return (entity_type, entity_key, tuple(sorted((params or {}).items())))
+
+    async def get_or_fetch(self, entity_type, entity_key, params, fetch):
+        """
+        Returns the cached entity or loads it with fetch.
+
+        Parameters:
+            entity_type (str): Karbon entity type, e.g. 'Contact'.
+            entity_key (str): Karbon key of the entity.
+            params (dict): Query parameters sent with the request.
+            fetch (callable): Coroutine function taking an ETag (or None) and returning
+                (value, etag). value is None when the server answered 304 Not Modified.
+        """
+        ttl = self.ttl_for(entity_type)
+        if ttl <= 0:
+            value, _ = await fetch(None)
+            return value
+
+        key = self.make_key(entity_type, entity_key, params)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[2]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats['shared'] += 1
+        else:
+            self.stats['misses'] += 1
+            # registered before the task runs, so an invalidation that lands first still counts.
+            self._generations[key] = self._generations.get(key, 0) + 1
+            task = asyncio.ensure_future(self._load(key, ttl, fetch, self._generations[key]))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield so a cancelled caller doesn't cancel the fetch other callers are waiting on.
+        return await asyncio.shield(task)
+
+    async def _load(self, key, ttl, fetch, generation):
+        try:
+            entry = self._entries.get(key)
+            etag = entry[1] if entry is not None else None
+            value, new_etag = await fetch(etag)
+        finally:
+            invalidated = self._generations.pop(key, None) != generation
+        if invalidated:
+            logger.debug("Entity cache not storing %s %s, it was invalidated during the fetch.", key[0], key[1])
+            return value if value is not None or entry is None else entry[2]
+
+        if value is None and entry is not None:
+            logger.debug("Entity cache revalidated %s %s with ETag.", key[0], key[1])
+            self.stats['revalidated'] += 1
+            value = entry[2]
+            new_etag = new_etag or etag
+
+        self._entries[key] = [time.monotonic() + ttl, new_etag, value]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+        return value
+
+    def invalidate(self, entity_type, entity_key=None):
+        """Evicts every cached variant of an entity, or every entity of the type if no key is given."""
+        stale = [key for key in self._entries if key[0] == entity_type and entity_key in (None, key[1])]
+        for key in stale:
+            del self._entries[key]
+        self._bump_inflight(lambda key: key[0] == entity_type and entity_key in (None, key[1]))
+        self.stats['invalidations'] += len(stale)
+        return len(stale)
+
+    def invalidate_where(self, entity_type, predicate):
+        """Evicts cached entities of a type whose value matches predicate(value)."""
+        stale = [key for key, entry in self._entries.items() if key[0] == entity_type and predicate(entry[2])]
+        for key in stale:
+            del self._entries[key]
+        # an in-flight fetch has no value to test yet, so every one of the type is treated as stale.
+        self._bump_inflight(lambda key: key[0] == entity_type)
+        self.stats['invalidations'] += len(stale)
+        return len(stale)
+
+    def _bump_inflight(self, matches):
+        for key in self._generations:
+            if matches(key):
+                self._generations[key] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._bump_inflight(lambda key: True)
+
+# Process-wide cache shared by every Entities client.
+entity_cache = EntityCache(entity_cache_max_entries, entity_cache_ttls, entity_cache_default_ttl)
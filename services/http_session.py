@@ -0,0 +1,51 @@
+import asyncio
+import logging
+import aiohttp
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Connection pool settings shared by every outbound client in the worker process.
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 20
+KEEPALIVE_TIMEOUT = 60
+REQUEST_TIMEOUT = 30
+
+_session = None
+_session_loop = None
+
+def get_session():
+    """
+    Returns the process-wide aiohttp session, creating it on first use.
+
+    The session keeps TCP/TLS connections alive between invocations so repeat calls
+    to the same host skip the handshake. A new session is created if the previous one
+    was closed or belongs to a different event loop.
+    """
+    global _session, _session_loop
+
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        logger.info("Creating shared HTTP session.")
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+        _session_loop = loop
+    return _session
+
+async def close_session():
+    """Closes the shared session. Used by scripts that own their event loop."""
+    global _session, _session_loop
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
@@ -0,0 +1,107 @@
+"""
+Compact models for the Karbon entities the webhook pipeline reads.
+
+Each model keeps only the fields the pipeline uses, in __slots__, and nothing refers back to the
+decoded JSON, so the full payload can be freed as soon as the model is built. Build them with
+from_json on the dict returned by Entities.
+"""
+import datetime
+
+class BusinessCard:
+    """A contact's business card. email is the first email address on the card, or None."""
+
+    __slots__ = ('organization_key', 'is_primary', 'email')
+
+    def __init__(self, organization_key, is_primary, email):
+        self.organization_key = organization_key
+        self.is_primary = is_primary
+        self.email = email
+
+    @classmethod
+    def from_json(cls, payload):
+        emails = payload.get('EmailAddresses')
+        return cls(payload.get('OrganizationKey'), bool(payload.get('IsPrimaryCard')), emails[0] if emails else None)
+
+class ContactRef:
+    """A contact as listed on an organization: just its key and display name."""
+
+    __slots__ = ('contact_key', 'full_name')
+
+    def __init__(self, contact_key, full_name):
+        self.contact_key = contact_key
+        self.full_name = full_name
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(payload['ContactKey'], payload.get('FullName'))
+
+class Contact:
+    """A contact with its business cards. first_name is the preferred name when one is set."""
+
+    __slots__ = ('contact_key', 'first_name', 'last_name', 'business_cards')
+
+    def __init__(self, contact_key, first_name, last_name, business_cards=()):
+        self.contact_key = contact_key
+        self.first_name = first_name
+        self.last_name = last_name
+        self.business_cards = business_cards
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(
+            payload['ContactKey'],
+            payload.get('PreferredName') or payload.get('FirstName'),
+            payload.get('LastName'),
+            tuple(BusinessCard.from_json(business_card) for business_card in payload.get('BusinessCards') or ())
+        )
+
+class WorkItem:
+    """
+    A work item's NPS-relevant fields. CompletedDate is kept as sent and parsed to an aware UTC
+    datetime the first time completed_date is read, so work items that are never checked for
+    completion (or aren't completed) never pay for the parse.
+    """
+
+    __slots__ = (
+        'work_item_key', 'title', 'work_type', 'primary_status', 'client_key', 'client_type',
+        'client_name', 'assignee_email_address', '_completed_date', '_completed_date_text'
+    )
+
+    def __init__(self, work_item_key, title, work_type, primary_status, completed_date, client_key, client_type, client_name, assignee_email_address):
+        self.work_item_key = work_item_key
+        self.title = title
+        self.work_type = work_type
+        self.primary_status = primary_status
+        self.client_key = client_key
+        self.client_type = client_type
+        self.client_name = client_name
+        self.assignee_email_address = assignee_email_address
+        self._completed_date = None
+        self._completed_date_text = completed_date
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(
+            payload['WorkItemKey'],
+            payload.get('Title'),
+            payload.get('WorkType'),
+            payload.get('PrimaryStatus'),
+            payload.get('CompletedDate'),
+            payload.get('ClientKey'),
+            payload.get('ClientType'),
+            payload.get('ClientName'),
+            payload.get('AssigneeEmailAddress')
+        )
+
+    @property
+    def completed_date(self):
+        """CompletedDate as an aware UTC datetime, or None if the work item has none."""
+        if self._completed_date is None and self._completed_date_text:
+            self._completed_date = parse_completed_date(self._completed_date_text)
+            self._completed_date_text = None
+        return self._completed_date
+
+def parse_completed_date(completed_date):
+    """Parses a Karbon CompletedDate, e.g. '2024-05-01T17:30:00Z', to an aware UTC datetime."""
+    completed_datetime = datetime.datetime.strptime(completed_date, '%Y-%m-%dT%H:%M:%SZ') # format time for comparison.
+    return completed_datetime.replace(tzinfo=datetime.timezone.utc) # set completed time to UTC.
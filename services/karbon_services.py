@@ -1,78 +1,191 @@
-import requests
+import json
 import logging
-from requests.exceptions import HTTPError, RequestException
+from aiohttp import ClientError
+from services.entity_cache import entity_cache
+from services.resilience import HTTPStatusError, request as outbound_request
+from utils.config import karbon_base_url
+from utils.ingest import validate_webhook_payload
 from utils.logging_config import setup_logging
+from utils.metrics import span
 
 # apply logging config file
 setup_logging()
+logger = logging.getLogger(__name__)
 
 class APIRequestHandler:
     """Base class for handling API requests to the Karbon API."""
     
-    def __init__(self, bearer_token, access_key, base_url='https://api.karbonhq.com/v3'):
+    def __init__(self, bearer_token, access_key, base_url=None):
         self.bearer_token = bearer_token
         self.access_key = access_key
-        self.base_url = base_url
+        self.base_url = base_url or karbon_base_url
 
-    def _send_request(self, method, endpoint, data=None, params=None):
-        """Sends an HTTP request to the specified endpoint."""
-        url = f"{self.base_url}/{endpoint}"
+    async def _send_request(self, method, endpoint, data=None, params=None):
+        """Sends an HTTP request to the specified endpoint over the shared connection pool."""
+        _, _, body = await self._request(method, endpoint, data=data, params=params)
+        return body
+
+    async def _request(self, method, endpoint, data=None, params=None, extra_headers=None):
+        """
+        Sends an HTTP request and returns the status code, response headers and parsed JSON body.
+        endpoint may also be an absolute URL, e.g. an @odata.nextLink.
+        """
+        url = endpoint if endpoint.startswith(('http://', 'https://')) else f"{self.base_url}/{endpoint}"
         headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {self.bearer_token}',
             'AccessKey': self.access_key
         }
+        if extra_headers:
+            headers.update(extra_headers)
         
         try:
-            response = requests.request(method, url, headers=headers, json=data, params=params)
-            response.raise_for_status()  # Raises an HTTPError for bad responses
-            logging.info(f"Request successful: {method} {url}")
-            return response.json()  # Returns JSON response
-        except HTTPError as e:
-            logging.error(f"HTTP error: {method} {url} - {e.response.status_code} {e.response.text}")
+            # label by collection (e.g. 'Contacts') rather than full path to keep the series count small.
+            with span('karbon_request', method=method, resource=endpoint.split('/', 1)[0]) as timing:
+                response = await outbound_request(method, url, headers=headers, json=data, params=params)
+                timing.set(status=response.status)
+            if response.status >= 400:
+                logger.error("HTTP error: %s %s - %s %s", method, url, response.status, response.text)
+                raise HTTPStatusError(method, url, response.status, response.text)
+            logger.debug("Request successful: %s %s", method, url)
+            return response.status, response.headers, json.loads(response.text) if response.text else None  # Returns JSON response
+        except HTTPStatusError:
             raise
-        except RequestException as e:
-            logging.error(f"Request exception: {method} {url} - {e}")
+        except ClientError as e:
+            logger.error("Request exception: %s %s - %s", method, url, e)
             raise
         except Exception as e:
-            logging.error(f"Unhandled exception: {method} {url} - {e}")
+            logger.error("Unhandled exception: %s %s - %s", method, url, e)
             raise
 
-    def get(self, endpoint, params=None):
+    async def get(self, endpoint, params=None):
         """Sends a GET request."""
-        return self._send_request('GET', endpoint, params=params)
+        return await self._send_request('GET', endpoint, params=params)
+
+    async def get_conditional(self, endpoint, params=None, etag=None):
+        """
+        Sends a GET request with If-None-Match when an ETag is given.
+
+        Returns:
+            Tuple of the JSON body (None if the server answered 304 Not Modified) and the response ETag.
+        """
+        extra_headers = {'If-None-Match': etag} if etag else None
+        status, headers, body = await self._request('GET', endpoint, params=params, extra_headers=extra_headers)
+        if status == 304:
+            return None, etag
+        return body, headers.get('ETag')
 
-    def post(self, endpoint, data):
+    async def post(self, endpoint, data):
         """Sends a POST request."""
-        return self._send_request('POST', endpoint, data=data)
+        return await self._send_request('POST', endpoint, data=data)
 
-    def put(self, endpoint, data):
+    async def put(self, endpoint, data):
         """Sends a PUT request."""
-        return self._send_request('PUT', endpoint, data=data)
+        return await self._send_request('PUT', endpoint, data=data)
 
-    def delete(self, endpoint):
+    async def delete(self, endpoint):
         """Sends a DELETE request."""
-        return self._send_request('DELETE', endpoint)
+        return await self._send_request('DELETE', endpoint)
 
-    def patch(self, endpoint, data):
+    async def patch(self, endpoint, data):
         """Sends a PATCH request."""
-        return self._send_request('PATCH', endpoint, data=data)
+        return await self._send_request('PATCH', endpoint, data=data)
     
+# Fields the webhook pipeline reads from each entity. Passed as select= so Karbon sends nothing else.
+WORK_ITEM_FIELDS = ('WorkItemKey', 'Title', 'WorkType', 'PrimaryStatus', 'CompletedDate', 'ClientKey', 'ClientType', 'ClientName', 'AssigneeEmailAddress')
+ORGANIZATION_CONTACT_FIELDS = ('ContactKey', 'FullName')
+CONTACT_FIELDS = ('ContactKey', 'FirstName', 'PreferredName', 'LastName')
+CONTACT_EXPAND = {'$expand': 'BusinessCards($select=OrganizationKey,IsPrimaryCard,EmailAddresses)'}
+
+def select_parameters(parameters=None, select=None):
+    """Returns a copy of parameters with $select set to the given field names, so Karbon only sends those fields."""
+    parameters = dict(parameters or {})
+    if select:
+        parameters['$select'] = ','.join(select)
+    return parameters
+
 class Entities(APIRequestHandler):
-    def __init__(self, bearer_token, access_key):
-        super().__init__(bearer_token, access_key)
+    def __init__(self, bearer_token, access_key, base_url=None):
+        super().__init__(bearer_token, access_key, base_url)
     
-    def get_entity_by_key(self, entitiy_key, entitiy_type,parameters=None):
-        """Gets a single entitiy using the entities's key. Optionally add parameters"""
+    async def get_entity_by_key(self, entitiy_key, entitiy_type,parameters=None,use_cache=True,select=None):
+        """
+        Gets a single entitiy using the entities's key. Optionally add parameters.
+        Pass select (a tuple of field names) to fetch only those fields.
+        Results are served from the shared entity cache unless use_cache is False.
+        """
         endpoint = f"{entitiy_type}s"
         endpoint = f"{endpoint}/{entitiy_key}"
-        return self.get(endpoint,parameters)
+        parameters = select_parameters(parameters, select) if select else parameters
+        if not use_cache:
+            return await self.get(endpoint,parameters)
+
+        async def fetch(etag):
+            return await self.get_conditional(endpoint, parameters, etag)
+
+        return await entity_cache.get_or_fetch(entitiy_type, entitiy_key, parameters, fetch)
+
+    async def iter_collection(self, collection, parameters=None, select=None, page_size=100):
+        """
+        Yields every item of a listed collection, e.g. 'Contacts', one page at a time.
+
+        Pages are requested with $top/$skip, and an @odata.nextLink is followed when Karbon sends one.
+        Only one page is held in memory, so callers can start work as soon as the first page arrives.
+        """
+        parameters = select_parameters(parameters, select)
+        parameters['$top'] = page_size
+        skip = 0
+        endpoint = collection
+        while True:
+            page = await self.get(endpoint, parameters) or {}
+            items = page.get('value') or []
+            for item in items:
+                yield item
+
+            next_link = page.get('@odata.nextLink')
+            if next_link:
+                # the next link carries its own query string.
+                endpoint, parameters = next_link, None
+            elif len(items) < page_size or parameters is None:
+                return
+            else:
+                skip += page_size
+                parameters['$skip'] = skip
+
+    async def iter_expanded(self, entitiy_key, entitiy_type, navigation, select=None, page_size=100, use_cache=True):
+        """
+        Yields the items of an entity's expanded collection (e.g. an Organization's Contacts) a page at a time.
+
+        Each page is requested as $expand=<navigation>($select=...;$top=...;$skip=...) with the parent
+        entity itself projected down to its key, so the full entity is never downloaded. If the
+        server ignores the nested paging, the first response is treated as the whole collection.
+        Pages are cached like any other entity fetch unless use_cache is False.
+        """
+        nested_select = f"$select={','.join(select)};" if select else ''
+        skip = 0
+        previous_first = None
+        while True:
+            parameters = {
+                '$select': f"{entitiy_type}Key",
+                '$expand': f"{navigation}({nested_select}$top={page_size};$skip={skip})"
+            }
+            page = await self.get_entity_by_key(entitiy_key, entitiy_type, parameters, use_cache=use_cache) or {}
+            items = page.get(navigation) or []
+            if items and items[0] == previous_first:
+                # the same page came back again, so the server isn't paging the expansion.
+                return
+            for item in items:
+                yield item
+            if len(items) != page_size:
+                return
+            previous_first = items[0]
+            skip += page_size
 
 class Notes(APIRequestHandler):
-    def __init__(self, bearer_token, access_key):
-        super().__init__(bearer_token, access_key)
+    def __init__(self, bearer_token, access_key, base_url=None):
+        super().__init__(bearer_token, access_key, base_url)
 
-    def add_note(self, subject, body, timelines, assignee=None, todo_date=None, due_date=None):
+    async def add_note(self, subject, body, timelines, assignee=None, todo_date=None, due_date=None):
         """
         Adds a note with provided information to Karbon.
         EXAMPLE TIMELINES:
@@ -103,20 +216,13 @@ class Notes(APIRequestHandler):
             "TodoDate": todo_date,
             "Timelines": timelines
         }
-        return self.post(endpoint, data)
+        return await self.post(endpoint, data)
     
 # check to see if a webhook is from karbon.
 def is_karbon_webhook(webhook_data):
-    # Check if the necessary headers or body keys are present
-    try:
-        # Check for specific body keys typical for Karbon
-        logging.info("Main Handler - is_karbon_webhook:Checking to see if received data looks like a Karbon webhook.")
-        body_keys = ['ResourcePermaKey', 'ResourceType', 'ActionType']
-        if all(key in webhook_data for key in body_keys):
-            logging.info("Main Handler - is_karbon_webhook:Data appears to be a karbon webhook.")
-            # Additional checks can be made here, e.g., specific values or formats
-            return True
-        return False
-    except KeyError:
-        # If any key is missing, it's not a valid Karbon webhook
+    """Checks the body keys, their types and the allowed ResourceType/ActionType values."""
+    problem = validate_webhook_payload(webhook_data)
+    if problem is not None:
+        logger.debug("Main Handler - is_karbon_webhook:Data is not a Karbon webhook: %s", problem)
         return False
+    return True
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from aiohttp import ClientError
+from services.http_session import get_session
+from utils import config
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# statuses that mean the request was not processed, so even non-idempotent calls can be retried.
+SAFE_RETRY_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+class CircuitOpenError(ClientError):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+class HTTPStatusError(ClientError):
+    """Raised for 4xx/5xx responses once retries are exhausted."""
+
+    def __init__(self, method, url, status, text):
+        super().__init__(f"{status} for {method} {url}")
+        self.status = status
+        self.text = text
+
+class OutboundResponse:
+    __slots__ = ('status', 'headers', 'text')
+
+    def __init__(self, status, headers, text):
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+class TokenBucket:
+    """
+    Token bucket limiter. Callers reserve a token up front and sleep until it is due,
+    so waiters are served in arrival order without a lock.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+
+    def pause(self, seconds):
+        """Holds every caller back for seconds, e.g. when the host answered 429 with Retry-After."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Waits for a token and returns the time spent waiting, in seconds."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        wait = max(-self.tokens / self.rate, self.blocked_until - now, 0)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for reset_timeout
+    seconds. It then lets a single trial call through (half-open); success closes it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self._trial_in_flight = False
+
+    def allow(self):
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            self._trial_in_flight = False
+        if self.state == 'closed':
+            return True
+        if self.state == 'half_open' and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def abandon_trial(self):
+        """Frees the half-open trial slot when the trial call was cancelled before finishing."""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning("Circuit breaker opened after %s failures.", self.failures)
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+class HostPolicy:
+    """Rate limiter, circuit breaker and counters shared by every client calling one host."""
+
+    def __init__(self, host, rate, burst):
+        self.host = host
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(config.circuit_breaker_failure_threshold, config.circuit_breaker_reset_timeout)
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'shed': 0, 'throttled': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def record_wait(self, wait):
+        if wait > 0:
+            self.stats['throttled'] += 1
+            self.stats['wait_seconds'] += wait
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+
+_policies = {}
+
+def get_host_policy(host):
+    policy = _policies.get(host)
+    if policy is None:
+        rate, burst = config.outbound_rate_limits.get(host, config.outbound_default_rate_limit)
+        policy = _policies[host] = HostPolicy(host, rate, burst)
+    return policy
+
+def outbound_stats():
+    """Returns limiter, retry and breaker counters per host."""
+    return {host: dict(policy.stats, breaker_state=policy.breaker.state) for host, policy in _policies.items()}
+
+def retry_after_seconds(value):
+    """Parses a Retry-After header given either as seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given retry attempt (1-based)."""
+    return random.uniform(0, min(config.outbound_retry_max_delay, config.outbound_retry_base_delay * 2 ** attempt))
+
+async def request(method, url, **kwargs):
+    """
+    Sends an HTTP request through the shared session under the host's rate limit and circuit breaker.
+
+    429 and 5xx responses are retried with jittered exponential backoff, honouring Retry-After.
+    Non-idempotent methods are only retried when the status shows the request wasn't processed.
+
+    Returns:
+        OutboundResponse: status, headers and body text of the final response.
+
+    Raises:
+        CircuitOpenError: if the host's breaker is open.
+        aiohttp.ClientError: if the connection keeps failing after all retries.
+    """
+    policy = get_host_policy(urlsplit(url).hostname)
+    retry_statuses = RETRY_STATUSES if method.upper() in IDEMPOTENT_METHODS else SAFE_RETRY_STATUSES
+    attempt = 0
+    while True:
+        if not policy.breaker.allow():
+            policy.stats['shed'] += 1
+            raise CircuitOpenError(f"Circuit open for {policy.host}, not calling {method} {url}")
+
+        try:
+            policy.record_wait(await policy.bucket.acquire())
+            policy.stats['requests'] += 1
+            async with get_session().request(method, url, **kwargs) as response:
+                result = OutboundResponse(response.status, response.headers, await response.text())
+        except asyncio.CancelledError:
+            policy.breaker.abandon_trial()
+            raise
+        except (ClientError, asyncio.TimeoutError) as e:
+            policy.breaker.record_failure()
+            policy.stats['failures'] += 1
+            if attempt >= config.outbound_max_retries or method.upper() not in IDEMPOTENT_METHODS:
+                raise
+            attempt += 1
+            policy.stats['retries'] += 1
+            delay = backoff_delay(attempt)
+            logger.warning("Retrying %s %s in %.2fs after error: %s", method, url, delay, e)
+            await asyncio.sleep(delay)
+            continue
+
+        if result.status >= 500:
+            policy.breaker.record_failure()
+            policy.stats['failures'] += 1
+        else:
+            policy.breaker.record_success()
+
+        if result.status not in retry_statuses or attempt >= config.outbound_max_retries:
+            return result
+
+        attempt += 1
+        policy.stats['retries'] += 1
+        retry_after = retry_after_seconds(result.headers.get('Retry-After'))
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        if result.status == 429:
+            # the quota is shared, so hold back every caller for this host, not just this one.
+            policy.bucket.pause(delay)
+            delay = 0
+        logger.warning("Retrying %s %s after %s (attempt %s).", method, url, result.status, attempt)
+        await asyncio.sleep(delay)
@@ -0,0 +1,56 @@
+"""
+Looks up webhooks recorded in the event log.
+
+Times are ISO 8601 (e.g. 2026-10-01 or 2026-10-01T14:30:00, UTC unless an offset is given) or epoch seconds.
+Matching events are printed as JSON lines, oldest first.
+
+Usage:
+    python -m tools.event_log query --key 2RbhPrHfNgRY
+    python -m tools.event_log query --type WorkItem --since 2026-10-01 --until 2026-10-08 --limit 100
+    python -m tools.event_log stats
+"""
+import argparse
+import datetime
+import json
+import os
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return parsed.timestamp()
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the webhook event log.")
+    parser.add_argument('--dir', default=None, help="Event log directory (default EVENT_LOG_DIR from the environment).")
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help="Print recorded webhooks as JSON lines.")
+    query.add_argument('--key', help="ResourcePermaKey to look up.")
+    query.add_argument('--type', help="ResourceType, e.g. WorkItem.")
+    query.add_argument('--since', type=parse_time, help="Only events received at or after this time.")
+    query.add_argument('--until', type=parse_time, help="Only events received at or before this time.")
+    query.add_argument('--limit', type=int, help="Stop after this many events.")
+    commands.add_parser('stats', help="Print segment, event and byte counts.")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(f".env.{os.environ.get('ENVIRONMENT', 'test')}")
+
+    # imported here so the environment is loaded before the config is read.
+    from utils import config
+    from utils.event_log import EventLog
+
+    event_log = EventLog(args.dir or config.event_log_dir, config.event_log_segment_bytes, config.event_log_max_segments)
+    if args.command == 'stats':
+        print(json.dumps(event_log.stats()))
+        return
+
+    for record in event_log.query(args.key, args.type, args.since, args.until, args.limit):
+        record['ReceivedAt'] = datetime.datetime.fromtimestamp(record['ReceivedAt'], datetime.timezone.utc).isoformat()
+        print(json.dumps(record))
+
+if __name__ == "__main__":
+    main()
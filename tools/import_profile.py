@@ -0,0 +1,91 @@
+"""
+Measures cold-start import cost of function_app and of each lazily loaded handler.
+
+Every run imports function_app in a fresh interpreter with -X importtime, then pre-warms every
+handler in the registry, so the two costs show up separately: the first is paid before the
+worker can answer anything, the second on the first webhook of each type (or by the startup
+pre-warm).
+
+The probe runs with the deployed configuration, i.e. the azure queue backend (against the Azurite
+connection string, nothing is contacted at import), unless --queue-backend says otherwise.
+
+Usage:
+    python -m tools.import_profile --runs 5 --top 15
+    python -m tools.import_profile --json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROBE = (
+    "import json, time\n"
+    "started = time.perf_counter()\n"
+    "import function_app\n"
+    "imported = time.perf_counter() - started\n"
+    "from handlers.registry import handler_registry\n"
+    "print(json.dumps({'function_app': imported, 'handlers': handler_registry.prewarm()}))\n"
+)
+
+def parse_importtime(stderr):
+    """Returns (module, self microseconds, cumulative microseconds) for each line of -X importtime output."""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+def profile_once(repo_root, queue_backend='azure'):
+    with tempfile.TemporaryDirectory(prefix='avrio-import-profile-') as data_dir:
+        env = dict(os.environ, LOG_LEVEL='ERROR', LOCAL_DATA_DIR=data_dir, WEBHOOK_QUEUE_BACKEND=queue_backend)
+        env.setdefault('AzureWebJobsStorage', 'UseDevelopmentStorage=true')
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE], cwd=repo_root, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Import probe failed:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, parse_importtime(result.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile cold-start import time of function_app and its handlers.")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters to average over (default 5).")
+    parser.add_argument('--top', type=int, default=15, help="Slowest modules to list by self time (default 15).")
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON.")
+    parser.add_argument('--queue-backend', choices=('azure', 'sqlite', 'none'), default='azure', help="Webhook queue backend to import with (default azure, as deployed).")
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [profile_once(repo_root, args.queue_backend) for _ in range(args.runs)]
+
+    function_app_ms = statistics.median(timings['function_app'] for timings, _ in runs) * 1000
+    handler_ms = {
+        resource_type: round(statistics.median(timings['handlers'][resource_type] for timings, _ in runs) * 1000, 1)
+        for resource_type in runs[0][0]['handlers']
+    }
+    # slowest modules from the last run, by time spent in the module itself.
+    slowest = sorted(runs[-1][1], key=lambda module: module[1], reverse=True)[:args.top]
+
+    summary = {
+        'runs': args.runs,
+        'queue_backend': args.queue_backend,
+        'function_app_import_ms': round(function_app_ms, 1),
+        'handler_first_import_ms': handler_ms,
+        'slowest_modules': [{'module': name, 'self_ms': round(self_us / 1000, 1), 'cumulative_ms': round(cumulative_us / 1000, 1)} for name, self_us, cumulative_us in slowest]
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f"function_app import (median of {args.runs}): {summary['function_app_import_ms']} ms")
+    for resource_type, milliseconds in handler_ms.items():
+        print(f"  {resource_type} handler first import: {milliseconds} ms")
+    print(f"\nSlowest {args.top} modules by self time:")
+    for module in summary['slowest_modules']:
+        print(f"  {module['self_ms']:>8} ms  {module['cumulative_ms']:>8} ms cumulative  {module['module']}")
+
+if __name__ == "__main__":
+    main()
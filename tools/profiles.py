@@ -0,0 +1,85 @@
+"""
+Requests and reads webhook processing profiles.
+
+`token` prints a header value that makes the function app profile the webhook it's sent with
+(PROFILING_SECRET must match the app's). `list` shows the saved profiles and `top` summarises
+one: the frames with the most samples, counted on their own (self) and with their callees
+(total). Collapsed-stack files can also be opened directly in speedscope or flamegraph.pl, and
+.prof files in snakeviz or pstats.
+
+Usage:
+    curl -H "X-Profile-Token: $(python -m tools.profiles token)" ...
+    python -m tools.profiles list
+    python -m tools.profiles top 20261017T204500-WorkItem-1f2e3d4c.collapsed --limit 25
+"""
+import argparse
+import collections
+import glob
+import os
+import time
+
+def summarize_collapsed(path):
+    """Returns (self counts, total counts, samples) per frame from a collapsed-stack file."""
+    self_counts = collections.Counter()
+    total_counts = collections.Counter()
+    samples = 0
+    with open(path) as file:
+        for line in file:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if not stack or not count.isdigit():
+                continue
+            count = int(count)
+            frames = stack.split(';')
+            samples += count
+            self_counts[frames[-1]] += count
+            # a recursive frame counts once per stack towards its total.
+            for frame in set(frames):
+                total_counts[frame] += count
+    return self_counts, total_counts, samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Request and read webhook processing profiles.")
+    parser.add_argument('--dir', default=None, help="Profile directory (default PROFILING_DIR from the environment).")
+    commands = parser.add_subparsers(dest='command', required=True)
+    token = commands.add_parser('token', help="Print a signed profiling token for the request header.")
+    token.add_argument('--ttl', type=int, default=300, help="Seconds the token stays valid (default 300).")
+    commands.add_parser('list', help="List saved profiles, newest first.")
+    top = commands.add_parser('top', help="Print the busiest frames of a profile.")
+    top.add_argument('path', help="Profile file, absolute or relative to the profile directory.")
+    top.add_argument('--limit', type=int, default=20, help="Frames to print (default 20).")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(f".env.{os.environ.get('ENVIRONMENT', 'test')}")
+
+    # imported here so the environment is loaded before the config is read.
+    from utils import config
+    from utils.profiling import sign_token
+
+    directory = args.dir or config.profiling_dir
+    if args.command == 'token':
+        if not config.profiling_secret:
+            parser.error("PROFILING_SECRET is not set.")
+        print(sign_token(time.time() + args.ttl))
+        return
+
+    if args.command == 'list':
+        paths = glob.glob(os.path.join(directory, '*.prof')) + glob.glob(os.path.join(directory, '*.collapsed'))
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            print(f"{os.path.getsize(path):>10}  {os.path.basename(path)}")
+        return
+
+    path = args.path if os.path.exists(args.path) else os.path.join(directory, args.path)
+    if path.endswith('.prof'):
+        import pstats
+        pstats.Stats(path).sort_stats('cumulative').print_stats(args.limit)
+        return
+
+    self_counts, total_counts, samples = summarize_collapsed(path)
+    print(f"{samples} samples")
+    print(f"{'self':>7} {'total':>7}  frame")
+    for frame, total in total_counts.most_common(args.limit):
+        print(f"{self_counts[frame] / samples:>7.1%} {total / samples:>7.1%}  {frame}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Replays a JSONL file of Karbon webhook payloads through webhook_processor.
+
+Each line holds one webhook body, e.g. {"ResourcePermaKey": "...", "ResourceType": "WorkItem", "ActionType": "Updated"}.
+The file is streamed line by line, so memory stays flat no matter how large it is.
+
+Usage:
+    python -m tools.replay_webhooks events.jsonl --workers 8 --rate 5 --checkpoint events.checkpoint
+    python -m tools.replay_webhooks events.jsonl --dry-run
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from utils.ingest import validate_webhook_payload
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class Checkpoint:
+    """
+    Tracks the highest line number below which every line has finished, and persists it.
+
+    Lines complete out of order when replayed concurrently, so only the contiguous
+    low-water mark is safe to resume from.
+    """
+
+    def __init__(self, path, save_every=50):
+        self.path = path
+        self.save_every = save_every
+        self.line = 0
+        self._done = set()
+        self._unsaved = 0
+        if path and os.path.exists(path):
+            with open(path) as file:
+                self.line = json.load(file)['line']
+
+    def mark_done(self, line_number):
+        self._done.add(line_number)
+        while self.line + 1 in self._done:
+            self.line += 1
+            self._done.remove(self.line)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({'line': self.line, 'saved_at': time.time()}, file)
+        os.replace(temp_path, self.path)
+        self._unsaved = 0
+
+def read_events(path, start_after=0):
+    """Yields (line number, payload or None, problem) for each non-blank line after start_after."""
+    with open(path) as file:
+        for line_number, line in enumerate(file, start=1):
+            if line_number <= start_after or not line.strip():
+                continue
+            try:
+                payload = json.loads(line)
+            except ValueError:
+                yield line_number, None, "invalid JSON"
+                continue
+            yield line_number, payload, validate_webhook_payload(payload)
+
+async def replay(path, processor, workers=4, rate=None, dry_run=False, checkpoint_path=None):
+    """
+    Streams events from path into processor with bounded concurrency and an optional rate limit.
+
+    Parameters:
+        path (str): JSONL file of webhook payloads.
+        processor (callable): Coroutine function called with each payload; raising marks it failed.
+        workers (int): Number of events processed at once.
+        rate (float): Maximum events started per second, or None for no limit.
+        dry_run (bool): Validate and report events without calling processor.
+        checkpoint_path (str): File used to record progress and resume from.
+
+    Returns:
+        dict: Counts of dispatched, failed and invalid events and the last checkpointed line.
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    if checkpoint.line:
+        logger.info("Replay - Resuming after line %s.", checkpoint.line)
+
+    stats = {'dispatched': 0, 'failed': 0, 'invalid': 0}
+    pending = asyncio.Queue(maxsize=workers * 2)
+
+    async def worker():
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            line_number, payload = item
+            try:
+                await processor(payload)
+                stats['dispatched'] += 1
+            except Exception as e:
+                stats['failed'] += 1
+                logger.error("Replay - Line %s failed: %s", line_number, e)
+            checkpoint.mark_done(line_number)
+
+    worker_tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    interval = 1 / rate if rate else 0
+    next_start = time.monotonic()
+    try:
+        for line_number, payload, problem in read_events(path, checkpoint.line):
+            if problem is not None:
+                stats['invalid'] += 1
+                logger.warning("Replay - Skipping line %s: %s", line_number, problem)
+                checkpoint.mark_done(line_number)
+                continue
+            if dry_run:
+                stats['dispatched'] += 1
+                logger.info("Replay - Would dispatch line %s: %s %s %s", line_number, payload['ResourceType'], payload['ActionType'], payload['ResourcePermaKey'])
+                continue
+
+            if interval:
+                delay = next_start - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_start = max(next_start, time.monotonic()) + interval
+            await pending.put((line_number, payload))
+
+        for _ in worker_tasks:
+            await pending.put(None)
+        await asyncio.gather(*worker_tasks)
+    finally:
+        for task in worker_tasks:
+            task.cancel()
+        if not dry_run:
+            checkpoint.save()
+
+    stats['checkpoint'] = checkpoint.line
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Karbon webhook payloads from a JSONL file through webhook_processor.")
+    parser.add_argument('path', help="JSONL file with one webhook payload per line.")
+    parser.add_argument('--workers', type=int, default=4, help="Events processed concurrently (default 4).")
+    parser.add_argument('--rate', type=float, default=None, help="Maximum events started per second.")
+    parser.add_argument('--dry-run', action='store_true', help="Validate and list events without dispatching them.")
+    parser.add_argument('--checkpoint', default=None, help="Progress file; replay resumes after the line it records.")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(f".env.{os.environ.get('ENVIRONMENT', 'test')}")
+
+    async def run():
+        if args.dry_run:
+            return await replay(args.path, None, args.workers, args.rate, dry_run=True)
+
+        # imported here so the environment is loaded before function_app reads it.
+        from function_app import webhook_processor
+        from services.http_session import close_session
+
+        async def processor(payload):
+            await webhook_processor(payload, raise_errors=True)
+
+        try:
+            return await replay(args.path, processor, args.workers, args.rate, args.dry_run, args.checkpoint)
+        finally:
+            await close_session()
+
+    stats = asyncio.run(run())
+    print(json.dumps(stats))
+
+if __name__ == "__main__":
+    main()
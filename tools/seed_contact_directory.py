@@ -0,0 +1,128 @@
+"""
+Seeds the local contact directory from Karbon, so NPS runs can resolve contacts without calling Karbon.
+
+Pages through the Karbon contact list (or the contacts of the given organizations), fetches each
+contact with its business cards and stores its name and best email per organization. After this
+one-time load, Contact webhooks keep the directory current.
+
+Usage:
+    python -m tools.seed_contact_directory --concurrency 8
+    python -m tools.seed_contact_directory --organization 4ZxDbR8kTyQ3 --organization 2pLkM7wVnHc1
+    python -m tools.seed_contact_directory --skip 1200    # resume a run that stopped part way
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+async def list_contact_keys(entities, page_size=100, skip=0, limit=None):
+    """Yields the ContactKey of every Karbon contact, one $top/$skip page at a time."""
+    listed = 0
+    while True:
+        page = await entities.get('Contacts', {'$top': page_size, '$skip': skip, '$select': 'ContactKey'})
+        contacts = (page or {}).get('value') or []
+        for contact in contacts:
+            yield contact['ContactKey']
+            listed += 1
+            if limit and listed >= limit:
+                return
+        if len(contacts) < page_size:
+            return
+        skip += page_size
+
+async def organization_contact_keys(entities, organization_keys):
+    for organization_key in organization_keys:
+        async for contact in entities.iter_expanded(organization_key, 'Organization', 'Contacts', select=('ContactKey',), use_cache=False):
+            yield contact['ContactKey']
+
+async def seed(entities, directory, contact_keys, concurrency=8, batch_size=50):
+    """
+    Fetches every contact from contact_keys with its business cards and stores it in directory.
+
+    Returns:
+        dict: Counts of stored and failed contacts.
+    """
+    # imported here so the environment is loaded before the config is read.
+    from services.karbon_models import Contact
+    from services.karbon_services import CONTACT_FIELDS, CONTACT_EXPAND
+
+    stats = {'stored': 0, 'failed': 0}
+    pending = asyncio.Queue(maxsize=concurrency * 2)
+    batch = []
+
+    async def flush():
+        if batch:
+            stats['stored'] += await asyncio.to_thread(directory.upsert_many, list(batch))
+            batch.clear()
+            logger.info("Seed - Stored %s contacts so far.", stats['stored'])
+
+    async def worker():
+        while True:
+            contact_key = await pending.get()
+            if contact_key is None:
+                return
+            try:
+                batch.append(Contact.from_json(await entities.get_entity_by_key(contact_key, 'Contact', CONTACT_EXPAND, use_cache=False, select=CONTACT_FIELDS)))
+            except Exception as e:
+                stats['failed'] += 1
+                logger.error("Seed - Could not fetch contact %s: %s", contact_key, e)
+                continue
+            if len(batch) >= batch_size:
+                await flush()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        async for contact_key in contact_keys:
+            await pending.put(contact_key)
+        for _ in workers:
+            await pending.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    await flush()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the local contact directory from Karbon.")
+    parser.add_argument('--organization', action='append', default=[], help="Only seed contacts of this organization key. Can be repeated.")
+    parser.add_argument('--concurrency', type=int, default=8, help="Contacts fetched at once (default 8).")
+    parser.add_argument('--page-size', type=int, default=100, help="Contacts listed per page (default 100).")
+    parser.add_argument('--skip', type=int, default=0, help="Contacts in the list to skip, to resume a previous run.")
+    parser.add_argument('--limit', type=int, default=None, help="Stop after this many contacts.")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv(f".env.{os.environ.get('ENVIRONMENT', 'test')}")
+    if not os.getenv('CONTACT_DIRECTORY_PATH'):
+        parser.error("CONTACT_DIRECTORY_PATH is not set, so the seeded file would be one the function app never reads.")
+
+    async def run():
+        # imported here so the environment is loaded before the config is read.
+        from services.http_session import close_session
+        from services.karbon_services import Entities
+        from utils.contact_directory import get_contact_directory
+
+        entities = Entities(os.getenv('KARBON_BEARER_TOKEN'), os.getenv('KARBON_ACCESS_KEY'))
+        directory = get_contact_directory()
+        if args.organization:
+            contact_keys = organization_contact_keys(entities, args.organization)
+        else:
+            contact_keys = list_contact_keys(entities, args.page_size, args.skip, args.limit)
+        try:
+            stats = await seed(entities, directory, contact_keys, args.concurrency)
+        finally:
+            await close_session()
+        stats['directory_size'] = directory.count()
+        return stats
+
+    print(json.dumps(asyncio.run(run())))
+
+if __name__ == "__main__":
+    main()
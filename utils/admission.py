@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import signal
+import time
+from utils import config
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """Raised by AdmissionController.admit when a webhook is shed. Carries the response to send back."""
+
+    def __init__(self, status_code, message, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Bounds the webhooks MainWebhookHandler processes in-process, in the background.
+
+    At most max_in_flight admitted webhooks run at once; the rest wait their turn. Once
+    max_backlog webhooks are admitted but not finished, new ones are shed with a 429 and a
+    Retry-After, so Karbon redelivers them later instead of the worker running out of memory.
+    While draining for shutdown every new webhook is shed with a 503.
+
+    The controller keeps a reference to every task it starts, so none are garbage collected
+    mid-flight, and drain() waits for them (up to a deadline) before the worker exits.
+    """
+
+    def __init__(self, max_in_flight=64, max_backlog=256, retry_after=30, drain_timeout=20):
+        self.max_in_flight = max_in_flight
+        self.max_backlog = max(max_backlog, max_in_flight)
+        self.retry_after = retry_after
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self._tasks = set()
+        self._running = 0
+        self._semaphore = None
+        self._signal_loop = None
+        self.stats = {'admitted': 0, 'shed': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'last_drain_seconds': None}
+
+    @property
+    def backlog(self):
+        """Admitted webhooks that haven't finished, running or waiting."""
+        return len(self._tasks)
+
+    @property
+    def in_flight(self):
+        return self._running
+
+    def admit(self, coroutine_function, *args, **kwargs):
+        """
+        Starts coroutine_function(*args, **kwargs) in the background, or raises AdmissionRejected
+        if the backlog is full or the worker is draining. The coroutine is only created once
+        admitted, so a shed webhook costs nothing.
+        """
+        if self.draining:
+            self.stats['shed'] += 1
+            raise AdmissionRejected(503, "Shutting down, try again later.", self.retry_after)
+        if len(self._tasks) >= self.max_backlog:
+            self.stats['shed'] += 1
+            raise AdmissionRejected(429, "Too many webhooks in progress, try again later.", self.retry_after)
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self.install_signal_handler()
+        task = asyncio.create_task(self._run(coroutine_function, *args, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.stats['admitted'] += 1
+        return task
+
+    async def _run(self, coroutine_function, *args, **kwargs):
+        async with self._semaphore:
+            self._running += 1
+            try:
+                await coroutine_function(*args, **kwargs)
+            except asyncio.CancelledError:
+                self.stats['cancelled'] += 1
+                raise
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error("Admission - Background webhook failed: %s", e, exc_info=True)
+            else:
+                self.stats['completed'] += 1
+            finally:
+                self._running -= 1
+
+    async def drain(self, timeout=None):
+        """
+        Stops admitting webhooks and waits up to timeout seconds (default drain_timeout) for the
+        admitted ones to finish. Stragglers are cancelled. Returns the number cancelled.
+        """
+        timeout = self.drain_timeout if timeout is None else timeout
+        self.draining = True
+        started = time.monotonic()
+        pending = set(self._tasks)
+        logger.info("Admission - Draining %s background webhooks (%s in flight), waiting up to %ss.", len(pending), self._running, timeout)
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning("Admission - Cancelled %s background webhooks still running at the drain deadline.", len(pending))
+        self.stats['last_drain_seconds'] = round(time.monotonic() - started, 3)
+        logger.info("Admission - Drained in %ss.", self.stats['last_drain_seconds'])
+        return len(pending)
+
+    def install_signal_handler(self):
+        """
+        Drains on SIGTERM before handing the signal to whatever handled it before. Best effort:
+        returns False where the loop can't take signal handlers (Windows, or not the main thread).
+        """
+        if not config.admission_drain_on_sigterm or self._signal_loop is not None:
+            return False
+        loop = asyncio.get_running_loop()
+        previous = signal.getsignal(signal.SIGTERM)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self._on_terminate, loop, previous)
+        except (NotImplementedError, RuntimeError, ValueError):
+            return False
+        self._signal_loop = loop
+        return True
+
+    def _on_terminate(self, loop, previous):
+        async def drain_then_exit():
+            try:
+                await self.drain()
+            finally:
+                loop.remove_signal_handler(signal.SIGTERM)
+                signal.signal(signal.SIGTERM, previous if previous is not None else signal.SIG_DFL)
+                signal.raise_signal(signal.SIGTERM)
+
+        if not self.draining:
+            logger.info("Admission - SIGTERM received.")
+            self._drain_task = loop.create_task(drain_then_exit())
+
+admission_controller = AdmissionController(
+    max_in_flight=config.admission_max_in_flight,
+    max_backlog=config.admission_max_backlog,
+    retry_after=config.admission_retry_after,
+    drain_timeout=config.admission_drain_timeout
+)
@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import time
+from utils import config
+from utils.logging_config import setup_logging
+from utils.storage import SqliteStore
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class CheckpointStore(SqliteStore):
+    """
+    Named high-water marks for incremental jobs, such as the work item reconciliation sweep.
+
+    Each checkpoint is an epoch time. It survives restarts, so a job picks up where its last
+    successful run left off instead of rescanning everything.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID;
+    '''
+
+    async def get(self, name):
+        """Returns the checkpoint's value, or None if it was never set."""
+        rows = await asyncio.to_thread(self._execute, 'SELECT value FROM checkpoints WHERE name = ?', (name,))
+        return rows[0][0] if rows else None
+
+    async def set(self, name, value):
+        await asyncio.to_thread(
+            self._execute,
+            'INSERT OR REPLACE INTO checkpoints (name, value, updated_at) VALUES (?, ?, ?)',
+            (name, value, time.time())
+        )
+
+_store = None
+
+def get_checkpoint_store():
+    """Returns the process-wide checkpoint store, opening it on first use."""
+    global _store
+    if _store is None:
+        _store = CheckpointStore(config.checkpoint_store_path)
+    return _store
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class _PendingBatch:
+    __slots__ = ('payload', 'first_seen', 'flush_at', 'events', 'task')
+
+    def __init__(self, payload, now, flush_at):
+        self.payload = payload
+        self.first_seen = now
+        self.flush_at = flush_at
+        self.events = 1
+        self.task = None
+
+class WebhookCoalescer:
+    """
+    Collapses webhooks for the same key that arrive within a short window into one handler run.
+
+    Every event for a key pushes its flush back by window seconds, but never past max_wait
+    seconds after the first event, so latency stays bounded. The handler runs once with the
+    latest payload and every caller that submitted during the window gets its result
+    (or exception).
+    """
+
+    def __init__(self, window=2.0, max_wait=10.0, resource_types=('WorkItem',)):
+        self.window = window
+        self.max_wait = max_wait
+        self.resource_types = set(resource_types)
+        self._pending = {}
+        self.stats = {'received': 0, 'merged': 0, 'flushed': 0}
+
+    def applies_to(self, resource_type):
+        return self.window > 0 and resource_type in self.resource_types
+
+    async def submit(self, key, payload, handler):
+        """
+        Queues payload under key and waits for the coalesced handler run.
+
+        Parameters:
+            key (tuple): Identity of the resource, e.g. (ResourceType, ResourcePermaKey).
+            payload (dict): The webhook body.
+            handler (callable): Coroutine function called once with the latest payload.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.stats['received'] += 1
+
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = _PendingBatch(payload, now, now + self.window)
+            self._pending[key] = batch
+            batch.task = asyncio.ensure_future(self._flush_when_due(key, batch, handler))
+        else:
+            batch.payload = payload
+            batch.events += 1
+            batch.flush_at = min(now + self.window, batch.first_seen + self.max_wait)
+            self.stats['merged'] += 1
+            logger.info("Coalescer - Merged event %s for %s.", batch.events, key)
+
+        # shield so a cancelled caller doesn't cancel the run the other callers are waiting on.
+        return await asyncio.shield(batch.task)
+
+    async def _flush_when_due(self, key, batch, handler):
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = batch.flush_at - loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        # later events for this key start a new batch from here on.
+        del self._pending[key]
+        self.stats['flushed'] += 1
+        if batch.events > 1:
+            logger.info("Coalescer - Running handler once for %s events on %s.", batch.events, key)
+        return await handler(batch.payload)
@@ -1,2 +1,135 @@
+import os
+import tempfile
+
+# Local storage for the SQLite-backed stores. The temp directory is per instance and is wiped when it's recycled or scaled in.
+local_data_dir=os.getenv('LOCAL_DATA_DIR', os.path.join(tempfile.gettempdir(), 'avrio-webhook-handler'))
+
+# API endpoints
+karbon_base_url=os.getenv('KARBON_BASE_URL', 'https://api.karbonhq.com/v3')
+asknicely_trigger_url=os.getenv('ASKNICELY_TRIGGER_URL', 'https://avriosolutions.asknice.ly/api/v1/contact/trigger')
+
 # AskNicely settings
-ask_nicely_minutes_delay=1440
\ No newline at end of file
+ask_nicely_minutes_delay=int(os.getenv('ASK_NICELY_MINUTES_DELAY', 0)) # surveys are held this long after a work item completes, 0 sends right away; needs a shared ACTION_SCHEDULER_PATH
+
+# NPS settings
+nps_max_concurrency=int(os.getenv('NPS_MAX_CONCURRENCY', 8)) # contacts handled at once per work item
+nps_contact_page_size=int(os.getenv('NPS_CONTACT_PAGE_SIZE', 50)) # organization contacts fetched per page
+nps_note_mode=os.getenv('NPS_NOTE_MODE', 'aggregate') # 'aggregate' for one summary note per work item, 'per_contact' for a note per contact
+nps_eligible_work_types=tuple(os.getenv('NPS_ELIGIBLE_WORK_TYPES', 'Tax: Processing,Internal').split(',')) # completed work items of these types get NPS surveys
+nps_completion_window=int(os.getenv('NPS_COMPLETION_WINDOW', 3600)) # seconds after CompletedDate a work item stays eligible
+
+# Work item reconciliation sweep, which catches completed work items whose webhook was missed or late.
+# It relies on the idempotency ledger to skip work items a webhook already handled, so only enable it when
+# every instance shares one ledger (a single instance, or IDEMPOTENCY_LEDGER_PATH on shared storage);
+# otherwise webhooks handled on other instances get their surveys sent twice.
+reconciliation_enabled=os.getenv('RECONCILIATION_ENABLED', 'false').lower() == 'true'
+reconciliation_overlap=int(os.getenv('RECONCILIATION_OVERLAP', 300)) # seconds each sweep re-reads before the last one, for late writes
+reconciliation_page_size=int(os.getenv('RECONCILIATION_PAGE_SIZE', 100))
+reconciliation_concurrency=int(os.getenv('RECONCILIATION_CONCURRENCY', 4)) # work items sent through NPS at once
+checkpoint_store_path=os.getenv('CHECKPOINT_STORE_PATH', os.path.join(local_data_dir, 'checkpoints.db'))
+
+# Delayed action scheduler, which holds survey triggers and their notes until they are due.
+# Set ACTION_SCHEDULER_PATH to storage every instance shares (e.g. under $HOME in Azure) before using a delay:
+# the default is on the instance's temp disk, so held surveys are lost when it's recycled or scaled in.
+action_scheduler_path=os.getenv('ACTION_SCHEDULER_PATH', os.path.join(local_data_dir, 'scheduled_actions.db'))
+action_scheduler_batch_size=int(os.getenv('ACTION_SCHEDULER_BATCH_SIZE', 100)) # due actions fired together
+action_scheduler_lease=300 # seconds a fired action stays leased before it's due again
+action_scheduler_max_attempts=int(os.getenv('ACTION_SCHEDULER_MAX_ATTEMPTS', 5))
+action_scheduler_retry_base_delay=60 # seconds, doubled on each attempt
+action_scheduler_poll_interval=30 # longest sleep between checks for due actions
+
+# Entity cache settings
+entity_cache_max_entries=int(os.getenv('ENTITY_CACHE_MAX_ENTRIES', 1024))
+entity_cache_default_ttl=60 # seconds
+entity_cache_ttls={
+    'WorkItem': 0, # always fetch fresh, status and completion drive NPS eligibility
+    'Organization': int(os.getenv('ENTITY_CACHE_ORGANIZATION_TTL', 300)),
+    'Contact': int(os.getenv('ENTITY_CACHE_CONTACT_TTL', 300))
+}
+
+# Webhook queue settings
+webhook_queue_backend=os.getenv('WEBHOOK_QUEUE_BACKEND', 'azure' if os.getenv('AzureWebJobsStorage') else 'sqlite') # 'azure' (default in Azure), 'sqlite' for offline runs only, or 'none' to dispatch in-process
+webhook_queue_path=os.getenv('WEBHOOK_QUEUE_PATH', os.path.join(local_data_dir, 'webhook_queue.db'))
+webhook_queue_connection_string=os.getenv('WEBHOOK_QUEUE_CONNECTION_STRING', os.getenv('AzureWebJobsStorage'))
+webhook_queue_name=os.getenv('WEBHOOK_QUEUE_NAME', 'karbon-webhooks')
+webhook_queue_batch_size=int(os.getenv('WEBHOOK_QUEUE_BATCH_SIZE', 16)) # messages leased per dequeue
+webhook_queue_max_in_flight=int(os.getenv('WEBHOOK_QUEUE_MAX_IN_FLIGHT', 128)) # leased messages processing at once, most of them waiting out the coalescing window; kept above the handler caps
+webhook_queue_visibility_timeout=int(os.getenv('WEBHOOK_QUEUE_VISIBILITY_TIMEOUT', 300)) # seconds a leased message stays hidden
+webhook_queue_max_attempts=int(os.getenv('WEBHOOK_QUEUE_MAX_ATTEMPTS', 5))
+webhook_queue_retry_base_delay=30 # seconds, doubled on each attempt
+webhook_queue_poll_interval=1.0 # seconds between polls when the queue is empty
+
+# Admission control for webhooks processed in-process (webhook_queue_backend 'none')
+admission_max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 64)) # background webhooks running at once
+admission_max_backlog=int(os.getenv('ADMISSION_MAX_BACKLOG', 256)) # admitted but unfinished webhooks before new ones get a 429
+admission_retry_after=int(os.getenv('ADMISSION_RETRY_AFTER', 30)) # seconds, sent as Retry-After on 429 and 503 responses
+admission_drain_timeout=float(os.getenv('ADMISSION_DRAIN_TIMEOUT', 20)) # seconds to let background webhooks finish on shutdown
+admission_drain_on_sigterm=os.getenv('ADMISSION_DRAIN_ON_SIGTERM', 'true').lower() == 'true'
+
+# Webhook coalescing settings
+webhook_coalesce_window=float(os.getenv('WEBHOOK_COALESCE_WINDOW', 2.0)) # seconds of quiet before a key is handled, 0 disables
+webhook_coalesce_max_wait=float(os.getenv('WEBHOOK_COALESCE_MAX_WAIT', 10.0)) # upper bound on the delay from the first event
+webhook_coalesce_resource_types=('WorkItem',)
+
+# Idempotency ledger settings
+idempotency_ledger_path=os.getenv('IDEMPOTENCY_LEDGER_PATH', os.path.join(local_data_dir, 'idempotency.db'))
+idempotency_ledger_ttl=int(os.getenv('IDEMPOTENCY_LEDGER_TTL', 30 * 24 * 3600)) # seconds an action is remembered
+
+# Contact directory settings. A Contact webhook only updates the directory of the instance that handles it, so it's
+# off unless CONTACT_DIRECTORY_PATH points at one file every instance (and the seed tool) uses.
+contact_directory_enabled=os.getenv('CONTACT_DIRECTORY_ENABLED', 'true' if os.getenv('CONTACT_DIRECTORY_PATH') else 'false').lower() == 'true' # resolve NPS contacts locally before calling Karbon
+contact_directory_path=os.getenv('CONTACT_DIRECTORY_PATH', os.path.join(local_data_dir, 'contact_directory.db'))
+contact_directory_max_age=int(os.getenv('CONTACT_DIRECTORY_MAX_AGE', 7 * 24 * 3600)) # seconds before an entry is refetched, in case a webhook was missed
+
+# Webhook ingestion settings
+webhook_max_body_bytes=int(os.getenv('WEBHOOK_MAX_BODY_BYTES', 16 * 1024)) # Karbon webhooks are a few hundred bytes
+webhook_signing_secret=os.getenv('WEBHOOK_SIGNING_SECRET') # when set, webhooks must carry a matching HMAC-SHA256 signature
+webhook_signature_header=os.getenv('WEBHOOK_SIGNATURE_HEADER', 'X-Karbon-Signature')
+karbon_webhook_resource_types=tuple(os.getenv('KARBON_WEBHOOK_RESOURCE_TYPES', 'WorkItem,Contact,Organization,ClientGroup,Note,User').split(','))
+karbon_webhook_action_types=tuple(os.getenv('KARBON_WEBHOOK_ACTION_TYPES', 'Inserted,Updated,Deleted').split(','))
+
+# Event log settings
+event_log_enabled=os.getenv('EVENT_LOG_ENABLED', 'true').lower() == 'true'
+event_log_dir=os.getenv('EVENT_LOG_DIR', os.path.join(local_data_dir, 'event_log'))
+event_log_segment_bytes=int(os.getenv('EVENT_LOG_SEGMENT_BYTES', 16 * 1024 * 1024)) # a new segment is started past this size
+event_log_max_segments=int(os.getenv('EVENT_LOG_MAX_SEGMENTS', 32)) # oldest segments are deleted beyond this
+event_log_resource_types=tuple(filter(None, os.getenv('EVENT_LOG_RESOURCE_TYPES', ','.join(karbon_webhook_resource_types)).split(','))) # types recorded as they are accepted
+
+# Outbound API limits, shared by every client in the process. host -> (requests per second, burst)
+outbound_rate_limits={
+    'api.karbonhq.com': (float(os.getenv('KARBON_RATE_LIMIT', 2)), int(os.getenv('KARBON_RATE_BURST', 10))),
+    'avriosolutions.asknice.ly': (float(os.getenv('ASKNICELY_RATE_LIMIT', 5)), int(os.getenv('ASKNICELY_RATE_BURST', 10)))
+}
+outbound_default_rate_limit=(float(os.getenv('OUTBOUND_DEFAULT_RATE_LIMIT', 10)), int(os.getenv('OUTBOUND_DEFAULT_RATE_BURST', 20))) # any other host
+outbound_max_retries=int(os.getenv('OUTBOUND_MAX_RETRIES', 4))
+outbound_retry_base_delay=0.5 # seconds, doubled on each retry
+outbound_retry_max_delay=30 # seconds
+circuit_breaker_failure_threshold=int(os.getenv('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5)) # consecutive failures before opening
+circuit_breaker_reset_timeout=int(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', 30)) # seconds before a trial call
+
+# Handler settings
+handler_prewarm=tuple(filter(None, os.getenv('HANDLER_PREWARM', 'WorkItem').split(','))) # resource types whose handlers are imported at startup
+handler_max_concurrency=int(os.getenv('HANDLER_MAX_CONCURRENCY', 32)) # handler runs at once across all resource types
+handler_concurrency_limits={ # handler runs at once per resource type
+    'WorkItem': int(os.getenv('WORKITEM_HANDLER_CONCURRENCY', 16)),
+    'Contact': int(os.getenv('CONTACT_HANDLER_CONCURRENCY', 8)),
+    'Note': int(os.getenv('NOTE_HANDLER_CONCURRENCY', 8))
+}
+handler_default_concurrency_limit=8
+handler_priorities={'Contact': 0, 'Note': 1, 'WorkItem': 2} # lower is served first when slots are scarce; quick events jump ahead of NPS runs
+handler_thread_pool_size=int(os.getenv('HANDLER_THREAD_POOL_SIZE', 4)) # threads for synchronous (blocking) handlers
+
+# Metrics and tracing settings
+metrics_enabled=os.getenv('METRICS_ENABLED', 'true').lower() == 'true' # stage timings served on the metrics route
+otel_exporter_endpoint=os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT') # when set, stage spans are also exported over OTLP (needs the opentelemetry packages)
+otel_service_name=os.getenv('OTEL_SERVICE_NAME', 'avrio-webhook-handler')
+
+# On-demand profiling of webhook processing
+profiling_sample_rate=float(os.getenv('PROFILING_SAMPLE_RATE', 0)) # share of webhooks (0-1) profiled at random, 0 disables
+profiling_secret=os.getenv('PROFILING_SECRET') # when set, a webhook carrying a token signed with it is profiled (see tools/profiles.py)
+profiling_header=os.getenv('PROFILING_HEADER', 'X-Profile-Token')
+profiling_mode=os.getenv('PROFILING_MODE', 'sample') # 'sample' for collapsed stacks including awaited time, 'cprofile' for pstats
+profiling_interval=float(os.getenv('PROFILING_INTERVAL', 0.005)) # seconds between stack samples
+profiling_dir=os.getenv('PROFILING_DIR', os.path.join(local_data_dir, 'profiles'))
+profiling_max_bytes=int(os.getenv('PROFILING_MAX_BYTES', 50 * 1024 * 1024)) # oldest profiles are deleted beyond this total size
+profiling_max_files=int(os.getenv('PROFILING_MAX_FILES', 200))
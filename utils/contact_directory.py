@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from utils import config
+from utils.logging_config import setup_logging
+from utils.storage import SqliteStore
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+def resolve_business_card_emails(business_cards):
+    """
+    Precomputes which email to use for a contact from its BusinessCard models, following the same
+    precedence as the NPS helper.
+
+    Returns:
+        Tuple of a dict of organization key -> first email on that organization's card, and the
+        default email for any other organization: the primary card's email, else the first email
+        found on any card, else None.
+    """
+    organization_emails = {}
+    primary_email = None
+    first_email = None
+    for business_card in business_cards:
+        email = business_card.email
+        if not email:
+            continue
+        organization_key = business_card.organization_key
+        if organization_key and organization_key not in organization_emails:
+            organization_emails[organization_key] = email
+        if business_card.is_primary:
+            primary_email = email
+        if first_email is None:
+            first_email = email
+    return organization_emails, primary_email or first_email
+
+class ContactDirectory(SqliteStore):
+    """
+    Local index of each contact's name and best email per organization, built from Karbon contacts.
+
+    Kept current by Contact webhooks (see contacts_handler) and seeded in bulk with
+    tools/seed_contact_directory.py, so the NPS helper can resolve a contact without calling Karbon.
+    Entries older than max_age seconds are treated as missing and refetched.
+
+    Only enabled by default when CONTACT_DIRECTORY_PATH is set: a copy on one instance's temp disk
+    would miss the Contact webhooks handled elsewhere and keep stale emails for up to max_age.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS contacts (
+            contact_key TEXT PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            default_email TEXT,
+            refreshed_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS contact_emails (
+            contact_key TEXT NOT NULL,
+            organization_key TEXT NOT NULL,
+            email TEXT NOT NULL,
+            PRIMARY KEY (contact_key, organization_key)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path, max_age=7 * 24 * 3600):
+        super().__init__(path)
+        self.max_age = max_age
+        self.stats = {'hits': 0, 'misses': 0, 'updates': 0, 'removals': 0}
+
+    async def lookup(self, contact_key, organization_key):
+        """
+        Returns a dict of FirstName, LastName and Email (None if the contact has no email address),
+        or None if the contact isn't in the directory or its entry is too old.
+        """
+        rows = await asyncio.to_thread(
+            self._execute,
+            'SELECT c.first_name, c.last_name, COALESCE(e.email, c.default_email) FROM contacts c '
+            'LEFT JOIN contact_emails e ON e.contact_key = c.contact_key AND e.organization_key = ? '
+            'WHERE c.contact_key = ? AND c.refreshed_at > ?',
+            (organization_key or '', contact_key, time.time() - self.max_age)
+        )
+        if not rows:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        first_name, last_name, email = rows[0]
+        return {'FirstName': first_name, 'LastName': last_name, 'Email': email}
+
+    async def upsert(self, contact):
+        """Stores a Contact model built from a Karbon contact fetched with $expand=BusinessCards."""
+        await asyncio.to_thread(self.upsert_many, [contact])
+
+    def upsert_many(self, contacts):
+        """Stores several Contact models in one transaction. Returns the number stored."""
+        now = time.time()
+
+        def work(connection):
+            for contact in contacts:
+                contact_key = contact.contact_key
+                organization_emails, default_email = resolve_business_card_emails(contact.business_cards)
+                connection.execute(
+                    'INSERT OR REPLACE INTO contacts (contact_key, first_name, last_name, default_email, refreshed_at) VALUES (?, ?, ?, ?, ?)',
+                    (contact_key, contact.first_name, contact.last_name, default_email, now)
+                )
+                connection.execute('DELETE FROM contact_emails WHERE contact_key = ?', (contact_key,))
+                connection.executemany(
+                    'INSERT INTO contact_emails (contact_key, organization_key, email) VALUES (?, ?, ?)',
+                    [(contact_key, organization_key, email) for organization_key, email in organization_emails.items()]
+                )
+            return len(contacts)
+
+        stored = self._transaction(work)
+        self.stats['updates'] += stored
+        return stored
+
+    async def remove(self, contact_key):
+        def work(connection):
+            connection.execute('DELETE FROM contact_emails WHERE contact_key = ?', (contact_key,))
+            return connection.execute('DELETE FROM contacts WHERE contact_key = ?', (contact_key,)).rowcount
+        removed = await asyncio.to_thread(self._transaction, work)
+        self.stats['removals'] += removed
+        return removed
+
+    def count(self):
+        return self._execute('SELECT COUNT(*) FROM contacts')[0][0]
+
+_directory = None
+
+def get_contact_directory():
+    """Returns the process-wide contact directory, opening it on first use."""
+    global _directory
+    if _directory is None:
+        _directory = ContactDirectory(config.contact_directory_path, config.contact_directory_max_age)
+    return _directory
@@ -0,0 +1,344 @@
+import atexit
+import glob
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from utils import config
+from utils.logging_config import setup_logging
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    _dumps = lambda value: json.dumps(value, separators=(',', ':')).encode()
+    _loads = json.loads
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# One index entry per record: key hash, resource type hash, received at, offset and length in the log.
+INDEX_RECORD = struct.Struct('<QIdQI')
+
+# Seconds after its last write that an unsealed segment of a live process counts as abandoned. Writers
+# start a new segment after ORPHAN_AGE / 2 idle, so nothing appends to a segment that old.
+ORPHAN_AGE = 3600
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def key_hash(resource_perma_key):
+    return int.from_bytes(hashlib.blake2b(resource_perma_key.encode(), digest_size=8).digest(), 'little')
+
+def type_hash(resource_type):
+    return zlib.crc32(resource_type.encode())
+
+class _Segment:
+    """
+    One log file and its index files.
+
+    <name>.log holds one JSON record per line. <name>.idx holds INDEX_RECORD entries in append
+    (time) order. <name>.kdx is written when the segment is sealed and holds the same entries
+    sorted by key hash, so key lookups in sealed segments are a binary search.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.base = log_path[:-len('.log')]
+        self.index_path = f"{self.base}.idx"
+        self.key_index_path = f"{self.base}.kdx"
+
+    def _map(self, path):
+        try:
+            with open(path, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size // INDEX_RECORD.size * INDEX_RECORD.size
+                if not size:
+                    return None
+                return mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def bounds(self):
+        """Returns (first, last) received_at in the segment, or None if it's empty."""
+        index = self._map(self.index_path)
+        if index is None:
+            return None
+        with index:
+            first = INDEX_RECORD.unpack_from(index, 0)[2]
+            last = INDEX_RECORD.unpack_from(index, len(index) - INDEX_RECORD.size)[2]
+        return first, last
+
+    def entries_for_key(self, wanted_key_hash):
+        key_index = self._map(self.key_index_path)
+        if key_index is None:
+            # not sealed yet (still being written, or its writer stopped), so scan the append index.
+            index = self._map(self.index_path)
+            if index is None:
+                return []
+            with index:
+                return [entry for entry in INDEX_RECORD.iter_unpack(index) if entry[0] == wanted_key_hash]
+
+        with key_index:
+            count = len(key_index) // INDEX_RECORD.size
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if INDEX_RECORD.unpack_from(key_index, middle * INDEX_RECORD.size)[0] < wanted_key_hash:
+                    low = middle + 1
+                else:
+                    high = middle
+            entries = []
+            while low < count:
+                entry = INDEX_RECORD.unpack_from(key_index, low * INDEX_RECORD.size)
+                if entry[0] != wanted_key_hash:
+                    break
+                entries.append(entry)
+                low += 1
+            return entries
+
+    def entries_between(self, since=None, until=None):
+        index = self._map(self.index_path)
+        if index is None:
+            return
+        with index:
+            count = len(index) // INDEX_RECORD.size
+            low, high = 0, count
+            while since is not None and low < high:
+                middle = (low + high) // 2
+                if INDEX_RECORD.unpack_from(index, middle * INDEX_RECORD.size)[2] < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            for position in range(low, count):
+                entry = INDEX_RECORD.unpack_from(index, position * INDEX_RECORD.size)
+                if until is not None and entry[2] > until:
+                    break
+                yield entry
+
+    def read(self, entries):
+        """Yields the decoded record for each index entry."""
+        with open(self.log_path, 'rb') as file:
+            for entry in entries:
+                file.seek(entry[3])
+                yield _loads(file.read(entry[4]))
+
+    @property
+    def pid(self):
+        return int(self.base.rsplit('-', 1)[1])
+
+    @property
+    def sealed(self):
+        return os.path.exists(self.key_index_path)
+
+    def seal(self):
+        index = self._map(self.index_path)
+        if index is None:
+            return
+        with index:
+            entries = sorted(INDEX_RECORD.iter_unpack(index), key=lambda entry: (entry[0], entry[2]))
+        temp_path = f"{self.key_index_path}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(b''.join(INDEX_RECORD.pack(*entry) for entry in entries))
+        os.replace(temp_path, self.key_index_path)
+
+    def remove(self):
+        for path in (self.log_path, self.index_path, self.key_index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class EventLog:
+    """
+    Append-only log of accepted webhook payloads, split into size-capped segments.
+
+    Each append is two small unbuffered writes (the JSON line, then its fixed-size index entry),
+    cheap enough for the ingest path. Every process writes its own segments, so several worker
+    processes can share the directory. The oldest sealed segments are deleted beyond max_segments.
+
+    Queries by ResourcePermaKey use the sealed segments' key index; queries by time binary-search
+    the append index. Both are read through mmap, so the index is never loaded into memory.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_segments=32):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._segment = None
+        self._log_file = None
+        self._index_file = None
+        self._log_size = 0
+        self._last_append = 0.0
+        self._started_at = time.time()
+        os.makedirs(directory, exist_ok=True)
+
+    def _segments(self):
+        return [_Segment(path) for path in sorted(glob.glob(os.path.join(self.directory, 'events-*.log')))]
+
+    def _open_segment(self):
+        # time first so segments sort by creation, pid so concurrent workers never share a file.
+        name = f"events-{time.time_ns():020d}-{os.getpid()}"
+        self._segment = _Segment(os.path.join(self.directory, f"{name}.log"))
+        self._log_file = open(self._segment.log_path, 'ab', buffering=0)
+        self._index_file = open(self._segment.index_path, 'ab', buffering=0)
+        self._log_size = 0
+
+    def _rotate(self):
+        # sorting the key index takes a moment on a full segment, so keep it off the append path.
+        sealed = self._close_segment(seal=False)
+        threading.Thread(target=sealed.seal, name='event-log-seal', daemon=True).start()
+        self._prune(reserve=1)
+        self._open_segment()
+
+    def _prune(self, reserve=0):
+        # only sealed segments are pruned: an unsealed one may still be open for append in another
+        # worker process, and on Linux its later appends would go to an unlinked file and be lost.
+        segments = [segment for segment in self._segments() if segment.sealed]
+        for segment in segments[:max(0, len(segments) - self.max_segments + reserve)]:
+            logger.info("Event log - Removing old segment %s.", segment.log_path)
+            segment.remove()
+
+    def seal_orphans(self):
+        """
+        Seals the segments of writers that stopped without sealing them, so retention applies to
+        them: a host kills recycled workers without running atexit. A segment is orphaned when its
+        writer's pid is gone, when it carries this process's pid but predates this log (a restart
+        reusing the pid), or when it hasn't been written for ORPHAN_AGE seconds. Returns the number sealed.
+        """
+        now = time.time()
+        sealed = 0
+        for segment in self._segments():
+            if segment.sealed:
+                continue
+            try:
+                pid = segment.pid
+                modified = os.path.getmtime(segment.log_path)
+            except (ValueError, OSError):
+                continue
+            if pid == os.getpid():
+                orphaned = modified < self._started_at
+            else:
+                orphaned = not pid_alive(pid)
+            if not orphaned and now - modified < ORPHAN_AGE:
+                continue
+            if segment.bounds() is None:
+                segment.remove() # nothing was ever written to it
+            else:
+                segment.seal()
+                sealed += 1
+        if sealed:
+            logger.info("Event log - Sealed %s segments left by stopped workers.", sealed)
+        self._prune()
+        return sealed
+
+    def _close_segment(self, seal=True):
+        segment = self._segment
+        if segment is None:
+            return None
+        self._log_file.close()
+        self._index_file.close()
+        if seal:
+            segment.seal()
+        self._segment = None
+        return segment
+
+    def append(self, payload, correlation_id=None, received_at=None):
+        """Records one webhook payload."""
+        received_at = received_at or time.time()
+        line = _dumps({'ReceivedAt': received_at, 'CorrelationId': correlation_id, 'Payload': payload}) + b'\n'
+        entry_key = key_hash(str(payload.get('ResourcePermaKey')))
+        entry_type = type_hash(str(payload.get('ResourceType')))
+        with self._lock:
+            now = time.monotonic()
+            if self._segment is None:
+                self._open_segment()
+            elif self._log_size + len(line) > self.segment_bytes or now - self._last_append > ORPHAN_AGE / 2:
+                # an idle segment is rotated too, so seal_orphans can't seal one that's still appended to.
+                self._rotate()
+            offset = self._log_size
+            self._log_file.write(line)
+            self._log_size += len(line)
+            self._last_append = now
+            self._index_file.write(INDEX_RECORD.pack(entry_key, entry_type, received_at, offset, len(line) - 1))
+
+    def query(self, resource_perma_key=None, resource_type=None, since=None, until=None, limit=None):
+        """
+        Yields recorded webhooks, oldest first, as dicts of ReceivedAt, CorrelationId and Payload.
+
+        Parameters:
+            resource_perma_key (str): Only events for this key.
+            resource_type (str): Only events of this type, e.g. 'WorkItem'.
+            since (float): Only events received at or after this epoch time.
+            until (float): Only events received at or before this epoch time.
+            limit (int): Stop after this many events.
+        """
+        wanted_key = key_hash(resource_perma_key) if resource_perma_key is not None else None
+        wanted_type = type_hash(resource_type) if resource_type is not None else None
+
+        def segment_records(segment):
+            if wanted_key is not None:
+                entries = [entry for entry in segment.entries_for_key(wanted_key) if (since is None or entry[2] >= since) and (until is None or entry[2] <= until)]
+            else:
+                entries = segment.entries_between(since, until)
+            if wanted_type is not None:
+                entries = (entry for entry in entries if entry[1] == wanted_type)
+            for record in segment.read(entries):
+                payload = record['Payload']
+                # hashes can collide, so confirm against the payload itself.
+                if resource_perma_key is not None and payload.get('ResourcePermaKey') != resource_perma_key:
+                    continue
+                if resource_type is not None and payload.get('ResourceType') != resource_type:
+                    continue
+                yield record
+
+        sources = []
+        for segment in self._segments():
+            bounds = segment.bounds()
+            if bounds is None or (since is not None and bounds[1] < since) or (until is not None and bounds[0] > until):
+                continue
+            sources.append(segment_records(segment))
+
+        # segments from different workers overlap in time, so merge them back into one timeline.
+        for count, record in enumerate(heapq.merge(*sources, key=lambda record: record['ReceivedAt']), start=1):
+            yield record
+            if limit and count >= limit:
+                return
+
+    def stats(self):
+        segments = self._segments()
+        return {
+            'segments': len(segments),
+            'bytes': sum(os.path.getsize(segment.log_path) for segment in segments if os.path.exists(segment.log_path)),
+            'events': sum(os.path.getsize(segment.index_path) // INDEX_RECORD.size for segment in segments if os.path.exists(segment.index_path))
+        }
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+_event_log = None
+
+def get_event_log():
+    """Returns the process-wide event log, opening it on first use."""
+    global _event_log
+    if _event_log is None:
+        _event_log = EventLog(config.event_log_dir, config.event_log_segment_bytes, config.event_log_max_segments)
+        # seal the open segment on exit so its key index is written, and any left by killed workers now.
+        atexit.register(_event_log.close)
+        threading.Thread(target=_event_log.seal_orphans, name='event-log-orphans', daemon=True).start()
+    return _event_log
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from utils import config
+from utils.logging_config import setup_logging
+from utils.storage import SqliteStore
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class IdempotencyLedger(SqliteStore):
+    """
+    Records which outbound side effects have already happened, keyed on (WorkItemKey, ContactKey, action).
+
+    claim is an atomic insert, so only one of several concurrent or repeated webhooks wins the
+    right to perform an action. Entries older than ttl seconds are compacted away.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS ledger (
+            work_item_key TEXT NOT NULL,
+            contact_key TEXT NOT NULL,
+            action TEXT NOT NULL,
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (work_item_key, contact_key, action)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS ledger_recorded_at ON ledger (recorded_at);
+    '''
+
+    def __init__(self, path, ttl=30 * 24 * 3600, compact_interval=3600):
+        super().__init__(path)
+        self.ttl = ttl
+        self.compact_interval = compact_interval
+        self._last_compacted = 0
+
+    async def has(self, work_item_key, contact_key, action):
+        rows = await asyncio.to_thread(
+            self._execute,
+            'SELECT 1 FROM ledger WHERE work_item_key = ? AND contact_key = ? AND action = ? AND recorded_at > ?',
+            (work_item_key, contact_key or '', action, time.time() - self.ttl)
+        )
+        return bool(rows)
+
+    async def claim(self, work_item_key, contact_key, action):
+        """Records the action and returns True, or returns False if it was already recorded."""
+        return await asyncio.to_thread(self._claim, work_item_key, contact_key or '', action)
+
+    def _claim(self, work_item_key, contact_key, action):
+        self._maybe_compact()
+        now = time.time()
+
+        def work(connection):
+            # an expired entry no longer blocks the action.
+            connection.execute(
+                'DELETE FROM ledger WHERE work_item_key = ? AND contact_key = ? AND action = ? AND recorded_at <= ?',
+                (work_item_key, contact_key, action, now - self.ttl)
+            )
+            return connection.execute(
+                'INSERT OR IGNORE INTO ledger (work_item_key, contact_key, action, recorded_at) VALUES (?, ?, ?, ?)',
+                (work_item_key, contact_key, action, now)
+            ).rowcount == 1
+        return self._transaction(work)
+
+    async def release(self, work_item_key, contact_key, action):
+        """Forgets a claim whose side effect failed so a retry can perform it."""
+        await asyncio.to_thread(
+            self._execute,
+            'DELETE FROM ledger WHERE work_item_key = ? AND contact_key = ? AND action = ?',
+            (work_item_key, contact_key or '', action)
+        )
+
+    def compact(self):
+        """Deletes entries older than the TTL. Returns the number removed."""
+        removed = self._transaction(lambda connection: connection.execute(
+            'DELETE FROM ledger WHERE recorded_at <= ?', (time.time() - self.ttl,)
+        ).rowcount)
+        self._last_compacted = time.time()
+        if removed:
+            logger.info("Idempotency ledger - Compacted %s expired entries.", removed)
+        return removed
+
+    def _maybe_compact(self):
+        if time.time() - self._last_compacted >= self.compact_interval:
+            self.compact()
+
+_ledger = None
+
+def get_idempotency_ledger():
+    """Returns the process-wide ledger, opening it on first use."""
+    global _ledger
+    if _ledger is None:
+        _ledger = IdempotencyLedger(config.idempotency_ledger_path, config.idempotency_ledger_ttl)
+    return _ledger
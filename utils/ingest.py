@@ -0,0 +1,95 @@
+import hashlib
+import hmac
+import json
+from utils import config
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+class WebhookRejected(Exception):
+    """Raised when an incoming webhook fails ingestion. status_code is returned to the sender."""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+def compile_schema(fields):
+    """
+    Compiles a webhook schema into a tuple of (key, type, allowed values) checks.
+
+    Parameters:
+        fields (dict): key -> (expected type, iterable of allowed values or None for any value).
+    """
+    return tuple((key, expected_type, frozenset(allowed) if allowed else None) for key, (expected_type, allowed) in fields.items())
+
+KARBON_WEBHOOK_SCHEMA = compile_schema({
+    'ResourcePermaKey': (str, None),
+    'ResourceType': (str, config.karbon_webhook_resource_types),
+    'ActionType': (str, config.karbon_webhook_action_types)
+})
+
+def validate_webhook_payload(payload, schema=KARBON_WEBHOOK_SCHEMA):
+    """Returns None if payload matches the schema, otherwise a short description of the first problem."""
+    if not isinstance(payload, dict):
+        return "body is not a JSON object"
+    for key, expected_type, allowed in schema:
+        value = payload.get(key)
+        if value is None:
+            return f"missing {key}"
+        if type(value) is not expected_type:
+            return f"{key} must be {expected_type.__name__}"
+        if allowed is not None and value not in allowed:
+            return f"unsupported {key} {value!r}"
+    return None
+
+def compute_signature(body, secret):
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+def verify_signature(body, signature, secret):
+    """Constant-time check of a hex HMAC-SHA256 signature of body. Accepts an optional 'sha256=' prefix."""
+    if not signature:
+        return False
+    if signature.startswith('sha256='):
+        signature = signature[len('sha256='):]
+    # compared as bytes: compare_digest raises TypeError for str with non-ASCII characters.
+    return hmac.compare_digest(compute_signature(body, secret).encode(), signature.lower().encode('utf-8', 'replace'))
+
+def parse_webhook(body, headers, max_body_bytes=None, signing_secret=None):
+    """
+    Validates and decodes a raw webhook body in one pass.
+
+    Checks run cheapest first: declared and actual size, signature (when a signing secret is
+    configured), a single JSON decode, then the compiled schema.
+
+    Returns:
+        dict: The decoded webhook payload.
+
+    Raises:
+        WebhookRejected: with 413 for oversized bodies, 401 for bad signatures and 400 for
+            malformed or unrecognised payloads.
+    """
+    max_body_bytes = max_body_bytes or config.webhook_max_body_bytes
+    signing_secret = signing_secret if signing_secret is not None else config.webhook_signing_secret
+
+    content_length = headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > max_body_bytes:
+        raise WebhookRejected(413, "Payload too large")
+    if len(body) > max_body_bytes:
+        raise WebhookRejected(413, "Payload too large")
+
+    if signing_secret and not verify_signature(body, headers.get(config.webhook_signature_header), signing_secret):
+        raise WebhookRejected(401, "Invalid signature")
+
+    try:
+        payload = _loads(body)
+    except ValueError:
+        raise WebhookRejected(400, "Invalid JSON")
+
+    problem = validate_webhook_payload(payload)
+    if problem is not None:
+        raise WebhookRejected(400, f"Not a recognized webhook: {problem}")
+    return payload
@@ -1,6 +1,140 @@
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+
+# Logging settings, read from the environment.
+#   LOG_LEVEL              root level (default INFO)
+#   LOG_LEVELS             per-module levels, e.g. "services=WARNING,handlers.karbon_work_item_handler=DEBUG"
+#   LOG_FORMAT             'json' (default) or 'text'
+#   LOG_STREAM             'auto' (default), 'stderr' or 'none'. 'auto' only adds a stream handler when
+#                          nothing else (e.g. the Azure Functions worker) is already handling root records;
+#                          handlers that are (the worker's) get the LOG_FORMAT formatter instead.
+#   LOG_BODY_SAMPLE_RATE   fraction of webhook requests whose headers and body are logged (default 0)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_STREAM = os.getenv('LOG_STREAM', 'auto').lower()
+LOG_BODY_SAMPLE_RATE = float(os.getenv('LOG_BODY_SAMPLE_RATE', 0))
+
+# Header and body keys whose values never reach the logs.
+REDACTED_KEYS = {'authorization', 'accesskey', 'x-functions-key', 'x-apikey', 'cookie', 'x-karbon-signature', 'emailaddress', 'email'}
+
+_correlation_id = contextvars.ContextVar('correlation_id', default=None)
+_listener = None
+
+# Attributes every LogRecord has; anything else was passed through extra= and is emitted as a field.
+_STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'correlation_id'}
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:16]
+
+def set_correlation_id(correlation_id=None):
+    """Sets the correlation id for the current task (and tasks it creates). Returns the id used."""
+    correlation_id = correlation_id or new_correlation_id()
+    _correlation_id.set(correlation_id)
+    return correlation_id
+
+def get_correlation_id():
+    return _correlation_id.get()
+
+def should_log_body():
+    """Decides whether this request's headers and body are sampled into the logs."""
+    return LOG_BODY_SAMPLE_RATE > 0 and random.random() < LOG_BODY_SAMPLE_RATE
+
+def redact(value):
+    """Returns a copy of a dict (or list of dicts) with sensitive values masked."""
+    if isinstance(value, dict):
+        return {key: '***' if str(key).lower() in REDACTED_KEYS else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, including the correlation id and extra fields."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'correlation_id': record.correlation_id
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def _record_factory(factory):
+    # stamp the correlation id on the calling task, before the record crosses to the listener thread.
+    def create(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.correlation_id = _correlation_id.get()
+        return record
+    return create
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def _formatter():
+    if LOG_FORMAT == 'json':
+        return JsonFormatter()
+    return logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - [%(correlation_id)s] %(message)s', '%Y-%m-%d %H:%M:%S')
 
 def setup_logging():
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s - %(levelname)s - %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S')
+    """
+    Configures logging once per process; later calls are no-ops.
+
+    Records are handed to a QueueHandler and written by a QueueListener thread, so formatting
+    and stream I/O never run on the request path.
+
+    Handlers installed by the host before this runs (the Azure Functions worker's, which forwards
+    the formatted message to App Insights) stay on the root logger and get the LOG_FORMAT
+    formatter, so the correlation id and extra fields reach the host too. They aren't moved
+    behind the queue: the worker matches each record to its invocation on the calling thread,
+    and it already sends records on asynchronously.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    logging.setLogRecordFactory(_record_factory(logging.getLogRecordFactory()))
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    # chatty third-party loggers stay quiet unless asked for.
+    for name in ('asyncio', 'azure', 'urllib3'):
+        if name not in LOG_LEVELS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    for host_handler in root.handlers:
+        host_handler.setFormatter(_formatter())
+
+    handlers = []
+    if LOG_STREAM == 'stderr' or (LOG_STREAM == 'auto' and not root.handlers):
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(_formatter())
+        handlers.append(stream_handler)
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    if handlers:
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,170 @@
+import bisect
+import logging
+import time
+from utils import config
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the stage duration histogram buckets.
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {} # label tuple -> value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    """Prometheus-style histogram. Observations are bucketed on the way in, so rendering is cheap."""
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {} # label tuple -> [per-bucket counts (last one is +Inf), sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+def format_labels(key):
+    if not key:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
+
+stage_duration = Histogram('webhook_stage_duration_seconds', "Time spent in each stage of webhook handling.")
+webhooks_total = Counter('webhooks_total', "Webhooks received by MainWebhookHandler, by resource type and outcome.")
+
+def _load_tracer():
+    """Sets up OpenTelemetry span export over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set and the packages are installed."""
+    if not config.otel_exporter_endpoint:
+        return None
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http are not installed. Spans won't be exported.")
+        return None
+
+    provider = TracerProvider(resource=Resource.create({'service.name': config.otel_service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer(__name__)
+
+_tracer = _load_tracer()
+
+class Span:
+    """
+    Times one stage into webhook_stage_duration_seconds, and into an OpenTelemetry span when export is on.
+
+    The outcome label is 'error' when the block raises and 'ok' otherwise, unless set explicitly.
+    Labels added with set() inside the block (e.g. an upstream status) are recorded too.
+    """
+
+    __slots__ = ('labels', 'started', '_otel', '_otel_span')
+
+    def __init__(self, stage, labels):
+        labels['stage'] = stage
+        self.labels = labels
+        self._otel = None
+
+    def set(self, **labels):
+        self.labels.update(labels)
+
+    def __enter__(self):
+        if _tracer is not None:
+            self._otel = _tracer.start_as_current_span(self.labels['stage'], attributes={key: str(value) for key, value in self.labels.items()})
+            self._otel_span = self._otel.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.labels['outcome'] = 'error'
+        else:
+            self.labels.setdefault('outcome', 'ok')
+        stage_duration.observe(duration, **self.labels)
+        if self._otel is not None:
+            self._otel_span.set_attributes({key: str(value) for key, value in self.labels.items()})
+            self._otel.__exit__(exc_type, exc, traceback)
+        return False
+
+class _DisabledSpan:
+    __slots__ = ()
+
+    def set(self, **labels):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_disabled_span = _DisabledSpan()
+
+def span(stage, **labels):
+    """
+    Returns a context manager that times a stage of webhook handling, e.g.
+
+        with span('contact_fetch') as timing:
+            ...
+            timing.set(status=200)
+    """
+    if not config.metrics_enabled:
+        return _disabled_span
+    return Span(stage, labels)
+
+def stats_counter(name, help, samples):
+    """Renders externally kept counts, given as (labels dict, value) pairs, as a Prometheus counter."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+    return lines
+
+def stats_gauge(name, help, samples):
+    """Renders current values, given as (labels dict, value) pairs, as a Prometheus gauge."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+    return lines
+
+def render_prometheus(extra_lines=()):
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = stage_duration.render() + webhooks_total.render()
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,273 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import cProfile
+import glob
+import hashlib
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from utils import config
+from utils.logging_config import setup_logging
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Checked before anything else, so profiling costs a single attribute lookup when it's off.
+enabled = config.profiling_sample_rate > 0 or bool(config.profiling_secret)
+
+_disabled = contextlib.nullcontext()
+_session = contextvars.ContextVar('profile_session', default=None)
+_active = None # only one profile runs at a time
+
+# correlation id -> expiry, for webhooks that asked to be profiled with a signed header.
+_requested = collections.OrderedDict()
+REQUEST_TTL = 600 # seconds a request waits in the queue and still gets profiled
+MAX_REQUESTED = 1000
+
+def sign_token(expires, secret=None):
+    """Returns a profiling token valid until the epoch time expires, as '<expires>:<hex HMAC-SHA256>'."""
+    secret = secret or config.profiling_secret
+    signature = hmac.new(secret.encode(), f"profile:{int(expires)}".encode(), hashlib.sha256).hexdigest()
+    return f"{int(expires)}:{signature}"
+
+def verify_token(token, secret=None, now=None):
+    """Constant-time check of a profiling token. Expired or malformed tokens are rejected."""
+    secret = secret or config.profiling_secret
+    if not token or not secret:
+        return False
+    try:
+        expires, _, signature = token.partition(':')
+        if not expires.isascii() or not expires.isdigit() or int(expires) < (now or time.time()):
+            return False
+        expected = sign_token(int(expires), secret).encode()
+        return hmac.compare_digest(expected, f"{expires}:{signature.lower()}".encode('utf-8', 'replace'))
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+def request_profile(headers, correlation_id):
+    """Marks the webhook for profiling if its headers carry a valid token. Returns whether it was marked."""
+    if not config.profiling_secret or not verify_token(headers.get(config.profiling_header)):
+        return False
+    now = time.monotonic()
+    _requested[correlation_id] = now + REQUEST_TTL
+    while _requested and (len(_requested) > MAX_REQUESTED or next(iter(_requested.values())) < now):
+        _requested.popitem(last=False)
+    return True
+
+def should_profile(correlation_id):
+    if not enabled:
+        return False
+    expires = _requested.pop(correlation_id, None)
+    if expires is not None and expires >= time.monotonic():
+        return True
+    return config.profiling_sample_rate > 0 and random.random() < config.profiling_sample_rate
+
+def maybe_profile(name, correlation_id):
+    """
+    Returns an async context manager that profiles its body when this webhook was picked for
+    profiling (signed header or sampling rate), and does nothing otherwise, e.g.
+
+        async with maybe_profile(resource_type, correlation_id):
+            ...
+    """
+    if not enabled or _active is not None or not should_profile(correlation_id):
+        return _disabled
+    return ProfileSession(name, correlation_id)
+
+def frame_label(frame):
+    # co_qualname (Class.method) is new in Python 3.11; older workers get the bare function name.
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+def await_stack(awaitable):
+    """Labels for a suspended coroutine and everything it's awaiting, outermost first."""
+    labels = []
+    while awaitable is not None:
+        frame = getattr(awaitable, 'cr_frame', None) or getattr(awaitable, 'gi_frame', None) or getattr(awaitable, 'ag_frame', None)
+        if frame is None:
+            # a future or other leaf awaitable, e.g. a socket read in aiohttp.
+            labels.append(f"[await {type(awaitable).__name__}]")
+            break
+        labels.append(frame_label(frame))
+        awaitable = getattr(awaitable, 'cr_await', None) or getattr(awaitable, 'gi_yieldfrom', None) or getattr(awaitable, 'ag_await', None)
+    return labels
+
+def running_stack(frame, root_frame):
+    """Labels for a thread's stack from root_frame (the task's coroutine) down to frame, outermost first."""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        if frame is root_frame:
+            break
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+class StackSampler:
+    """
+    Samples the stacks of a webhook's tasks from a background thread.
+
+    Every task created while the profile is active (in its context) is tracked. Each sample
+    records, for every live tracked task, either the stack it's running on the event loop thread
+    or the chain of awaits it's suspended in, so time blocked on outbound HTTP shows up under
+    the await that was waiting. Concurrent tasks each count, so totals are task time, not wall time.
+    """
+
+    def __init__(self, loop, root_task, interval):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.interval = interval
+        self.tasks = {root_task}
+        self.counts = collections.Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def track(self, task):
+        with self._lock:
+            self.tasks.add(task)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                # the loop thread moved on mid-walk; the next sample will do.
+                logger.debug("Profiling - Skipped a sample: %s", e)
+
+    def sample(self):
+        with self._lock:
+            tasks = [task for task in self.tasks if not task.done()]
+        running = asyncio.current_task(self.loop)
+        loop_frame = sys._current_frames().get(self.loop_thread)
+        for task in tasks:
+            coroutine = task.get_coro()
+            if task is running and loop_frame is not None:
+                stack = running_stack(loop_frame, getattr(coroutine, 'cr_frame', None))
+            else:
+                stack = await_stack(coroutine)
+            if stack:
+                self.counts[';'.join(stack)] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        """The samples in collapsed-stack format, one 'frame;frame;frame count' line per stack."""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+class ProfileSession:
+    """Profiles one webhook's processing and writes the result to config.profiling_dir."""
+
+    def __init__(self, name, correlation_id, mode=None, interval=None, directory=None):
+        self.name = name
+        self.correlation_id = correlation_id or 'none'
+        self.mode = mode or config.profiling_mode
+        self.interval = interval or config.profiling_interval
+        self.directory = directory or config.profiling_dir
+        self._sampler = None
+        self._profiler = None
+        self._token = None
+        self._previous_factory = None
+        self._started = None
+
+    async def __aenter__(self):
+        global _active
+        if _active is not None:
+            return self
+        _active = self
+        loop = asyncio.get_running_loop()
+        self._started = time.perf_counter()
+        if self.mode == 'cprofile':
+            # cProfile sees everything on the loop thread while enabled, but not time spent suspended.
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._sampler = StackSampler(loop, asyncio.current_task(), self.interval)
+            self._token = _session.set(self._sampler)
+            self._install_task_factory(loop)
+            self._sampler.start()
+        logger.info("Profiling - Started %s profile of %s webhook %s.", self.mode, self.name, self.correlation_id)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        global _active
+        if _active is not self:
+            return False
+        try:
+            elapsed = time.perf_counter() - self._started
+            if self._profiler is not None:
+                self._profiler.disable()
+            else:
+                self._sampler.stop()
+                asyncio.get_running_loop().set_task_factory(self._previous_factory)
+                _session.reset(self._token)
+            path = await asyncio.to_thread(self._write)
+            logger.info("Profiling - Wrote %s profile of %s webhook %s (%.3fs) to %s.", self.mode, self.name, self.correlation_id, elapsed, path)
+        except Exception as e:
+            logger.warning("Profiling - Could not write profile: %s", e)
+        finally:
+            _active = None
+        return False
+
+    def _install_task_factory(self, loop):
+        previous = self._previous_factory = loop.get_task_factory()
+
+        def task_factory(loop, coroutine, **kwargs):
+            task = previous(loop, coroutine, **kwargs) if previous else asyncio.Task(coroutine, loop=loop, **kwargs)
+            # runs in the creating task's context, so only tasks spawned by the profiled webhook are tracked.
+            sampler = _session.get()
+            if sampler is not None:
+                sampler.track(task)
+            return task
+
+        loop.set_task_factory(task_factory)
+
+    def _write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        stem = f"{time.strftime('%Y%m%dT%H%M%S')}-{self.name}-{self.correlation_id[:16]}"
+        if self._profiler is not None:
+            path = os.path.join(self.directory, f"{stem}.prof")
+            self._profiler.dump_stats(path)
+        else:
+            path = os.path.join(self.directory, f"{stem}.collapsed")
+            with open(path, 'w') as file:
+                file.write(self._sampler.collapsed())
+        rotate_profiles(self.directory)
+        return path
+
+def rotate_profiles(directory, max_bytes=None, max_files=None):
+    """Deletes the oldest profiles until the directory is within max_bytes and max_files. Returns the number deleted."""
+    max_bytes = max_bytes or config.profiling_max_bytes
+    max_files = max_files or config.profiling_max_files
+    profiles = []
+    for path in glob.glob(os.path.join(directory, '*.prof')) + glob.glob(os.path.join(directory, '*.collapsed')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        profiles.append((stat.st_mtime, stat.st_size, path))
+    profiles.sort()
+
+    total = sum(size for _, size, _ in profiles)
+    deleted = 0
+    while profiles and (total > max_bytes or len(profiles) > max_files):
+        _, size, path = profiles.pop(0)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
+        deleted += 1
+    return deleted
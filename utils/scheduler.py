@@ -0,0 +1,296 @@
+import asyncio
+import importlib
+import json
+import logging
+import random
+import time
+from utils import config
+from utils.logging_config import setup_logging
+from utils.storage import SqliteStore
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Action kinds and the 'module:function' that fires each, called as executor(payload).
+# Resolved on first use, so actions stored before a restart fire even if nothing imported the module yet.
+SCHEDULED_ACTION_EXECUTORS = {
+    'asknicely_survey': 'helpers.send_contacts_to_asknicely:fire_scheduled_survey',
+    'karbon_note': 'helpers.send_contacts_to_asknicely:fire_scheduled_note'
+}
+
+# Optional 'module:function' per kind, called as handler(action, error) once an action is dead-lettered,
+# e.g. to undo what scheduling it recorded and tell someone it never went out.
+SCHEDULED_ACTION_DEAD_LETTER_HANDLERS = {
+    'asknicely_survey': 'helpers.send_contacts_to_asknicely:survey_dead_lettered'
+}
+
+class ActionFailed(Exception):
+    """Raised by an executor for a failure that mustn't be retried, e.g. a request that may already have taken effect. The action is dead-lettered at once."""
+
+class ScheduledAction:
+    """A due action leased from the scheduler. attempts counts this one."""
+
+    __slots__ = ('id', 'kind', 'payload', 'work_item_key', 'contact_key', 'attempts', 'lease')
+
+    def __init__(self, id, kind, payload, work_item_key, contact_key, attempts, lease):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.work_item_key = work_item_key
+        self.contact_key = contact_key
+        self.attempts = attempts
+        self.lease = lease
+
+class ActionScheduler(SqliteStore):
+    """
+    Persistent store of delayed outbound actions, such as AskNicely survey triggers and Karbon notes.
+
+    Actions are rows indexed by due time, so scheduling, cancelling and finding the next due batch
+    are each an index lookup (O(log n)) however many are pending. They survive restarts, and reach
+    other instances (for cancelling), only as far as the database file does, so deployed apps
+    holding surveys need ACTION_SCHEDULER_PATH on shared storage.
+    A background loop leases due actions in batches, fires them through their executor and
+    deletes them. A failed action is retried with backoff, and after max_attempts it's moved to
+    dead_actions and its kind's dead-letter handler is called.
+
+    Leasing pushes an action's due time out by lease seconds, so an action whose worker died
+    mid-fire becomes due again instead of being lost.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS scheduled_actions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            work_item_key TEXT,
+            contact_key TEXT,
+            due_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease TEXT,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS scheduled_actions_due_at ON scheduled_actions (due_at);
+        CREATE INDEX IF NOT EXISTS scheduled_actions_work_item_key ON scheduled_actions (work_item_key);
+        CREATE TABLE IF NOT EXISTS dead_actions (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            work_item_key TEXT,
+            contact_key TEXT,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            created_at REAL NOT NULL,
+            failed_at REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path, executors=None, dead_letter_handlers=None, batch_size=100, lease=300, max_attempts=5, retry_base_delay=60, poll_interval=30):
+        super().__init__(path)
+        self._paths = dict(executors or SCHEDULED_ACTION_EXECUTORS)
+        self._executors = {}
+        self._dead_letter_paths = dict(SCHEDULED_ACTION_DEAD_LETTER_HANDLERS if dead_letter_handlers is None else dead_letter_handlers)
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.poll_interval = poll_interval
+        self._task = None
+        self._wake = None
+        self._next_due = None
+        self.stats = {'scheduled': 0, 'fired': 0, 'retried': 0, 'dead_lettered': 0, 'cancelled': 0}
+
+    def executor_for(self, kind):
+        executor = self._executors.get(kind)
+        if executor is None:
+            executor = self._executors[kind] = resolve(self._paths[kind])
+        return executor
+
+    async def schedule(self, kind, payload, due_at, work_item_key=None, contact_key=None):
+        """Stores an action to fire at the epoch time due_at. Returns its id."""
+        if kind not in self._paths:
+            raise ValueError(f"Unknown scheduled action kind {kind!r}")
+        action_id = await asyncio.to_thread(
+            self._transaction,
+            lambda connection: connection.execute(
+                'INSERT INTO scheduled_actions (kind, payload, work_item_key, contact_key, due_at, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, json.dumps(payload), work_item_key, contact_key, due_at, time.time())
+            ).lastrowid
+        )
+        self.stats['scheduled'] += 1
+        # wake the loop early if this action is due before whatever it's sleeping towards.
+        if self._wake is not None and (self._next_due is None or due_at < self._next_due):
+            self._wake.set()
+        return action_id
+
+    async def cancel(self, work_item_key, kind=None):
+        """
+        Deletes the pending actions for a work item, optionally only one kind. Actions that have been
+        leased are left alone: they may already be firing, or have fired before their worker died.
+
+        Returns:
+            list: (kind, contact_key) of every cancelled action.
+        """
+        def work(connection):
+            sql = 'FROM scheduled_actions WHERE work_item_key = ?' + (' AND kind = ?' if kind else '')
+            params = (work_item_key, kind) if kind else (work_item_key,)
+            cancelled = connection.execute(f'SELECT kind, contact_key {sql} AND lease IS NULL', params).fetchall()
+            connection.execute(f'DELETE {sql} AND lease IS NULL', params)
+            leased = connection.execute(f'SELECT COUNT(*) {sql}', params).fetchone()[0]
+            return cancelled, leased
+
+        cancelled, leased = await asyncio.to_thread(self._transaction, work)
+        if leased:
+            logger.info("Scheduler - Left %s leased actions for work item %s uncancelled.", leased, work_item_key)
+        self.stats['cancelled'] += len(cancelled)
+        return cancelled
+
+    async def pending(self):
+        rows = await asyncio.to_thread(self._execute, 'SELECT COUNT(*) FROM scheduled_actions')
+        return rows[0][0]
+
+    async def lease_due(self, now=None):
+        """Leases up to batch_size actions that are due, earliest first."""
+        return await asyncio.to_thread(self._transaction, lambda connection: self._lease(connection, now or time.time()))
+
+    def _lease(self, connection, now):
+        rows = connection.execute(
+            'SELECT id, kind, payload, work_item_key, contact_key, attempts FROM scheduled_actions WHERE due_at <= ? ORDER BY due_at LIMIT ?',
+            (now, self.batch_size)
+        ).fetchall()
+        actions = []
+        for id, kind, payload, work_item_key, contact_key, attempts in rows:
+            lease = f"{now}:{id}:{random.getrandbits(32)}"
+            connection.execute(
+                'UPDATE scheduled_actions SET due_at = ?, attempts = ?, lease = ? WHERE id = ?',
+                (now + self.lease, attempts + 1, lease, id)
+            )
+            actions.append(ScheduledAction(id, kind, json.loads(payload), work_item_key, contact_key, attempts + 1, lease))
+        return actions
+
+    async def _complete(self, action):
+        await asyncio.to_thread(self._execute, 'DELETE FROM scheduled_actions WHERE id = ? AND lease = ?', (action.id, action.lease))
+
+    async def _dead_letter(self, action, error):
+        logger.error("Scheduler - Dead-lettering %s action %s for work item %s after %s attempts: %s", action.kind, action.id, action.work_item_key, action.attempts, error)
+
+        def work(connection):
+            connection.execute(
+                'INSERT OR REPLACE INTO dead_actions (id, kind, payload, work_item_key, contact_key, attempts, error, created_at, failed_at) '
+                'SELECT id, kind, payload, work_item_key, contact_key, attempts, ?, created_at, ? FROM scheduled_actions WHERE id = ? AND lease = ?',
+                (str(error), time.time(), action.id, action.lease)
+            )
+            connection.execute('DELETE FROM scheduled_actions WHERE id = ? AND lease = ?', (action.id, action.lease))
+
+        await asyncio.to_thread(self._transaction, work)
+        self.stats['dead_lettered'] += 1
+        path = self._dead_letter_paths.get(action.kind)
+        if path:
+            try:
+                await resolve(path)(action, error)
+            except Exception as e:
+                logger.error("Scheduler - Dead-letter handler for %s action %s failed: %s", action.kind, action.id, e, exc_info=True)
+
+    async def _retry(self, action, error):
+        if action.attempts >= self.max_attempts:
+            await self._dead_letter(action, error)
+            return
+        delay = self.retry_base_delay * 2 ** (action.attempts - 1) * random.uniform(0.5, 1.0)
+        self.stats['retried'] += 1
+        await asyncio.to_thread(
+            self._execute,
+            'UPDATE scheduled_actions SET due_at = ?, lease = NULL WHERE id = ? AND lease = ?',
+            (time.time() + delay, action.id, action.lease)
+        )
+
+    async def _fire(self, action):
+        try:
+            await self.executor_for(action.kind)(action.payload)
+        except ActionFailed as e:
+            await self._dead_letter(action, e)
+        except Exception as e:
+            logger.warning("Scheduler - %s action %s failed on attempt %s: %s", action.kind, action.id, action.attempts, e)
+            await self._retry(action, e)
+        else:
+            self.stats['fired'] += 1
+            await self._complete(action)
+
+    async def run_once(self, now=None):
+        """Leases and fires one batch of due actions. Returns the number fired or retried."""
+        actions = await self.lease_due(now)
+        if actions:
+            await asyncio.gather(*(self._fire(action) for action in actions))
+        return len(actions)
+
+    def dead_letters(self, limit=100):
+        """Returns the most recently dead-lettered actions with their error."""
+        rows = self._execute(
+            'SELECT id, kind, payload, work_item_key, contact_key, attempts, error, failed_at FROM dead_actions ORDER BY failed_at DESC LIMIT ?', (limit,)
+        )
+        return [
+            {'Id': id, 'Kind': kind, 'Payload': json.loads(payload), 'WorkItemKey': work_item_key, 'ContactKey': contact_key, 'Attempts': attempts, 'Error': error, 'FailedAt': failed_at}
+            for id, kind, payload, work_item_key, contact_key, attempts, error, failed_at in rows
+        ]
+
+    async def _seconds_until_next_due(self):
+        rows = await asyncio.to_thread(self._execute, 'SELECT MIN(due_at) FROM scheduled_actions')
+        self._next_due = rows[0][0]
+        if self._next_due is None:
+            return self.poll_interval
+        return min(self.poll_interval, max(0.0, self._next_due - time.time()))
+
+    def ensure_started(self):
+        """Starts the firing loop on the running event loop if it isn't already running."""
+        if self._task is None or self._task.done():
+            logger.info("Scheduler - Starting the action loop.")
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            # cleared before looking, so an action scheduled while this batch fires isn't slept through.
+            self._wake.clear()
+            try:
+                # keep going while full batches come back, then sleep until the next action is due.
+                while await self.run_once() >= self.batch_size:
+                    pass
+                wait = await self._seconds_until_next_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Scheduler - Action loop error: %s", e, exc_info=True)
+                wait = self.poll_interval
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+def resolve(path):
+    module_name, _, function_name = path.partition(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+_scheduler = None
+
+def get_action_scheduler():
+    """Returns the process-wide action scheduler, opening it on first use."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ActionScheduler(
+            config.action_scheduler_path,
+            batch_size=config.action_scheduler_batch_size,
+            lease=config.action_scheduler_lease,
+            max_attempts=config.action_scheduler_max_attempts,
+            retry_base_delay=config.action_scheduler_retry_base_delay,
+            poll_interval=config.action_scheduler_poll_interval
+        )
+    return _scheduler
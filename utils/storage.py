@@ -0,0 +1,50 @@
+import os
+import sqlite3
+import threading
+
+def open_sqlite(path):
+    """
+    Opens a SQLite database for a local store, creating its directory if needed.
+
+    The connection may be shared between threads; callers serialise access with their own lock.
+    WAL mode keeps writers from blocking readers and makes small commits cheap.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+class SqliteStore:
+    """Base class for the local SQLite-backed stores. Subclasses provide SCHEMA."""
+
+    SCHEMA = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = open_sqlite(path)
+        with self._lock:
+            self._connection.executescript(self.SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def _transaction(self, work):
+        """Runs work(connection) inside a write transaction and returns its result."""
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(self._connection)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+            return result
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,395 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from utils import config
+from utils.logging_config import setup_logging, set_correlation_id
+from utils.storage import SqliteStore
+
+# apply logging config file
+setup_logging()
+logger = logging.getLogger(__name__)
+
+class QueueMessage:
+    """A webhook payload leased from a queue. receipt identifies the lease for ack/retry."""
+
+    __slots__ = ('id', 'payload', 'attempts', 'receipt', 'correlation_id')
+
+    def __init__(self, id, payload, attempts, receipt, correlation_id=None):
+        self.id = id
+        self.payload = payload
+        self.attempts = attempts
+        self.receipt = receipt
+        self.correlation_id = correlation_id
+
+class WebhookQueue:
+    """
+    Interface for the durable queue that sits between MainWebhookHandler and webhook_processor.
+
+    Messages are leased by dequeue and stay invisible for visibility_timeout seconds. A message
+    that is neither acked nor retried before the lease runs out becomes visible again, so work
+    survives a worker that dies mid-flight.
+    """
+
+    def __init__(self, max_attempts=5, retry_base_delay=30, retry_max_delay=900):
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+
+    def retry_delay(self, attempts):
+        """Jittered exponential backoff for a message that has been tried attempts times."""
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** max(0, attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def enqueue(self, payload, correlation_id=None):
+        raise NotImplementedError
+
+    async def dequeue(self, batch_size, visibility_timeout):
+        raise NotImplementedError
+
+    async def ack(self, message):
+        raise NotImplementedError
+
+    async def extend(self, message, visibility_timeout):
+        """Keeps a leased message hidden for another visibility_timeout seconds, while it's still being processed."""
+        raise NotImplementedError
+
+    async def retry(self, message, error):
+        """Returns a failed message to the queue, or dead-letters it once max_attempts is reached."""
+        raise NotImplementedError
+
+    async def depth(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class SqliteWebhookQueue(SqliteStore, WebhookQueue):
+    """
+    Durable queue stored in a local SQLite database. Works fully offline.
+
+    For local runs, the benchmark and tools only: the file lives on one instance's disk
+    (LOCAL_DATA_DIR), so in Azure its messages are lost when that instance is recycled or scaled in,
+    after Karbon already got its 202. Deployed apps use AzureStorageWebhookQueue.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            visible_at REAL NOT NULL,
+            receipt TEXT,
+            correlation_id TEXT,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_visible_at ON messages (visible_at);
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            created_at REAL NOT NULL,
+            failed_at REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path, **kwargs):
+        SqliteStore.__init__(self, path)
+        WebhookQueue.__init__(self, **kwargs)
+
+    async def enqueue(self, payload, correlation_id=None):
+        now = time.time()
+        await asyncio.to_thread(
+            self._execute,
+            'INSERT INTO messages (payload, visible_at, correlation_id, created_at) VALUES (?, ?, ?, ?)',
+            (json.dumps(payload), now, correlation_id, now)
+        )
+
+    async def dequeue(self, batch_size, visibility_timeout):
+        return await asyncio.to_thread(self._transaction, lambda connection: self._lease(connection, batch_size, visibility_timeout))
+
+    def _lease(self, connection, batch_size, visibility_timeout):
+        now = time.time()
+        rows = connection.execute(
+            'SELECT id, payload, attempts, correlation_id FROM messages WHERE visible_at <= ? ORDER BY visible_at, id LIMIT ?',
+            (now, batch_size)
+        ).fetchall()
+        messages = []
+        for id, payload, attempts, correlation_id in rows:
+            receipt = uuid.uuid4().hex
+            connection.execute(
+                'UPDATE messages SET attempts = ?, visible_at = ?, receipt = ? WHERE id = ?',
+                (attempts + 1, now + visibility_timeout, receipt, id)
+            )
+            messages.append(QueueMessage(id, json.loads(payload), attempts + 1, receipt, correlation_id))
+        return messages
+
+    async def ack(self, message):
+        await asyncio.to_thread(self._execute, 'DELETE FROM messages WHERE id = ? AND receipt = ?', (message.id, message.receipt))
+
+    async def extend(self, message, visibility_timeout):
+        await asyncio.to_thread(
+            self._execute,
+            'UPDATE messages SET visible_at = ? WHERE id = ? AND receipt = ?',
+            (time.time() + visibility_timeout, message.id, message.receipt)
+        )
+
+    async def retry(self, message, error):
+        await asyncio.to_thread(self._transaction, lambda connection: self._retry(connection, message, error))
+
+    def _retry(self, connection, message, error):
+        if message.attempts >= self.max_attempts:
+            logger.error("Webhook queue - Dead-lettering message %s after %s attempts: %s", message.id, message.attempts, error)
+            connection.execute(
+                'INSERT OR REPLACE INTO dead_letters (id, payload, attempts, error, created_at, failed_at) '
+                'SELECT id, payload, attempts, ?, created_at, ? FROM messages WHERE id = ? AND receipt = ?',
+                (str(error), time.time(), message.id, message.receipt)
+            )
+            connection.execute('DELETE FROM messages WHERE id = ? AND receipt = ?', (message.id, message.receipt))
+        else:
+            connection.execute(
+                'UPDATE messages SET visible_at = ?, receipt = NULL WHERE id = ? AND receipt = ?',
+                (time.time() + self.retry_delay(message.attempts), message.id, message.receipt)
+            )
+
+    async def depth(self):
+        rows = await asyncio.to_thread(self._execute, 'SELECT COUNT(*) FROM messages')
+        return rows[0][0]
+
+    async def close(self):
+        # SqliteStore.close is synchronous; keep the awaitable WebhookQueue interface.
+        await asyncio.to_thread(SqliteStore.close, self)
+
+    def dead_letters(self, limit=100):
+        """Returns the most recent dead-lettered payloads with their error."""
+        rows = self._execute('SELECT id, payload, attempts, error, failed_at FROM dead_letters ORDER BY failed_at DESC LIMIT ?', (limit,))
+        return [{'Id': id, 'Payload': json.loads(payload), 'Attempts': attempts, 'Error': error, 'FailedAt': failed_at} for id, payload, attempts, error, failed_at in rows]
+
+    def requeue_dead_letters(self):
+        """Moves every dead-lettered message back onto the queue with its attempts reset."""
+        def work(connection):
+            now = time.time()
+            moved = connection.execute(
+                'INSERT INTO messages (payload, visible_at, created_at) SELECT payload, ?, created_at FROM dead_letters', (now,)
+            ).rowcount
+            connection.execute('DELETE FROM dead_letters')
+            return moved
+        return self._transaction(work)
+
+class AzureStorageWebhookQueue(WebhookQueue):
+    """
+    Durable queue backed by an Azure Storage Queue, so a burst can be spread across instances.
+    Dead letters go to a sibling '<queue name>-poison' queue. This is the default backend whenever
+    AzureWebJobsStorage is set, i.e. in every deployed function app.
+
+    Works against the Azurite emulator with connection string 'UseDevelopmentStorage=true'.
+    Requires the azure-storage-queue package, which (with aiohttp under it) is only imported on
+    first use, so it stays off the cold-start path of `import function_app`.
+    """
+
+    def __init__(self, connection_string, queue_name, **kwargs):
+        super().__init__(**kwargs)
+        self.connection_string = connection_string
+        self.queue_name = queue_name
+        self.queue_client = None
+        self.poison_client = None
+        self._created = False
+
+    async def _ensure_queues(self):
+        if self._created:
+            return
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.queue.aio import QueueClient
+
+        if self.queue_client is None:
+            self.queue_client = QueueClient.from_connection_string(self.connection_string, self.queue_name)
+            self.poison_client = QueueClient.from_connection_string(self.connection_string, f"{self.queue_name}-poison")
+
+        for client in (self.queue_client, self.poison_client):
+            try:
+                await client.create_queue()
+            except ResourceExistsError:
+                pass
+        self._created = True
+
+    async def enqueue(self, payload, correlation_id=None):
+        await self._ensure_queues()
+        await self.queue_client.send_message(json.dumps({'CorrelationId': correlation_id, 'Payload': payload}))
+
+    async def dequeue(self, batch_size, visibility_timeout):
+        await self._ensure_queues()
+        messages = []
+        received = self.queue_client.receive_messages(messages_per_page=min(batch_size, 32), visibility_timeout=visibility_timeout)
+        async for message in received:
+            envelope = json.loads(message.content)
+            messages.append(QueueMessage(message.id, envelope['Payload'], message.dequeue_count, message.pop_receipt, envelope.get('CorrelationId')))
+            if len(messages) >= batch_size:
+                break
+        return messages
+
+    async def ack(self, message):
+        await self.queue_client.delete_message(message.id, message.receipt)
+
+    async def extend(self, message, visibility_timeout):
+        # every update hands out a new pop receipt, and only the latest one can ack the message.
+        updated = await self.queue_client.update_message(message.id, message.receipt, visibility_timeout=int(visibility_timeout))
+        message.receipt = updated.pop_receipt
+
+    async def retry(self, message, error):
+        if message.attempts >= self.max_attempts:
+            logger.error("Webhook queue - Dead-lettering message %s after %s attempts: %s", message.id, message.attempts, error)
+            await self.poison_client.send_message(json.dumps({'Payload': message.payload, 'Attempts': message.attempts, 'Error': str(error)}))
+            await self.queue_client.delete_message(message.id, message.receipt)
+        else:
+            await self.queue_client.update_message(message.id, message.receipt, visibility_timeout=int(self.retry_delay(message.attempts)))
+
+    async def depth(self):
+        await self._ensure_queues()
+        properties = await self.queue_client.get_queue_properties()
+        return properties.approximate_message_count
+
+    async def close(self):
+        if self.queue_client is not None:
+            await self.queue_client.close()
+            await self.poison_client.close()
+
+class WebhookQueueConsumer:
+    """
+    Background loop that leases webhooks from a queue and runs them through processor.
+
+    Up to max_in_flight messages are processed at once. Whenever one finishes, more are leased
+    (up to batch_size per dequeue) instead of waiting for the rest of a batch, so a message
+    sitting out its coalescing window or a slow handler doesn't hold back the ones behind it,
+    and events for the same key in later leases still reach the coalescer in time to merge.
+
+    A message is acked when processor returns and retried (then dead-lettered) when it raises.
+    Its lease is extended every third of visibility_timeout while it's processed, so a backlog
+    behind the rate limits doesn't make it visible to another instance halfway through.
+    """
+
+    def __init__(self, queue, processor, batch_size=16, max_in_flight=128, visibility_timeout=300, poll_interval=1.0):
+        self.queue = queue
+        self.processor = processor
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self._task = None
+        self._in_flight = set()
+        self._slot_freed = None
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def ensure_started(self):
+        """Starts the consumer loop on the running event loop if it isn't already running."""
+        if self._task is None or self._task.done():
+            logger.info("Webhook queue - Starting consumer loop.")
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        self._slot_freed = asyncio.Event()
+        try:
+            while True:
+                free = self.max_in_flight - len(self._in_flight)
+                if free <= 0:
+                    self._slot_freed.clear()
+                    await self._slot_freed.wait()
+                    continue
+                try:
+                    messages = await self.queue.dequeue(min(self.batch_size, free), self.visibility_timeout)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Webhook queue - Consumer loop error: %s", e, exc_info=True)
+                    messages = []
+                for message in messages:
+                    task = asyncio.create_task(self._handle(message))
+                    self._in_flight.add(task)
+                    task.add_done_callback(self._finished)
+                if not messages:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            # unacked messages become visible again once their lease runs out.
+            for task in list(self._in_flight):
+                task.cancel()
+
+    def _finished(self, task):
+        self._in_flight.discard(task)
+        self._slot_freed.set()
+
+    async def run_once(self):
+        """Leases one batch and waits for all of it to be processed. Returns the number of messages handled."""
+        messages = await self.queue.dequeue(self.batch_size, self.visibility_timeout)
+        if messages:
+            await asyncio.gather(*(self._handle(message) for message in messages))
+        return len(messages)
+
+    async def _handle(self, message):
+        set_correlation_id(message.correlation_id)
+        processed = asyncio.Event()
+        renewal = asyncio.create_task(self._keep_leased(message, processed))
+        error = None
+        try:
+            await self.processor(message.payload)
+        except asyncio.CancelledError:
+            renewal.cancel()
+            raise
+        except Exception as e:
+            logger.warning("Webhook queue - Message %s failed on attempt %s: %s", message.id, message.attempts, e)
+            error = e
+        # let a renewal in progress finish, so the ack or retry below uses the latest receipt.
+        processed.set()
+        await renewal
+
+        try:
+            if error is None:
+                await self.queue.ack(message)
+            else:
+                await self.queue.retry(message, error)
+        except Exception as e:
+            logger.error("Webhook queue - Could not %s message %s, it will be redelivered: %s", 'ack' if error is None else 'retry', message.id, e)
+
+    async def _keep_leased(self, message, processed):
+        while True:
+            try:
+                await asyncio.wait_for(processed.wait(), timeout=self.visibility_timeout / 3)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.queue.extend(message, self.visibility_timeout)
+            except Exception as e:
+                logger.warning("Webhook queue - Could not extend the lease on message %s: %s", message.id, e)
+
+def create_webhook_queue(backend=None):
+    """
+    Builds the queue configured by WEBHOOK_QUEUE_BACKEND: 'azure' (the default when
+    AzureWebJobsStorage is set), 'sqlite' (offline only, see SqliteWebhookQueue) or 'none'.
+    """
+    backend = backend or config.webhook_queue_backend
+    options = {
+        'max_attempts': config.webhook_queue_max_attempts,
+        'retry_base_delay': config.webhook_queue_retry_base_delay
+    }
+    if backend == 'sqlite':
+        return SqliteWebhookQueue(config.webhook_queue_path, **options)
+    if backend == 'azure':
+        return AzureStorageWebhookQueue(config.webhook_queue_connection_string, config.webhook_queue_name, **options)
+    if backend == 'none':
+        return None
+    raise ValueError(f"Unknown webhook queue backend: {backend}")